@@ -4,16 +4,18 @@ import ReactDOM from "react-dom";
 import RoomsView from "./room";
 import { ModalRoot, ModalProvider } from "./modals/modals";
 
+const root = document.getElementById('rooms_tab');
+
 const Rooms = () => (
   <ModalProvider>
     <ModalRoot />
-    <RoomsView isAdminView={true}/>
+    <RoomsView isAdminView={true} eventsEnabled={root.dataset.events == 'true'}/>
   </ModalProvider>
 )
 
 ReactDOM.render(
   (<Rooms />),
-  document.getElementById('rooms_tab')
+  root
 );
 
 
@@ -7,7 +7,10 @@ import styled from "styled-components";
 import useInterval from "./use_interval";
 import { useModal, ModalProvider, ModalRoot } from "./modals/modals";
 import { exists, map_of_arr, roomCapacity, roomFullness } from "./helpers";
-import { get_rooms, get_users, me, delete_room, edit_room } from "./zosia_api";
+import {
+  get_room_changes, get_rooms_snapshot, get_users, me, delete_room, edit_room,
+  subscribe_room_events
+} from "./zosia_api";
 
 import { RoomCard } from "./room_card";
 import SearchBar from "./search_bar";
@@ -16,17 +19,33 @@ const RoomsView = (props) =>
 {
   const [state, setState] = React.useState({
     rooms: [],
+    cursor: 0,
   });
   const [searchWords, setSearchWords] = React.useState([]);
   const [showFull, setShowFull] = React.useState(true);
   const [sortingStrategy, setSortingStrategy] = React.useState("room_number");
 
+  // Snapshot has only visible rooms and no lock passwords, so the own room is fetched with all
+  // details and merged into it, even if it's hidden
+  const with_own_room = (rooms, mine) =>
+    mine == null ? rooms : rooms.filter(room => room.id != mine.id).concat([mine]);
+
+  // Fetches only rooms changed since the last known cursor and merges them into the state.
+  // Participants load all rooms at once from the snapshot.
   const refresh = () => {
-    Promise.all([get_rooms(), me.info()])
-      .then(([rooms, info]) => {
-        return { rooms, me: info}
-      })
-      .then(setState);
+    if (!props.isAdminView && state.cursor == 0) {
+      Promise.all([get_rooms_snapshot(), me.info(), me.room()])
+        .then(([snapshot, info, mine]) => setState({
+          rooms: with_own_room(snapshot.rooms, mine), cursor: snapshot.version, me: info
+        }));
+      return;
+    }
+    Promise.all([get_room_changes(state.cursor), me.info()])
+      .then(([changes, info]) => setState(prev => {
+        const changed = new Set(changes.rooms.map(room => room.id).concat(changes.removed));
+        const rooms = prev.rooms.filter(room => !changed.has(room.id));
+        return { rooms: rooms.concat(changes.rooms), cursor: changes.cursor, me: info };
+      }));
   }
 
   const refresh_and_pass_arg = (arg) => {
@@ -34,7 +53,21 @@ const RoomsView = (props) =>
     return arg;
   }
 
-  useInterval(refresh, 60 * 1000);
+  // Room events only signal that something changed, details are fetched from the changes feed.
+  // The changes feed is polled unless events are enabled and their stream is connected.
+  const [streaming, setStreaming] = React.useState(false);
+  const refreshRef = React.useRef(refresh);
+  refreshRef.current = refresh;
+
+  React.useEffect(() => {
+    if (!props.eventsEnabled) {
+      return;
+    }
+    const source = subscribe_room_events(() => refreshRef.current(), setStreaming);
+    return () => source.close();
+  }, []);
+
+  useInterval(refresh, streaming ? null : 60 * 1000);
 
   const room_ops = {
     join: (room_id, password) => me.join_room(room_id, password).then(refresh_and_pass_arg),
@@ -152,18 +185,20 @@ const RoomsView = (props) =>
   )
 }
 
+const root = document.getElementById('rooms_tab');
+
 ReactDOM.render(
     (
     <ModalProvider>
       <ModalRoot/>
       <div className="container">
         <div className="row">
-          <RoomsView isAdminView={false}/>
+          <RoomsView isAdminView={false} eventsEnabled={root.dataset.events == 'true'}/>
         </div>
       </div>
     </ModalProvider>
     ),
-    document.getElementById('rooms_tab')
+    root
 );
 
 export default RoomsView;
@@ -3,7 +3,7 @@ import { resolve } from "path";
 const root = location.protocol + '//' + location.host;
 
 const cache = () => {
-    const cached_data = {};
+    let cached_data = {};
     const has_key = key => cached_data.hasOwnProperty(key)
     const get = key => cached_data[key]
     const store = (key, data) => {
@@ -22,12 +22,35 @@ const cache = () => {
 
 const api_cache = cache();
 
+// Responses tagged by the server are kept with their tags and sent back as `If-None-Match`,
+// so unchanged data comes back as an empty 304 Not Modified response
 const get = uri => {
+    const cached = api_cache.has_key(uri) ? api_cache.get(uri) : null;
+    const headers = cached ? { 'If-None-Match': cached.etag } : {};
+
     return fetch(root + uri, {
         method: 'GET',
+        headers,
+        cache: 'no-store',
     }).then(response => {
+        if (response.status === 304 && cached) {
+            return Promise.resolve(cached.json);
+        }
+
+        if (response.status === 204) {
+            return Promise.resolve(null);
+        }
+
         if (response.ok) {
-            return response.json().then(json => Promise.resolve(json));
+            return response.json().then(json => {
+                const etag = response.headers.get('ETag');
+
+                if (etag) {
+                    api_cache.store(uri, { etag, json });
+                }
+
+                return Promise.resolve(json);
+            });
         }
 
         return response.json().then(json => Promise.reject({
@@ -118,7 +141,7 @@ const me_id = () => get_me().then(({ id }) => id)
 export const me = {
     id: me_id,
     info: get_me,
-    room: get_my_room,
+    room: () => get_my_room(),
     join_room: (room, password) => me_id().then(id => join_room(room, id, password)),
     leave_room: (room) => me_id().then(id => leave_room(room, id)),
     lock_room: (room) => me_id().then(id => lock_room(room, id)),
@@ -126,28 +149,68 @@ export const me = {
 }
 
 export const get_users = () => get('/api/v1/users/')
+const convert_room_from_api = (room) => {
+    const {
+        beds_single,
+        beds_double,
+        available_beds_single,
+        available_beds_double,
+        ...room_
+    } = room;
+    return {
+        ...room_,
+        beds: {
+            single: beds_single,
+            double: beds_double,
+        },
+        available_beds: {
+            single: available_beds_single,
+            double: available_beds_double,
+        },
+    }
+}
+
 export const get_rooms = () => get('/api/v2/rooms/')
-    .then(rooms => rooms.map(room => {
-        const {
-            beds_single,
-            beds_double,
-            available_beds_single,
-            available_beds_double,
-            ...room_
-        } = room;
-        return {
-            ...room_,
-            beds: {
-                single: beds_single,
-                double: beds_double,
-            },
-            available_beds: {
-                single: available_beds_single,
-                double: available_beds_double,
-            },
-        }
+    .then(rooms => rooms.map(convert_room_from_api))
+export const get_room_changes = (since) => get('/api/v2/rooms/changes/?since=' + since)
+    .then(({ cursor, rooms, removed }) => ({
+        cursor,
+        rooms: rooms.map(convert_room_from_api),
+        removed,
     }))
 
+// Snapshot keeps rooms in a compact form, they're converted to the same shape as other rooms.
+// Hidden rooms and lock passwords are not included, so the own room has to be fetched separately.
+const convert_room_from_snapshot = ({ beds, locked_until, members, ...room }) => ({
+    ...room,
+    hidden: false,
+    available_beds: {
+        single: beds[0],
+        double: beds[1],
+    },
+    lock: locked_until == null ? null : { expiration_date: locked_until },
+    members: members.map(([id, first_name, last_name]) => ({ user: { id, first_name, last_name } })),
+})
+
+export const get_rooms_snapshot = () => get('/api/v2/rooms/snapshot/')
+    .then(({ version, rooms }) => ({
+        version,
+        rooms: rooms.map(convert_room_from_snapshot),
+    }))
+
+const ROOM_EVENT_TYPES = ['joined', 'left', 'locked', 'unlocked', 'hidden', 'unhidden']
+
+// Calls on_event for every room event and on_status with whether the stream is connected.
+// The browser reconnects by itself, so the returned source has to be closed explicitly.
+export const subscribe_room_events = (on_event, on_status) => {
+    const source = new EventSource('/api/v2/rooms/events/')
+    source.onopen = () => on_status(true)
+    source.onerror = () => on_status(false)
+    ROOM_EVENT_TYPES.forEach(type =>
+        source.addEventListener(type, event => on_event(JSON.parse(event.data))))
+    return source
+}
+
 const convert_room_to_api = (room_) => {
     const { beds, available_beds, ...room} = room_
     return {
@@ -159,11 +222,12 @@ const convert_room_to_api = (room_) => {
     }
 }
 
-export const get_my_room = (json) => get('/api/v2/rooms/mine')
+export const get_my_room = () => get('/api/v2/rooms/mine/')
+    .then(room => room == null ? null : convert_room_from_api(room))
 export const create_room = (json) => post('/api/v2/rooms/', convert_room_to_api(json))
 export const delete_room = (id) => delete_('/api/v2/rooms/' + id + '/', {})
 export const edit_room = (id, json) => put('/api/v2/rooms/' + id + '/', convert_room_to_api(json))
-export const get_room = (id) => get('/api/v2/rooms/' + id)
+export const get_room = (id) => get('/api/v2/rooms/' + id + '/').then(convert_room_from_api)
 export const join_room = (id, user, password) => post('/api/v2/rooms/' + id + '/member/', { user, password })
 export const leave_room = (id, user) => delete_('/api/v2/rooms/' + id + '/member/', { user })
 export const get_users_room = () => get('/api/v2/rooms/members')
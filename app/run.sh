@@ -3,4 +3,6 @@ set -eu
 
 cd src
 python3 ./manage.py migrate
+# Table of the database cache, does nothing for other cache backends
+python3 ./manage.py createcachetable
 gunicorn --bind ":$PORT" --workers 2 zosia16.wsgi:application
@@ -10,7 +10,8 @@ from organizers.models import OrganizerContact
 from questions.models import QA
 from rooms.models import Room
 from users.models import Organization, User, UserPreferences
-from utils.constants import FULL_DURATION_CHOICES, LECTURE_TYPE, MAX_BONUS_MINUTES, UserInternals
+from utils.constants import BONUS_STEP, FULL_DURATION_CHOICES, LECTURE_TYPE, MAX_BONUS_MINUTES, \
+    UserInternals
 from utils.time_manager import now, time_point, timedelta_since, timedelta_since_now
 
 FIRST_NAMES = ['Kasia', 'Marta', 'Julia', 'Ola', 'Natalia', 'Ania', 'Ewa', 'Alicja', 'Beata',
@@ -153,7 +154,16 @@ def random_bool():
     return random.random() < 0.5
 
 
-def create_random_user_with_preferences(zosia, id):
+def random_bonus(staggered):
+    if staggered:
+        # Bonuses are multiples of bonus step, so users start rooming in waves, like when
+        # organizers set bonuses with the slider
+        return random.randrange(0, MAX_BONUS_MINUTES + 1, BONUS_STEP)
+
+    return random.randint(1, MAX_BONUS_MINUTES)
+
+
+def create_random_user_with_preferences(zosia, id, paid_ratio=0.5, staggered_bonus=False):
     data = {
         'email': f'zosia{id}@example.com',
         'first_name': random.choice(FIRST_NAMES),
@@ -180,10 +190,11 @@ def create_random_user_with_preferences(zosia, id):
 
     phone_number = f'+48 {random.randint(100, 999)} {random.randint(100, 999)} ' \
                    f'{random.randint(100, 999)}'
-    transport = random.choice(Transport.objects.find_with_free_places(zosia)) if random_bool() else None
+    transports = Transport.objects.find_with_free_places(zosia)
+    transport = random.choice(transports) if transports and random_bool() else None
 
-    payment_acc = random_bool()
-    bonus = random.randint(1, MAX_BONUS_MINUTES) if payment_acc else 0
+    payment_acc = random.random() < paid_ratio
+    bonus = random_bonus(staggered_bonus) if payment_acc else 0
 
     is_student = id % 2 == 1
     student_number = random.randint(100000, 999999) if is_student else ''
@@ -234,8 +245,20 @@ def create_room(number):
 class Command(BaseCommand):
     help = 'Create custom data in database'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=7,
+                            help='Number of random users with preferences')
+        parser.add_argument('--rooms', type=int, default=None,
+                            help='Number of rooms (random from 10 to 25 by default)')
+        parser.add_argument('--paid-ratio', type=float, default=0.5,
+                            help='Fraction of users with accepted payment')
+        parser.add_argument('--staggered-bonus', action='store_true',
+                            help='Give users bonus minutes in multiples of bonus step')
+        parser.add_argument('--no-input', action='store_false', dest='interactive',
+                            help='Do not ask for confirmation when active ZOSIA already exists')
+
     def handle(self, *args, **kwargs):
-        if Zosia.objects.filter(active=True).count() > 0:
+        if kwargs['interactive'] and Zosia.objects.filter(active=True).count() > 0:
             self.stdout.write('\033[1;91mThere is already active ZOSIA in database.'
                               '\033[0m Do you want to create data anyway? [y/n]')
             choice = input().lower()
@@ -261,9 +284,11 @@ class Command(BaseCommand):
         create_contact_to_organizer(zosia, sample_organizer_user)
         self.stdout.write('Contact to sample organizer created')
 
-        user_num = 7
+        user_num = kwargs['users']
         for i in range(1, user_num + 1):
-            user_with_prefs = create_random_user_with_preferences(zosia, i)
+            user_with_prefs = create_random_user_with_preferences(
+                zosia, i, paid_ratio=kwargs['paid_ratio'],
+                staggered_bonus=kwargs['staggered_bonus'])
             self.stdout.write(f"Created random user #{i}")
             all_users.append(user_with_prefs)
 
@@ -280,7 +305,7 @@ class Command(BaseCommand):
             create_question()
             self.stdout.write(f"Created question #{i}")
 
-        room_num = random.randint(10, 25)
+        room_num = kwargs['rooms'] or random.randint(10, 25)
         for i in range(1, room_num + 1):
             create_room(i)
             self.stdout.write(f"Created room #{i}")
@@ -1,6 +1,7 @@
 from datetime import timedelta
 import re
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
@@ -8,6 +9,7 @@ from django.db.models import Count, F, Q
 from django.http import Http404
 from django.utils.translation import ugettext_lazy as _
 
+from utils.cache import get_cached, invalidate
 from utils.constants import DELIMITER, MAX_BONUS_MINUTES, RoomingStatus, UserInternals
 from utils.time_manager import format_in_zone, now
 
@@ -22,10 +24,31 @@ class Place(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        invalidate_active_zosia()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        invalidate_active_zosia()
+
+        return result
+
+
+ACTIVE_ZOSIA_CACHE_KEY = "conferences.active_zosia"
+
+
+def invalidate_active_zosia():
+    invalidate(ACTIVE_ZOSIA_CACHE_KEY)
+
 
 class ZosiaManager(models.Manager):
     def find_active(self):
-        return self.filter(active=True).first()
+        """Returns the active conference. Once it's cached, it's read from memory of the process
+        without queries until any process writes to the shared cache."""
+        return get_cached(ACTIVE_ZOSIA_CACHE_KEY,
+                          lambda: self.select_related("place").filter(active=True).first(),
+                          settings.ACTIVE_ZOSIA_CACHE_TIMEOUT)
 
     def find_active_or_404(self):
         zosia = self.find_active()
@@ -175,6 +198,16 @@ class Zosia(models.Model):
     def __str__(self):
         return f'Zosia {self.start_date.year}'
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        invalidate_active_zosia()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        invalidate_active_zosia()
+
+        return result
+
     def user_registration_start(self, user):
         if user.is_authenticated \
                 and self.early_registration_start is not None \
@@ -212,11 +245,12 @@ class Zosia(models.Model):
         return self.get_rooming_status(user_prefs, time) == RoomingStatus.ROOMING_PROGRESS
 
     def get_rooming_status(self, user_prefs, time=None):
+        return self.get_rooming_status_from(user_prefs.rooming_start_time, time)
+
+    def get_rooming_status_from(self, user_start_time, time=None):
         if time is None:
             time = now()
 
-        user_start_time = user_prefs.rooming_start_time
-
         if user_start_time is None:
             return RoomingStatus.ROOMING_UNAVAILABLE
 
@@ -0,0 +1,51 @@
+from django.conf import settings
+from django.db.models import Count, Q
+
+from conferences.models import Transport
+from users.models import User, UserPreferences
+from utils.cache import get_cached
+
+
+def statistics_cache_key(zosia):
+    return f"conferences.statistics.{zosia.pk}"
+
+
+def get_statistics(zosia):
+    """Returns numbers shown on the statistics dashboard, cached for a short time, as they
+    depend on almost every change of registrations."""
+    return get_cached(statistics_cache_key(zosia), lambda: compute_statistics(zosia),
+                      settings.STATISTICS_CACHE_TIMEOUT)
+
+
+def compute_statistics(zosia):
+    user_prefs = UserPreferences.objects.filter(zosia=zosia)
+    counts = user_prefs.aggregate(
+        registered=Count("pk"),
+        paid=Count("pk", filter=Q(payment_accepted=True)),
+        vegetarians=Count("pk", filter=Q(vegetarian=True)),
+        students=Count("pk", filter=Q(is_student=True)),
+        **{f"discount_round_{round_}": Count("pk", filter=Q(discount_round=round_))
+           for round_ in (1, 2, 3)},
+    )
+
+    return {
+        "users_count": User.objects.count(),
+        **counts,
+        "prices": list(UserPreferences.objects.annotate_price().filter(zosia=zosia)
+                       .values("computed_price").annotate(count=Count("pk"))
+                       .order_by("computed_price").values_list("computed_price", "count")),
+        "transports": _count_passengers(),
+    }
+
+
+def _count_passengers():
+    transports = Transport.objects.annotate(
+        passengers_num=Count("passengers"),
+        paid_passengers_num=Count("passengers", filter=Q(passengers__payment_accepted=True)),
+    ).order_by("departure_time", "pk")
+
+    return [{"name": str(transport),
+             "paid": transport.paid_passengers_num,
+             "not_paid": transport.passengers_num - transport.paid_passengers_num,
+             "free_seats": transport.capacity - transport.passengers_num}
+            for transport in transports]
@@ -1,11 +1,32 @@
+from collections import Counter
 from datetime import timedelta
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.cache.backends.db import DatabaseCache
 from django.core.exceptions import ValidationError
-from django.test import TestCase
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
-from conferences.models import Transport, Zosia
-from utils.test_helpers import create_transport, create_user, create_user_preferences, create_zosia
+from conferences.models import ACTIVE_ZOSIA_CACHE_KEY, Transport, Zosia
+from conferences.statistics import compute_statistics
+from conferences.views import shirt_rows
+from users.models import UserPreferences
+from utils.cache import GENERATION_KEY, RequestCacheMiddleware
+from utils.test_helpers import create_transport, create_user, create_user_preferences, \
+    create_users_in_bulk, create_zosia, login_as_user, production_settings
 from utils.time_manager import now, time_point
 
 User = get_user_model()
@@ -57,6 +78,241 @@ class ZosiaTestCase(TestCase):
         self.assertTrue(result)
 
 
+LOCMEM_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ActiveZosiaCacheTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.active = create_zosia(active=True)
+
+    def tearDown(self):
+        cache.clear()
+        super().tearDown()
+
+    def test_active_zosia_is_cached_with_place(self):
+        Zosia.objects.find_active()
+
+        with self.assertNumQueries(0):
+            zosia = Zosia.objects.find_active()
+            self.assertEqual(zosia.place.name, self.active.place.name)
+
+        self.assertEqual(zosia.pk, self.active.pk)
+
+    def test_cache_is_invalidated_on_save(self):
+        Zosia.objects.find_active()
+
+        self.active.active = False
+        self.active.save()
+
+        self.assertIsNone(Zosia.objects.find_active())
+
+    def test_cache_is_invalidated_on_delete(self):
+        Zosia.objects.find_active()
+
+        self.active.delete()
+
+        self.assertIsNone(Zosia.objects.find_active())
+
+    def test_cache_is_invalidated_on_place_save(self):
+        Zosia.objects.find_active()
+
+        self.active.place.name = "Orle Gniazdo"
+        self.active.place.save()
+
+        self.assertEqual(Zosia.objects.find_active().place.name, "Orle Gniazdo")
+
+
+# Runs code in a separate Python process with given cache settings, like another gunicorn worker
+OTHER_PROCESS_SCRIPT = """
+import json, sys
+import django
+django.setup()
+from django.test.utils import override_settings
+
+with override_settings(CACHES=json.loads(sys.argv[1])):
+    exec(sys.argv[2])
+"""
+
+
+class SharedCacheTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.active = create_zosia(active=True)
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        # Generation is checked on every read, so writes of other processes are seen at once
+        self.caches = {"default": {"BACKEND": "utils.cache.TieredCache",
+                                   "LOCATION": cache_dir,
+                                   "OPTIONS": {"CHECK_INTERVAL": 0, "SHARED": {
+                                       "BACKEND": "django.core.cache.backends.filebased."
+                                                  "FileBasedCache",
+                                       "LOCATION": cache_dir}}}}
+        settings_override = override_settings(CACHES=self.caches)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def run_in_other_process(self, code):
+        result = subprocess.run(
+            [sys.executable, "-c", OTHER_PROCESS_SCRIPT, json.dumps(self.caches), code],
+            env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+            capture_output=True, text=True, check=True)
+
+        return result.stdout.strip()
+
+    def test_value_cached_by_one_process_is_read_by_other(self):
+        Zosia.objects.find_active()
+
+        pk = self.run_in_other_process(
+            "from django.core.cache import cache\n"
+            f"print(cache.get({ACTIVE_ZOSIA_CACHE_KEY!r}).pk)")
+
+        self.assertEqual(pk, str(self.active.pk))
+
+    def test_invalidation_in_other_process_is_seen(self):
+        Zosia.objects.find_active()
+
+        self.run_in_other_process("from conferences.models import invalidate_active_zosia\n"
+                                  "invalidate_active_zosia()")
+
+        with self.assertNumQueries(1):
+            Zosia.objects.find_active()
+
+    def test_production_cache_is_shared_by_all_instances(self):
+        caches, = production_settings("CACHES")
+
+        self.assertEqual(caches["default"]["BACKEND"], "utils.cache.TieredCache")
+        self.assertEqual(caches["default"]["OPTIONS"]["SHARED"]["BACKEND"],
+                         "django.core.cache.backends.db.DatabaseCache")
+
+
+@override_settings(CACHES={"default": settings.SHARED_CACHE})
+class TieredCacheTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        call_command("createcachetable", stdout=io.StringIO())
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+        super().tearDown()
+
+    def test_shared_cache_is_stored_in_database(self):
+        self.assertIsInstance(cache.shared, DatabaseCache)
+
+    def test_warm_reads_do_not_query_database(self):
+        cache.set("key", "value")
+        cache.set_many({"first": 1, "second": 2})
+
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get("key"), "value")
+            self.assertEqual(cache.get_many(["first", "second"]), {"first": 1, "second": 2})
+
+    def test_value_is_read_from_database_once(self):
+        cache.shared.set("key", "value")
+
+        with self.assertNumQueries(1):
+            self.assertEqual(cache.get("key"), "value")
+            self.assertEqual(cache.get("key"), "value")
+
+    def test_copies_are_dropped_after_write_of_other_process(self):
+        cache.set("key", "value")
+        # Another process writes to the shared cache, which changes its generation
+        cache.shared.set("key", "new value")
+        cache.shared.set(GENERATION_KEY, "other")
+
+        self.assertEqual(cache.get("key"), "value")
+
+        cache.seen["checked_at"] = None
+
+        with self.assertNumQueries(2):
+            self.assertEqual(cache.get("key"), "new value")
+
+    def test_missing_value_is_added_without_changing_generation(self):
+        token = cache.shared.get(GENERATION_KEY)
+
+        self.assertEqual(cache.get_or_set("key", "value"), "value")
+
+        self.assertEqual(cache.shared.get(GENERATION_KEY), token)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get_or_set("key", "other"), "value")
+
+
+@override_settings(CACHES={"default": settings.SHARED_CACHE})
+class ActiveZosiaProductionCacheTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        call_command("createcachetable", stdout=io.StringIO())
+        cache.clear()
+        self.active = create_zosia(active=True)
+
+    def tearDown(self):
+        cache.clear()
+        super().tearDown()
+
+    def run_in_request(self, view):
+        return RequestCacheMiddleware(view)(RequestFactory().get("/"))
+
+    def test_warm_active_zosia_is_read_without_queries(self):
+        self.run_in_request(lambda request: Zosia.objects.find_active() and HttpResponse())
+
+        def view(request):
+            with self.assertNumQueries(0):
+                self.assertEqual(Zosia.objects.find_active(), self.active)
+            return HttpResponse()
+
+        self.run_in_request(view)
+
+    def test_active_zosia_is_read_again_after_change(self):
+        Zosia.objects.find_active()
+
+        self.active.active = False
+        self.active.save()
+
+        self.assertIsNone(Zosia.objects.find_active())
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}})
+class ActiveZosiaRequestCacheTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.active = create_zosia(active=True)
+
+    def run_in_request(self, view):
+        return RequestCacheMiddleware(view)(RequestFactory().get("/"))
+
+    def test_active_zosia_is_fetched_once_per_request(self):
+        def view(request):
+            with self.assertNumQueries(1):
+                self.assertEqual(Zosia.objects.find_active(), self.active)
+                self.assertEqual(Zosia.objects.find_active(), self.active)
+            return HttpResponse()
+
+        self.run_in_request(view)
+
+        with self.assertNumQueries(1):
+            self.run_in_request(lambda request: Zosia.objects.find_active() and HttpResponse())
+
+    def test_request_cache_is_invalidated_on_save(self):
+        def view(request):
+            Zosia.objects.find_active()
+            self.active.active = False
+            self.active.save()
+            self.assertIsNone(Zosia.objects.find_active())
+            return HttpResponse()
+
+        self.run_in_request(view)
+
+    def test_nothing_is_cached_outside_of_request(self):
+        Zosia.objects.find_active()
+
+        with self.assertNumQueries(1):
+            Zosia.objects.find_active()
+
+
 class TransportTestCase(TestCase):
     def setUp(self):
         super().setUp()
@@ -104,3 +360,85 @@ class TransportTestCase(TestCase):
         user_prefs = create_user_preferences(self.normal, self.zosia, transport=self.transport3)
         transport = Transport.objects.find_available(self.zosia, passenger=user_prefs)
         self.assertEqual(transport.count(), 2)
+
+
+class ShirtsExportTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.zosia = create_zosia(active=True)
+        staff = create_user(0, is_staff=True)
+        login_as_user(staff, self.client)
+
+        for user, size, type_, paid in [(staff, "XL", "f", True), (create_user(1), "S", "m", True),
+                                         (create_user(2), "S", "m", False)]:
+            create_user_preferences(user, self.zosia, shirt_size=size, shirt_type=type_,
+                                    payment_accepted=paid)
+
+        create_user_preferences(create_user(3), create_zosia(), shirt_size="S", shirt_type="m")
+
+    def test_shirts_are_counted_in_a_single_streamed_query(self):
+        with self.assertNumQueries(1):
+            rows = list(shirt_rows(self.zosia))
+
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(rows[0], ("S", "classic", 2, 1))
+        self.assertEqual(rows[7], ("XL", "female", 1, 1))
+        self.assertEqual(rows[1], ("S", "female", 0, 0))
+
+    def test_staff_downloads_csv_with_shirts(self):
+        response = self.client.get(reverse("export_shirts"))
+
+        self.assertEqual(response["Content-Disposition"], 'attachment; filename="shirts.csv"')
+        content = b"".join(response.streaming_content).decode()
+        self.assertEqual(content.splitlines()[:2], ["Size,Type,Registered,Payed", "S,classic,2,1"])
+
+
+class StatisticsTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.zosia = create_zosia(active=True)
+        self.staff = create_user(0, is_staff=True)
+        self.transport_1 = create_transport(self.zosia, capacity=10)
+        self.transport_2 = create_transport(self.zosia, capacity=5)
+
+    def create_preferences(self, users):
+        for i, user in enumerate(users):
+            create_user_preferences(
+                user, self.zosia, payment_accepted=i % 2 == 0, is_student=i % 3 == 0,
+                vegetarian=i % 4 == 0, discount_round=i % 4,
+                transport=[None, self.transport_1, self.transport_2][i % 3],
+                transport_baggage=i % 5 == 0, accommodation_day_1=i % 2 == 1,
+                dinner_day_1=i % 3 == 1, breakfast_day_2=i % 4 == 1, accommodation_day_2=True)
+
+    def test_statistics_match_registrations(self):
+        self.create_preferences(create_users_in_bulk(30))
+        prefs = UserPreferences.objects.filter(zosia=self.zosia)
+
+        stats = compute_statistics(self.zosia)
+
+        self.assertEqual(stats["users_count"], 31)
+        self.assertEqual(stats["registered"], 30)
+        self.assertEqual(stats["paid"], prefs.filter(payment_accepted=True).count())
+        self.assertEqual(stats["vegetarians"], prefs.filter(vegetarian=True).count())
+        self.assertEqual(stats["students"], prefs.filter(is_student=True).count())
+        self.assertEqual(stats["discount_round_2"], prefs.filter(discount_round=2).count())
+        self.assertEqual(stats["prices"], sorted(Counter(p.price for p in prefs).items()))
+        self.assertEqual(
+            [(t["paid"], t["not_paid"], t["free_seats"]) for t in stats["transports"]],
+            [(t.paid_passengers_count, t.passengers_count - t.paid_passengers_count, t.free_seats)
+             for t in (self.transport_1, self.transport_2)])
+
+    def test_dashboard_queries_do_not_depend_on_registrations(self):
+        login_as_user(self.staff, self.client)
+        users = create_users_in_bulk(55)
+        self.create_preferences(users[:5])
+
+        with CaptureQueriesContext(connection) as few_queries:
+            self.client.get(reverse("statistics"))
+
+        self.create_preferences(users[5:])
+
+        with self.assertNumQueries(len(few_queries)):
+            response = self.client.get(reverse("statistics"))
+
+        self.assertEqual(response.context["registeredUsers"], 55)
@@ -1,23 +1,23 @@
-from collections import Counter
-import csv
 import json
 from urllib.parse import urlencode
 
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
-from django.http import HttpResponse, JsonResponse
+from django.db.models import Count, Q
+from django.http import JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils.translation import ugettext_lazy as _
 from django.views.decorators.http import require_http_methods
 
 from conferences.forms import PlaceForm, TransportForm, ZosiaForm
 from conferences.models import Place, Transport, Zosia
+from conferences.statistics import get_statistics
 from lectures.models import Lecture
 from organizers.models import OrganizerContact
 from sponsors.models import Sponsor
-from users.models import User, UserPreferences
-from utils.constants import SHIRT_SIZE_CHOICES, SHIRT_TYPES_CHOICES
+from users.models import UserPreferences
+from utils.constants import CSV_CHUNK_SIZE, SHIRT_SIZE_CHOICES, SHIRT_TYPES_CHOICES
 from utils.views import csv_response
 
 
@@ -61,27 +61,26 @@ def export_data(request):
     return JsonResponse(data)
 
 
+def shirt_rows(zosia):
+    """Yields numbers of registered and paid participants for every shirt size and type, all
+    counted by a single streamed query."""
+    counts = UserPreferences.objects.filter(zosia=zosia).order_by() \
+        .values_list('shirt_size', 'shirt_type') \
+        .annotate(registered=Count('pk'), paid=Count('pk', filter=Q(payment_accepted=True))) \
+        .iterator(chunk_size=CSV_CHUNK_SIZE)
+    by_shirt = {(size, type_): (registered, paid) for size, type_, registered, paid in counts}
+
+    for size, size_name in SHIRT_SIZE_CHOICES:
+        for type_, type_name in SHIRT_TYPES_CHOICES:
+            yield (size_name, type_name, *by_shirt.get((size, type_), (0, 0)))
+
+
 @staff_member_required()
 @require_http_methods(['GET'])
 def export_shirts(request):
-    zosia = get_object_or_404(Zosia, active=True)
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="shirts.csv"'
-
-    writer = csv.writer(response)
-    writer.writerow(['Size', 'Type', 'Registered', 'Payed'])
-    for shirt_size in SHIRT_SIZE_CHOICES:
-        for shirt_type in SHIRT_TYPES_CHOICES:
-            reg_count = UserPreferences.objects \
-                .filter(zosia=zosia, shirt_size=shirt_size[0], shirt_type=shirt_type[0]) \
-                .count()
-            pay_count = UserPreferences.objects. \
-                filter(zosia=zosia, shirt_size=shirt_size[0], shirt_type=shirt_type[0],
-                       payment_accepted=True) \
-                .count()
-            writer.writerow([shirt_size[1], shirt_type[1], reg_count, pay_count])
-
-    return response
+    zosia = Zosia.objects.find_active_or_404()
+    return csv_response(('Size', 'Type', 'Registered', 'Payed'), shirt_rows(zosia),
+                        filename='shirts')
 
 
 @require_http_methods(['GET'])
@@ -131,7 +130,8 @@ def sign_up_rules_for_invited(request):
 @staff_member_required
 @require_http_methods(['GET'])
 def admin_panel(request):
-    return render(request, 'conferences/admin.html')
+    ctx = {'rooms_events': settings.ROOMS_EVENTS_ENABLED}
+    return render(request, 'conferences/admin.html', ctx)
 
 
 @staff_member_required
@@ -228,10 +228,11 @@ def place_add(request, pk=None):
 @staff_member_required
 @require_http_methods(['GET'])
 def list_csv_transport_by_user(request):
-    prefs = UserPreferences.objects.select_related('user').filter(transport__isnull=False) \
-        .order_by("user__last_name", "user__first_name")
-    data_list = [(str(p.user), str(p.transport), str(p.payment_accepted)) for p in prefs]
-    return csv_response(("User", "Transport", "Paid"), data_list,
+    prefs = UserPreferences.objects.select_related('user', 'transport') \
+        .filter(transport__isnull=False).order_by("user__last_name", "user__first_name") \
+        .iterator(chunk_size=CSV_CHUNK_SIZE)
+    data = ((str(p.user), str(p.transport), str(p.payment_accepted)) for p in prefs)
+    return csv_response(("User", "Transport", "Paid"), data,
                         filename='list_csv_transport_by_user')
 
 
@@ -239,8 +240,8 @@ def list_csv_transport_by_user(request):
 @require_http_methods(['GET'])
 def list_csv_all_users_by_transport(request):
     transport_list = Transport.objects.order_by("departure_time")
-    data_list = [(str(t), t.passengers_to_string()) for t in transport_list]
-    return csv_response(("Transport", "All users"), data_list,
+    data = ((str(t), t.passengers_to_string()) for t in transport_list)
+    return csv_response(("Transport", "All users"), data,
                         filename='list_csv_all_users_by_transport')
 
 
@@ -248,8 +249,8 @@ def list_csv_all_users_by_transport(request):
 @require_http_methods(['GET'])
 def list_csv_paid_users_by_transport(request):
     transport_list = Transport.objects.order_by("departure_time")
-    data_list = [(str(t), t.passengers_to_string(paid=True)) for t in transport_list]
-    return csv_response(("Transport", "Paid users"), data_list,
+    data = ((str(t), t.passengers_to_string(paid=True)) for t in transport_list)
+    return csv_response(("Transport", "Paid users"), data,
                         filename='list_csv_paid_users_by_transport')
 
 
@@ -257,9 +258,9 @@ def list_csv_paid_users_by_transport(request):
 @require_http_methods(['GET'])
 def list_csv_paid_students_by_transport(request):
     transport_list = Transport.objects.order_by("departure_time")
-    data_list = [(str(t), t.passengers_to_string(paid=True, is_student=True))
-                 for t in transport_list]
-    return csv_response(("Transport", "Paid student users"), data_list,
+    data = ((str(t), t.passengers_to_string(paid=True, is_student=True))
+            for t in transport_list)
+    return csv_response(("Transport", "Paid student users"), data,
                         filename='list_csv_paid_student_users_by_transport')
 
 
@@ -267,9 +268,9 @@ def list_csv_paid_students_by_transport(request):
 @require_http_methods(['GET'])
 def list_csv_paid_non_students_by_transport(request):
     transport_list = Transport.objects.order_by("departure_time")
-    data_list = [(str(t), t.passengers_to_string(paid=True, is_student=False))
-                 for t in transport_list]
-    return csv_response(("Transport", "Paid non-student users"), data_list,
+    data = ((str(t), t.passengers_to_string(paid=True, is_student=False))
+            for t in transport_list)
+    return csv_response(("Transport", "Paid non-student users"), data,
                         filename='list_csv_paid_non_student_users_by_transport')
 
 
@@ -277,64 +278,43 @@ def list_csv_paid_non_students_by_transport(request):
 @require_http_methods(['GET'])
 def statistics(request):
     zosia = Zosia.objects.find_active_or_404()
-    user_prefs = UserPreferences.objects.filter(zosia=zosia)
+    stats = get_statistics(zosia)
 
     # data for first chart
-    users_count = User.objects.count()
-    prefs_count = user_prefs.count()
-    paid_count = user_prefs.filter(payment_accepted=True).count()
-
-    users_with_payment = paid_count
-    users_with_prefs_only = prefs_count - paid_count
-    users_without_prefs = users_count - prefs_count
+    users_with_payment = stats['paid']
+    users_with_prefs_only = stats['registered'] - stats['paid']
+    users_without_prefs = stats['users_count'] - stats['registered']
 
     # data for second chart
-    if len(user_prefs):
-        price_items = Counter([t.price for t in user_prefs]).items()
-        price_values, price_counts = zip(*sorted(price_items))
-    else:
-        price_values, price_counts = [], []
+    price_values = [price for price, _count in stats['prices']]
+    price_counts = [count for _price, count in stats['prices']]
 
     # data for transport info chart
-    transport_list = Transport.objects.all()
-    transport_labels = []
-    transport_values = {'paid': [], 'notPaid': [], 'empty': []}
-    for t in transport_list:
-        transport_labels.append(f'{t}')
-        transport_values['paid'].append(t.paid_passengers_count)
-        transport_values['notPaid'].append(t.passengers_count - t.paid_passengers_count)
-        transport_values['empty'].append(t.free_seats)
+    transport_labels = [t['name'] for t in stats['transports']]
+    transport_values = {
+        'paid': [t['paid'] for t in stats['transports']],
+        'notPaid': [t['not_paid'] for t in stats['transports']],
+        'empty': [t['free_seats'] for t in stats['transports']],
+    }
 
     # discount
-    discounts = list(
-        user_prefs.filter(discount_round__gt=0).values_list('discount_round', flat=True))
-
-    # discount_values = {
-    #     "round_1": (discounts.count(1), zosia.first_discount_limit),
-    #     "round_2": (discounts.count(2), zosia.second_discount_limit),
-    #     "round_3": (discounts.count(3), zosia.third_discount_limit)
-    #     }
-
+    taken = [stats[f'discount_round_{x}'] for x in (1, 2, 3)]
     discount_values = {
-        "taken": [discounts.count(x) for x in (1, 2, 3)],
+        "taken": taken,
         "available": [
-            zosia.first_discount_limit-discounts.count(1),
-            zosia.second_discount_limit-discounts.count(2),
-            zosia.third_discount_limit-discounts.count(3)]
+            zosia.first_discount_limit - taken[0],
+            zosia.second_discount_limit - taken[1],
+            zosia.third_discount_limit - taken[2]]
     }
 
-    # other data
-    vegetarians = user_prefs.filter(vegetarian=True).count()
-    students = user_prefs.filter(is_student=True).count()
-
     ctx = {
-        'registeredUsers': prefs_count,
-        'vegetarians': vegetarians,
-        'students': students,
+        'registeredUsers': stats['registered'],
+        'vegetarians': stats['vegetarians'],
+        'students': stats['students'],
         'discountsData': json.dumps(discount_values),
         'userPrefsData': [users_with_payment, users_with_prefs_only, users_without_prefs],
-        'userCostsValues': list(price_values),
-        'userCostsCounts': list(price_counts),
+        'userCostsValues': price_values,
+        'userCostsCounts': price_counts,
         'transportLabels': json.dumps(transport_labels),
         'transportValues': json.dumps(transport_values),
         'numberOfTransport': len(transport_labels)
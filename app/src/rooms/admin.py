@@ -2,5 +2,13 @@ from django.contrib import admin
 
 from rooms.models import Room, UserRoom
 
-admin.site.register(Room)
+
+@admin.register(Room)
+class RoomAdmin(admin.ModelAdmin):
+    def delete_queryset(self, request, queryset):
+        # Rooms are deleted one by one, so each of them leaves a tombstone for the changes feed
+        for room in queryset:
+            room.delete()
+
+
 admin.site.register(UserRoom)
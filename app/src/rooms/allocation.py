@@ -0,0 +1,344 @@
+from collections import Counter, defaultdict
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils.translation import ugettext_lazy as _
+
+from rooms.events import publish_room_event
+from rooms.models import Room, UserRoom
+from users.models import User, UserPreferences
+from utils.constants import RoomEventType
+from utils.time_manager import now
+
+# Costs of a solution. Splitting an organization always costs more than anything gained from it.
+SPLIT_COST = 10
+OPENED_ROOM_COST = 2
+MIXED_DAYS_COST = 1
+
+# Local search stops after this many passes even if it still improves the solution
+MAX_PASSES = 10
+
+ACCOMMODATION_DAYS = ("accommodation_day_1", "accommodation_day_2", "accommodation_day_3")
+
+
+class RoomAllocator:
+    """Assigns participants to free places in rooms, keeping members of the same organization
+    and participants staying on the same days together, and filling partially occupied rooms
+    before empty ones.
+
+    Participants are placed greedily first, organizations from the largest, then moves and
+    swaps of placed participants are tried as long as they lower the total cost. Members already
+    in rooms are never moved.
+
+    Rooms are dicts with `pk`, `free` places and `members`, participants dicts with `pk`,
+    `organization` and `days`. Members of rooms are (organization, days) pairs.
+    """
+
+    def __init__(self, rooms, participants):
+        self.participants = {participant["pk"]: participant for participant in participants}
+        self.free = {room["pk"]: room["free"] for room in rooms}
+        self.occupied = {room["pk"]: room.get("occupied", len(room["members"])) for room in rooms}
+        self.was_empty = {room["pk"] for room in rooms if not self.occupied[room["pk"]]}
+        self.organization_rooms = defaultdict(Counter)
+        self.room_days = defaultdict(Counter)
+        self.placed = defaultdict(set)
+        self.assignment = {}
+        self.unplaced = []
+
+        for room in rooms:
+            for organization, days in room["members"]:
+                self._count(room["pk"], organization, days, 1)
+
+    def solve(self):
+        """Returns assignment of participants to rooms and participants without a place."""
+        self._place_greedily()
+
+        for _pass in range(MAX_PASSES):
+            if not self._improve():
+                break
+
+        return self.assignment, self.unplaced
+
+    def _count(self, room, organization, days, change):
+        if organization is not None:
+            self.organization_rooms[organization][room] += change
+
+        self.room_days[room][days] += change
+
+    def _add(self, pk, room):
+        participant = self.participants[pk]
+        self._count(room, participant["organization"], participant["days"], 1)
+        self.free[room] -= 1
+        self.occupied[room] += 1
+        self.placed[room].add(pk)
+        self.assignment[pk] = room
+
+    def _remove(self, pk):
+        participant = self.participants[pk]
+        room = self.assignment.pop(pk)
+        self._count(room, participant["organization"], participant["days"], -1)
+        self.free[room] += 1
+        self.occupied[room] -= 1
+        self.placed[room].discard(pk)
+
+        return room
+
+    def _cost(self, rooms, organizations):
+        """Returns part of the total cost depending on given rooms and organizations."""
+        cost = 0
+
+        for organization in organizations:
+            if organization is not None:
+                rooms_count = sum(1 for count in self.organization_rooms[organization].values()
+                                  if count)
+                cost += SPLIT_COST * max(0, rooms_count - 1)
+
+        for room in rooms:
+            if self.occupied[room]:
+                days_count = sum(1 for count in self.room_days[room].values() if count)
+                cost += MIXED_DAYS_COST * (days_count - 1)
+                cost += OPENED_ROOM_COST * (room in self.was_empty)
+
+        return cost
+
+    def _pick_room(self, group):
+        organization, days = group[0]["organization"], group[0]["days"]
+        candidates = [room for room, free in self.free.items() if free > 0]
+
+        if not candidates:
+            return None
+
+        fitting = [room for room in candidates if self.free[room] >= len(group)]
+
+        if not fitting:
+            # Group is split anyway, so the fewest rooms are used
+            return max(candidates, key=lambda room: (self.free[room], -room))
+
+        return min(fitting, key=lambda room: (
+            -self.organization_rooms[organization][room] if organization is not None else 0,
+            -self.room_days[room][days],
+            not self.occupied[room],
+            self.free[room],
+            room,
+        ))
+
+    def _place_greedily(self):
+        groups = defaultdict(list)
+
+        for participant in self.participants.values():
+            groups[participant["organization"]].append(participant)
+
+        ordered = sorted((group for organization, group in groups.items()
+                          if organization is not None), key=lambda group: -len(group))
+        ordered.extend([participant] for participant in groups.get(None, []))
+
+        for group in ordered:
+            group = sorted(group, key=lambda participant: participant["days"])
+
+            while group:
+                room = self._pick_room(group)
+
+                if room is None:
+                    self.unplaced.extend(participant["pk"] for participant in group)
+                    break
+
+                placed, group = group[:self.free[room]], group[self.free[room]:]
+
+                for participant in placed:
+                    self._add(participant["pk"], room)
+
+    def _try(self, change, undo, rooms, organizations):
+        before = self._cost(rooms, organizations)
+        change()
+
+        if self._cost(rooms, organizations) < before:
+            return True
+
+        undo()
+        return False
+
+    def _move(self, pk, room):
+        previous = self.assignment[pk]
+
+        def move(target):
+            self._remove(pk)
+            self._add(pk, target)
+
+        return self._try(lambda: move(room), lambda: move(previous), (previous, room),
+                         (self.participants[pk]["organization"],))
+
+    def _swap(self, pk, other):
+        def swap():
+            room, other_room = self._remove(pk), self._remove(other)
+            self._add(pk, other_room)
+            self._add(other, room)
+
+        organizations = (self.participants[pk]["organization"],
+                         self.participants[other]["organization"])
+
+        return self._try(swap, swap, (self.assignment[pk], self.assignment[other]),
+                         organizations)
+
+    def _improve(self):
+        improved = False
+
+        for pk in sorted(self.assignment):
+            for room in sorted(self._better_rooms(pk)):
+                if self.free[room] and self._move(pk, room):
+                    improved = True
+                    break
+
+                if any(self._swap(pk, other) for other in sorted(self.placed[room])
+                       if self._worth_swapping(pk, other)):
+                    improved = True
+                    break
+
+        return improved
+
+    def _better_rooms(self, pk):
+        """Returns rooms where moving the participant could lower the cost: rooms of their
+        organization if it's split, rooms with their stay if their room has mixed stays and rooms
+        with free places if their room was opened for new participants."""
+        participant = self.participants[pk]
+        current = self.assignment[pk]
+        organization_rooms = {room for room, count in
+                              self.organization_rooms[participant["organization"]].items()
+                              if count} if participant["organization"] is not None else set()
+        rooms = set()
+
+        if len(organization_rooms) > 1:
+            rooms.update(organization_rooms)
+
+        if sum(1 for count in self.room_days[current].values() if count) > 1:
+            rooms.update(room for room, days in self.room_days.items()
+                         if days[participant["days"]])
+
+        if current in self.was_empty and self.free[current]:
+            rooms.update(room for room, free in self.free.items() if free)
+
+        rooms.discard(current)
+
+        return rooms
+
+    def _worth_swapping(self, pk, other):
+        """Checks whether either of the participants has the organization or the stay of
+        roommates of the other one, so swapping them could lower the cost."""
+        participant, other_participant = self.participants[pk], self.participants[other]
+        room, other_room = self.assignment[pk], self.assignment[other]
+
+        def joins(joining, left, room):
+            organization = joining["organization"]
+
+            return organization is not None and organization != left["organization"] and \
+                self.organization_rooms[organization][room] > 0 or \
+                joining["days"] != left["days"] and self.room_days[room][joining["days"]] > 0
+
+        return joins(participant, other_participant, other_room) or \
+            joins(other_participant, participant, room)
+
+
+def allocation_input(zosia):
+    """Returns free rooms and paid participants of zosia with accommodation who have no room,
+    in the form accepted by `RoomAllocator`, with names for the preview."""
+    has_accommodation = Q()
+
+    for day in ACCOMMODATION_DAYS:
+        has_accommodation |= Q(**{day: True})
+
+    participants = [
+        {"pk": pk, "name": f"{first_name} {last_name}", "organization": organization,
+         "days": tuple(days)}
+        for pk, first_name, last_name, organization, *days in
+        UserPreferences.objects.filter(has_accommodation, zosia=zosia, payment_accepted=True,
+                                       user__userroom__isnull=True)
+        .order_by("user__last_name", "user__first_name")
+        .values_list("user_id", "user__first_name", "user__last_name", "organization_id",
+                     *ACCOMMODATION_DAYS)
+    ]
+    # Active locks are respected, rooms stay closed for participants who locked them
+    rooms = {
+        pk: {"pk": pk, "name": name, "free": free, "occupied": occupied, "members": []}
+        for pk, name, free, occupied in
+        Room.objects.all_visible().filter(Q(lock__isnull=True) | Q(lock__expiration_date__lt=now()))
+        .annotate(free=F("available_beds_single") + 2 * F("available_beds_double") -
+                  F("members_count"))
+        .filter(free__gt=0).values_list("pk", "name", "free", "members_count")
+    }
+    members = UserPreferences.objects.filter(zosia=zosia, user__userroom__room__in=rooms.keys()) \
+        .values_list("user__userroom__room_id", "organization_id", *ACCOMMODATION_DAYS)
+
+    for room, organization, *days in members:
+        rooms[room]["members"].append((organization, tuple(days)))
+
+    return list(rooms.values()), participants
+
+
+def make_allocation(zosia):
+    """Returns allocation of participants of zosia without rooms to free places for preview."""
+    rooms, participants = allocation_input(zosia)
+    assignment, unplaced = RoomAllocator(rooms, participants).solve()
+    names = {participant["pk"]: participant["name"] for participant in participants}
+    joining = defaultdict(list)
+
+    for pk, room in assignment.items():
+        joining[room].append(names[pk])
+
+    return {
+        "assignment": assignment,
+        "rooms": sorted(({"name": room["name"], "occupied": room["occupied"],
+                          "joining": sorted(joining[room["pk"]])}
+                         for room in rooms if joining[room["pk"]]),
+                        key=lambda room: Room.name_to_key_orderable(Room(name=room["name"]))),
+        "unplaced": sorted(names[pk] for pk in unplaced),
+    }
+
+
+@transaction.atomic
+def apply_allocation(zosia, assignment):
+    """Adds users to rooms given by assignment at once. Fails without changing anything if any
+    of the users has a room already or no accepted payment for zosia, or any room lacks free
+    places, is hidden or is locked. All of them are checked again under locks, as they could
+    have changed since the preview."""
+    # Users first and rooms after, in the same order as `Room.join`, so they never deadlock
+    list(User.objects.select_for_update().filter(pk__in=assignment.keys()).order_by("pk")
+         .values_list("pk", flat=True))
+
+    if UserRoom.objects.filter(user__in=assignment.keys()).exists():
+        raise ValidationError(_("Some participants have joined rooms since the preview"),
+                              code="invalid")
+
+    # Locked, so payments aren't withdrawn until the participants join rooms
+    paid = set(UserPreferences.objects.select_for_update()
+               .filter(zosia=zosia, user__in=assignment.keys(), payment_accepted=True)
+               .values_list("user_id", flat=True))
+
+    if paid != assignment.keys():
+        raise ValidationError(_("Some participants have no accepted payment"), code="invalid")
+
+    joining = Counter(assignment.values())
+    Room.objects.lock(*joining)
+    rooms = Room.objects.select_related("lock").in_bulk(joining.keys())
+
+    for pk, count in joining.items():
+        if pk not in rooms or rooms[pk].members_count + count > rooms[pk].capacity:
+            raise ValidationError(_("Room %(room)s has not enough free places"), code="invalid",
+                                  params={"room": rooms[pk] if pk in rooms else pk})
+
+        if rooms[pk].hidden:
+            raise ValidationError(_("Room %(room)s is hidden"), code="invalid",
+                                  params={"room": rooms[pk]})
+
+        if rooms[pk].is_locked:
+            raise ValidationError(_("Room %(room)s is locked"), code="invalid",
+                                  params={"room": rooms[pk]})
+
+    UserRoom.objects.bulk_create(UserRoom(user_id=user, room_id=room)
+                                 for user, room in assignment.items())
+
+    for room in rooms.values():
+        room.members_count = F("members_count") + joining[room.pk]
+        room.save()
+        publish_room_event(RoomEventType.JOINED, room)
+
+    return len(assignment)
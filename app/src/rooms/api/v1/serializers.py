@@ -1,8 +1,7 @@
 # -*- coding: utf-8 -*-
-from django.utils.translation import ugettext_lazy as _
 from rest_framework import serializers
 
-from rooms.models import Room, RoomLock, UserRoom
+from rooms.models import MAX_BEDS, Room, RoomLock, UserRoom, validate_beds
 from users.api.serializers import UserDataSerializer
 from users.models import User
 from utils.time_manager import parse_timezone
@@ -52,11 +51,10 @@ class RoomLockWithPasswordSerializer(serializers.ModelSerializer):
 
 
 class RoomSerializer(serializers.ModelSerializer):
-    # Accepted beds number range is from 0 to 42. You don't expect 43 beds in one room, do you?
-    beds_single = serializers.IntegerField(min_value=0, max_value=42)
-    beds_double = serializers.IntegerField(min_value=0, max_value=42)
-    available_beds_single = serializers.IntegerField(min_value=0, max_value=42)
-    available_beds_double = serializers.IntegerField(min_value=0, max_value=42)
+    beds_single = serializers.IntegerField(min_value=0, max_value=MAX_BEDS)
+    beds_double = serializers.IntegerField(min_value=0, max_value=MAX_BEDS)
+    available_beds_single = serializers.IntegerField(min_value=0, max_value=MAX_BEDS)
+    available_beds_double = serializers.IntegerField(min_value=0, max_value=MAX_BEDS)
     lock = RoomLockSerializer(read_only=True)
     members = UserInRoomSerializer(source="userroom_set", read_only=True, many=True)
 
@@ -69,39 +67,12 @@ class RoomSerializer(serializers.ModelSerializer):
     def validate(self, data):
         super().validate(data)
 
-        beds_single_data = data.get("beds_single",
-                                    0 if self.instance is None else self.instance.beds_single)
-        beds_double_data = data.get("beds_double",
-                                    0 if self.instance is None else self.instance.beds_double)
-        available_beds_single_data = data.get("available_beds_single",
-                                              0 if self.instance is None
-                                              else self.instance.available_beds_single)
-        available_beds_double_data = data.get("available_beds_double",
-                                              0 if self.instance is None
-                                              else self.instance.available_beds_double)
-
-        if available_beds_single_data > beds_single_data + beds_double_data:
-            raise serializers.ValidationError(
-                    _("Available single beds cannot exceed real single beds plus double beds"),
-                    code='invalid'
-            )
-
-        double_as_single = max(0, available_beds_single_data - beds_single_data)
-
-        if available_beds_double_data > beds_double_data - double_as_single:
-            raise serializers.ValidationError(_(
-                    "Available double beds cannot exceed real double beds minus double-as-single beds"),
-                    code='invalid'
-            )
-
-        available_members = available_beds_single_data + 2 * available_beds_double_data
-        members_count = 0 if self.instance is None else len(self.instance.members.all())
-
-        if available_members < members_count:
-            raise serializers.ValidationError(
-                    _("Available beds must exceed already joined members"),
-                    code='invalid'
-            )
+        def get(field):
+            return data.get(field, 0 if self.instance is None else getattr(self.instance, field))
+
+        validate_beds(get("beds_single"), get("beds_double"), get("available_beds_single"),
+                      get("available_beds_double"),
+                      0 if self.instance is None else self.instance.members_count)
 
         return data
 
@@ -4,7 +4,8 @@ from rest_framework import status
 from rest_framework.reverse import reverse
 from rest_framework.test import APITestCase
 
-from rooms.test_helpers import RoomAssertions, create_room
+from rooms.test_helpers import RoomAssertions, create_locked_rooms_with_members, \
+    create_room
 from utils.test_helpers import create_user, create_user_preferences, create_zosia
 from utils.time_manager import timedelta_since_now
 
@@ -167,6 +168,38 @@ class RoomListAPITestCase(RoomsAPITestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
 
+class RoomListQueriesAPITestCase(RoomsAPITestCase):
+    # Rooms with their locks and lock owners, room members, users of room members
+    QUERIES_COUNT = 3
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse("rooms_api_list")
+
+    def _test_rooms_list_queries(self, rooms_count, user):
+        create_locked_rooms_with_members(rooms_count)
+        self.client.force_authenticate(user=user)
+
+        with self.assertNumQueries(self.QUERIES_COUNT):
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len([room for room in response.data if room["lock"] and room["members"]]),
+                         rooms_count)
+
+    def test_user_gets_10_rooms_with_constant_queries(self):
+        self._test_rooms_list_queries(10, self.normal_1)
+
+    def test_user_gets_100_rooms_with_constant_queries(self):
+        self._test_rooms_list_queries(100, self.normal_1)
+
+    def test_user_gets_1000_rooms_with_constant_queries(self):
+        self._test_rooms_list_queries(1000, self.normal_1)
+
+    def test_staff_gets_1000_rooms_with_constant_queries(self):
+        self._test_rooms_list_queries(1000, self.staff_1)
+
+
 class RoomDetailAPITestCase(RoomsAPITestCase):
     def setUp(self):
         super().setUp()
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from django.core import exceptions
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.utils.translation import ugettext_lazy as _
 from rest_framework import status
@@ -21,8 +22,12 @@ from utils.constants import RoomingStatus
 def _check_rooming(user, sender):
     if not sender.is_staff:
         zosia = Zosia.objects.find_active_or_404()
-        user_prefs = get_object_or_404(UserPreferences, zosia=zosia, user=user)
-        rooming_status = zosia.get_rooming_status(user_prefs)
+        rooming_schedule = UserPreferences.objects.rooming_schedule(zosia)
+
+        if user.pk not in rooming_schedule:
+            raise Http404("User is not registered for the conference")
+
+        rooming_status = zosia.get_rooming_status_from(rooming_schedule[user.pk])
 
         if rooming_status == RoomingStatus.BEFORE_ROOMING:
             raise exceptions.ValidationError(_("Rooming for user has not started yet."),
@@ -42,21 +47,22 @@ class RoomViewSet(ModelViewSet):
     def get_queryset(self):
         sender = self.request.user
 
-        return Room.objects.all() if sender.is_staff else Room.objects.all_visible()
+        rooms = Room.objects.all() if sender.is_staff else Room.objects.all_visible()
+
+        # Fetch locks and members of all rooms at once instead of querying them room by room
+        return rooms.select_related("lock__user").prefetch_related("userroom_set__user")
 
     @action(detail=True, methods=["POST"])
     def hide(self, request, pk):
         room = self.get_object()
-        room.hidden = True
-        room.save()
+        room.hide()
 
         return Response(self.get_serializer(room).data, status=status.HTTP_200_OK)
 
     @action(detail=True, methods=["POST"])
     def unhide(self, request, pk):
         room = self.get_object()
-        room.hidden = False
-        room.save()
+        room.unhide()
 
         return Response(self.get_serializer(room).data, status=status.HTTP_200_OK)
 
@@ -151,6 +157,6 @@ def unlock(request, pk):
 
 
 class RoomMembersViewSet(ReadOnlyModelViewSet):
-    queryset = UserRoom.objects.all()
+    queryset = UserRoom.objects.select_related("room", "user")
     serializer_class = RoomMembersSerializer
     permission_classes = [IsAdminUser]
@@ -1,11 +1,27 @@
 # -*- coding: utf-8 -*-
-
+import gzip
+import json
+import time
+from unittest import skipUnless
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
 from rest_framework.reverse import reverse
 from rest_framework.test import APITestCase
 
-from rooms.test_helpers import RoomAssertions, create_room
-from utils.test_helpers import create_user, create_user_preferences, create_zosia
+from rooms.api.v2.serializers import RoomSerializer
+from rooms.models import Room
+from rooms.test_helpers import RoomAssertions, create_locked_rooms_with_members, \
+    create_room
+from utils.api import CompactJSONRenderer, EncodedJSON, EncodedJSONList
+from utils.compression import brotli
+from utils.test_helpers import create_user, create_user_preferences, create_zosia, \
+    production_settings, report_benchmark
 from utils.time_manager import timedelta_since_now
 
 room_assertions = RoomAssertions()
@@ -185,6 +201,184 @@ class RoomListAPITestCase(RoomsAPITestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
 
+class RoomListQueriesAPITestCase(RoomsAPITestCase):
+    # Rooming version, versions of rooms, rooms with their locks and lock owners, room members,
+    # users of room members
+    QUERIES_COUNT = 5
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse("rooms_api2_list")
+
+    def _test_rooms_list_queries(self, rooms_count, user):
+        create_locked_rooms_with_members(rooms_count)
+        self.client.force_authenticate(user=user)
+
+        with self.assertNumQueries(self.QUERIES_COUNT):
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len([room for room in response.data if room["lock"] and room["members"]]),
+                         rooms_count)
+
+    def test_user_gets_10_rooms_with_constant_queries(self):
+        self._test_rooms_list_queries(10, self.normal_1)
+
+    def test_user_gets_100_rooms_with_constant_queries(self):
+        self._test_rooms_list_queries(100, self.normal_1)
+
+    def test_user_gets_1000_rooms_with_constant_queries(self):
+        self._test_rooms_list_queries(1000, self.normal_1)
+
+    def test_staff_gets_1000_rooms_with_constant_queries(self):
+        self._test_rooms_list_queries(1000, self.staff_1)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class RoomListCachedJSONAPITestCase(RoomsAPITestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.url = reverse("rooms_api2_list")
+
+    def tearDown(self):
+        cache.clear()
+        super().tearDown()
+
+    def test_unchanged_rooms_are_not_read_again(self):
+        create_locked_rooms_with_members(100)
+        self.client.force_authenticate(user=self.normal_1)
+        rooms = self.client.get(self.url).json()
+
+        # Rooming version and versions of rooms
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.json(), rooms)
+
+    def test_changed_room_is_serialized_again(self):
+        self.client.force_authenticate(user=self.normal_1)
+        self.client.get(self.url)
+        self.room_2.join(self.normal_2)
+
+        response = self.client.get(self.url)
+
+        room_2 = next(room for room in response.json() if room["id"] == self.room_2.pk)
+        self.assertEqual([member["user"]["id"] for member in room_2["members"]],
+                         [self.normal_2.pk])
+
+    def test_lock_password_is_not_shared_with_other_users(self):
+        self.room_2.join(self.normal_1)
+        self.room_2.set_lock(self.normal_1)
+        self.client.force_authenticate(user=self.normal_1)
+        self.client.get(self.url)
+        self.client.force_authenticate(user=self.normal_2)
+
+        response = self.client.get(self.url)
+
+        room_2 = next(room for room in response.json() if room["id"] == self.room_2.pk)
+        self.assertIsNone(room_2["lock"]["password"])
+
+        self.client.force_authenticate(user=self.normal_1)
+        response = self.client.get(self.url)
+
+        room_2 = next(room for room in response.json() if room["id"] == self.room_2.pk)
+        self.assertEqual(room_2["lock"]["password"], self.room_2.lock.password)
+
+
+class RoomListCompressionAPITestCase(RoomsAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = reverse("rooms_api2_list")
+        create_locked_rooms_with_members(20)
+        self.client.force_authenticate(user=self.normal_1)
+
+    def test_large_response_is_gzipped_for_client_accepting_gzip(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING="gzip, deflate")
+
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response["Vary"])
+        self.assertEqual(len(json.loads(gzip.decompress(response.content))), 22)
+
+    @skipUnless(brotli, "brotli is not installed")
+    def test_large_response_is_compressed_with_brotli_if_accepted(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING="gzip, br")
+
+        self.assertEqual(response["Content-Encoding"], "br")
+        self.assertEqual(len(json.loads(brotli.decompress(response.content))), 22)
+
+    def test_response_is_not_compressed_for_other_clients(self):
+        response = self.client.get(self.url)
+
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(len(response.json()), 22)
+
+    @override_settings(COMPRESSION_MIN_SIZE=10 ** 6)
+    def test_small_response_is_not_compressed(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING="gzip")
+
+        self.assertFalse(response.has_header("Content-Encoding"))
+
+    def test_compressed_response_is_not_modified_for_its_etag(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING="gzip")
+
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING="gzip",
+                                   HTTP_IF_NONE_MATCH=response["ETag"])
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+class RoomListRenderingBenchmarkTestCase(RoomsAPITestCase):
+    ROOMS_COUNT = 100
+    RENDERS = 50
+
+    def setUp(self):
+        super().setUp()
+        create_locked_rooms_with_members(self.ROOMS_COUNT)
+        self.rooms = list(Room.objects.select_related("lock__user")
+                          .prefetch_related("userroom_set__user"))
+        self.context = {"request": None}
+
+    def render(self, get_data, renderer):
+        start = time.process_time()
+
+        for _ in range(self.RENDERS):
+            content = renderer.render(get_data())
+
+        return content, (time.process_time() - start) / self.RENDERS
+
+    def test_compact_rendering_of_100_rooms(self):
+        stock, stock_time = self.render(
+            lambda: RoomSerializer(self.rooms, many=True, context=self.context).data,
+            JSONRenderer())
+        encoded = EncodedJSONList(EncodedJSON(RoomSerializer(room, context=self.context).data)
+                                  for room in self.rooms)
+        compact, compact_time = self.render(lambda: encoded, CompactJSONRenderer())
+        sizes = {"plain": len(compact), "gzip": len(gzip.compress(compact))}
+
+        if brotli:
+            sizes["brotli"] = len(brotli.compress(compact,
+                                                  quality=settings.COMPRESSION_BROTLI_QUALITY))
+
+        report_benchmark(self, f"serializing and rendering {stock_time * 1000:.1f} ms, "
+                               f"rendering cached JSON {compact_time * 1000:.2f} ms, "
+                               f"bytes {len(stock)} with stock renderer, "
+                               + ", ".join(f"{size} {name}" for name, size in sizes.items()))
+        self.assertEqual(json.loads(compact), json.loads(stock))
+        self.assertLess(compact_time, stock_time)
+        self.assertLess(sizes["gzip"], sizes["plain"] / 4)
+
+
+class ProductionRenderersTestCase(SimpleTestCase):
+    def test_production_renders_compact_json_with_common_settings(self):
+        rest_framework, = production_settings("REST_FRAMEWORK")
+
+        self.assertEqual(rest_framework["DEFAULT_RENDERER_CLASSES"],
+                         ["utils.api.CompactJSONRenderer"])
+        self.assertEqual(rest_framework["DEFAULT_PERMISSION_CLASSES"],
+                         settings.REST_FRAMEWORK["DEFAULT_PERMISSION_CLASSES"])
+
+
 class RoomDetailAPITestCase(RoomsAPITestCase):
     def setUp(self):
         super().setUp()
@@ -623,6 +817,40 @@ class RoomMemberCreateAPITestCase(RoomsAPITestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
 
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class RoomMemberCreateQueriesAPITestCase(RoomsAPITestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.url = reverse("rooms_api2_member", kwargs={"pk": self.room_2.pk})
+        create_user_preferences(self.normal_1, self.zosia, payment_accepted=True)
+        self.client.force_authenticate(user=self.normal_1)
+
+    def tearDown(self):
+        cache.clear()
+        super().tearDown()
+
+    def join(self):
+        self.room_2.leave(self.normal_1)
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(self.url, data={"user": self.normal_1.pk}, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        return context.captured_queries
+
+    def test_joining_with_warm_cache_does_not_query_zosia_or_preferences(self):
+        cold_queries = self.join()
+        warm_queries = self.join()
+
+        report_benchmark(self, f"{len(cold_queries)} queries with empty cache, "
+                               f"{len(warm_queries)} queries with warm cache")
+        self.assertEqual(len(warm_queries), len(cold_queries) - 2)
+        self.assertFalse(any("conferences_zosia" in query["sql"] for query in warm_queries))
+        self.assertFalse(any("users_userpreferences" in query["sql"] for query in warm_queries))
+
+
 class RoomMemberDestroyAPITestCase(RoomsAPITestCase):
     def setUp(self):
         super().setUp()
@@ -1009,3 +1237,303 @@ class RoomMineAPITestCase(RoomsAPITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data["name"], "333")
+
+
+class RoomConditionalAPITestCase(RoomsAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.list_url = reverse("rooms_api2_list")
+        self.detail_url = reverse("rooms_api2_detail", kwargs={"pk": self.room_1.pk})
+        self.mine_url = reverse("rooms_api2_mine")
+        self.client.force_authenticate(user=self.normal_1)
+
+    def test_list_is_not_modified_until_rooms_change(self):
+        etag = self.client.get(self.list_url)["ETag"]
+
+        # Only the rooming version is read, rooms are neither fetched nor serialized
+        with self.assertNumQueries(1):
+            response = self.client.get(self.list_url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(response.content, b"")
+
+        self.room_2.join(self.normal_2)
+        response = self.client.get(self.list_url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_list_is_modified_after_room_is_deleted(self):
+        etag = self.client.get(self.list_url)["ETag"]
+
+        self.room_2.delete()
+        response = self.client.get(self.list_url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+
+    def test_list_tag_differs_between_users(self):
+        etag = self.client.get(self.list_url)["ETag"]
+        self.client.force_authenticate(user=self.normal_2)
+
+        response = self.client.get(self.list_url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_room_is_not_modified_by_changes_of_other_rooms(self):
+        etag = self.client.get(self.detail_url)["ETag"]
+
+        self.room_2.join(self.normal_2)
+        response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.room_1.join(self.normal_2)
+        response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["members"]), 1)
+
+    def test_own_room_is_not_modified_until_user_leaves(self):
+        self.room_1.join(self.normal_1)
+        etag = self.client.get(self.mine_url)["ETag"]
+
+        response = self.client.get(self.mine_url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.room_1.leave(self.normal_1)
+        response = self.client.get(self.mine_url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+
+class RoomChangesAPITestCase(RoomsAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = reverse("rooms_api2_changes")
+
+    def get_changes(self, since):
+        return self.client.get(self.url, {"since": since})
+
+    def test_user_gets_all_visible_rooms_without_cursor(self):
+        self.client.force_authenticate(user=self.normal_1)
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({room["id"] for room in response.data["rooms"]},
+                         {self.room_1.pk, self.room_2.pk})
+        self.assertEqual(response.data["removed"], [self.room_3.pk])
+
+    def test_user_gets_no_changes_for_current_cursor(self):
+        self.client.force_authenticate(user=self.normal_1)
+        cursor = self.client.get(self.url).data["cursor"]
+
+        response = self.get_changes(cursor)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["cursor"], cursor)
+        self.assertEqual(response.data["rooms"], [])
+        self.assertEqual(response.data["removed"], [])
+
+    def test_user_gets_only_changed_rooms(self):
+        self.client.force_authenticate(user=self.normal_1)
+        cursor = self.client.get(self.url).data["cursor"]
+        self.room_2.join(self.normal_2)
+        self.room_2.join(self.staff_1)
+
+        response = self.get_changes(cursor)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(response.data["cursor"], cursor)
+        self.assertEqual([room["id"] for room in response.data["rooms"]], [self.room_2.pk])
+        self.assertEqual(len(response.data["rooms"][0]["members"]), 2)
+
+    def test_each_room_operation_changes_room(self):
+        self.client.force_authenticate(user=self.normal_1)
+        operations = [
+            lambda: self.room_2.join(self.normal_1),
+            lambda: self.room_2.set_lock(self.normal_1),
+            lambda: self.room_2.unlock(self.normal_1),
+            lambda: self.room_2.leave(self.normal_1),
+        ]
+
+        for operation in operations:
+            cursor = self.client.get(self.url).data["cursor"]
+            operation()
+            response = self.get_changes(cursor)
+
+            self.assertEqual([room["id"] for room in response.data["rooms"]], [self.room_2.pk])
+
+    def test_user_gets_hidden_room_as_removed(self):
+        self.client.force_authenticate(user=self.normal_1)
+        cursor = self.client.get(self.url).data["cursor"]
+        self.room_1.hide()
+
+        response = self.get_changes(cursor)
+
+        self.assertEqual(response.data["rooms"], [])
+        self.assertEqual(response.data["removed"], [self.room_1.pk])
+
+    def test_user_gets_deleted_room_as_removed(self):
+        self.client.force_authenticate(user=self.normal_1)
+        cursor = self.client.get(self.url).data["cursor"]
+        room_pk = self.room_1.pk
+        self.room_1.delete()
+
+        response = self.get_changes(cursor)
+
+        self.assertGreater(response.data["cursor"], cursor)
+        self.assertEqual(response.data["rooms"], [])
+        self.assertEqual(response.data["removed"], [room_pk])
+        self.assertEqual(self.get_changes(response.data["cursor"]).data["removed"], [])
+
+    def test_user_gets_unhidden_room(self):
+        self.client.force_authenticate(user=self.normal_1)
+        cursor = self.client.get(self.url).data["cursor"]
+        self.room_3.unhide()
+
+        response = self.get_changes(cursor)
+
+        self.assertEqual([room["id"] for room in response.data["rooms"]], [self.room_3.pk])
+        self.assertEqual(response.data["removed"], [])
+
+    def test_staff_gets_hidden_room(self):
+        self.client.force_authenticate(user=self.staff_1)
+        cursor = self.client.get(self.url).data["cursor"]
+        self.room_1.hide()
+
+        response = self.get_changes(cursor)
+
+        self.assertEqual([room["id"] for room in response.data["rooms"]], [self.room_1.pk])
+        self.assertEqual(response.data["removed"], [])
+
+    def test_invalid_cursor_is_rejected(self):
+        self.client.force_authenticate(user=self.normal_1)
+
+        for cursor in ["abc", "-1"]:
+            response = self.get_changes(cursor)
+
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class RoomSnapshotAPITestCase(RoomsAPITestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.url = reverse("rooms_api2_snapshot")
+        self.client.force_authenticate(user=self.normal_1)
+
+    def tearDown(self):
+        cache.clear()
+        super().tearDown()
+
+    def get_snapshot(self, **headers):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING="gzip", **headers)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+
+        return json.loads(gzip.decompress(response.content))
+
+    def test_user_gets_all_visible_rooms(self):
+        self.room_2.join(self.normal_2)
+        self.room_2.set_lock(self.normal_2)
+
+        snapshot = self.get_snapshot()
+
+        self.assertEqual([room["id"] for room in snapshot["rooms"]],
+                         [self.room_1.pk, self.room_2.pk])
+        self.assertEqual(snapshot["rooms"][1]["occupancy"], 1)
+        self.assertEqual(snapshot["rooms"][1]["members"],
+                         [[self.normal_2.pk, self.normal_2.first_name, self.normal_2.last_name]])
+        self.assertIsNotNone(snapshot["rooms"][1]["locked_until"])
+        self.assertIsNone(snapshot["rooms"][0]["locked_until"])
+        self.assertNotIn("password", str(snapshot))
+
+    def test_snapshot_is_not_compressed_for_client_without_gzip(self):
+        response = self.client.get(self.url)
+
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(len(response.json()["rooms"]), 2)
+
+    def test_cached_snapshot_is_served_without_reading_rooms(self):
+        self.get_snapshot()
+
+        with CaptureQueriesContext(connection) as context:
+            self.get_snapshot()
+
+        # Only the rooming version is read
+        self.assertEqual(len(context.captured_queries), 1)
+
+    def test_only_changed_rooms_are_read_again(self):
+        self.get_snapshot()
+        self.room_2.join(self.normal_2)
+
+        with CaptureQueriesContext(connection) as context:
+            snapshot = self.get_snapshot()
+
+        self.assertEqual(snapshot["rooms"][1]["occupancy"], 1)
+        rooms_query = [query["sql"] for query in context.captured_queries
+                       if 'FROM "rooms_room" LEFT OUTER JOIN' in query["sql"]]
+        self.assertEqual(len(rooms_query), 1)
+        self.assertIn(f"IN ({self.room_2.pk})", rooms_query[0])
+
+    def test_hidden_and_deleted_rooms_are_removed(self):
+        self.get_snapshot()
+        self.room_1.hide()
+        self.room_2.delete()
+        self.room_3.unhide()
+
+        snapshot = self.get_snapshot()
+
+        self.assertEqual([room["id"] for room in snapshot["rooms"]], [self.room_3.pk])
+
+    def test_snapshot_is_not_modified_until_rooms_change(self):
+        response = self.client.get(self.url)
+
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+                         .status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.room_1.join(self.normal_2)
+
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+                         .status_code, status.HTTP_200_OK)
+
+
+@override_settings(ROOMS_EVENTS_ENABLED=True, ROOMS_EVENTS_STREAM_TIMEOUT=0.5,
+                   ROOMS_EVENTS_HEARTBEAT=0.1)
+class RoomEventsAPITestCase(RoomsAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = reverse("rooms_api2_events")
+
+    def test_anonymous_cannot_subscribe(self):
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_user_receives_room_events(self):
+        self.client.force_authenticate(user=self.normal_1)
+
+        response = self.client.get(self.url, HTTP_ACCEPT="text/event-stream")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room_2.join(self.normal_1)
+        content = b"".join(response.streaming_content).decode()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertIn("event: joined\n", content)
+        self.assertIn(f'"room": {self.room_2.pk}', content)
+        self.assertIn(": keep-alive\n\n", content)
+
+    @override_settings(ROOMS_EVENTS_ENABLED=False)
+    def test_stream_is_not_found_when_events_are_disabled(self):
+        self.client.force_authenticate(user=self.normal_1)
+
+        response = self.client.get(self.url, HTTP_ACCEPT="text/event-stream")
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
@@ -10,6 +10,13 @@ urlpatterns = [
                                                          "put": "partial_update",
                                                          "delete": "destroy"}),
          name="rooms_api2_detail"),
+    path("changes/", views.RoomViewSet.as_view(actions={"get": "changes"}),
+         name="rooms_api2_changes"),
+    path("snapshot/", views.RoomViewSet.as_view(actions={"get": "snapshot"}),
+         name="rooms_api2_snapshot"),
+    path("events/", views.RoomViewSet.as_view(actions={"get": "events"},
+                                                  **views.RoomViewSet.events.kwargs),
+         name="rooms_api2_events"),
     path("mine/", views.RoomViewSet.as_view(actions={"get": "user_member"}),
          name="rooms_api2_mine"),
     path("<int:pk>/hidden/",
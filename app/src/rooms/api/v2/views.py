@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
+import gzip
+import re
+
+from django.conf import settings
 from django.core import exceptions
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_vary_headers
 from django.utils.translation import ugettext_lazy as _
 from rest_framework import status
 from rest_framework.decorators import action
@@ -13,17 +20,30 @@ from rooms.api.v2.serializers import RoomLockCreateMethodAdminSerializer, \
     RoomLockCreateMethodSerializer, RoomMemberCreateMethodSerializer, \
     RoomMemberDestroyMethodSerializer, RoomSerializer, RoomWithLockPasswordSerializer, \
     UserRoomSerializer
-from rooms.models import Room, UserRoom
+from rooms.events import event_stream, get_broadcaster
+from rooms.models import RemovedRoom, Room, UserRoom, current_rooming_version
+from rooms.snapshot import get_snapshot
 from users.models import User, UserPreferences
-from utils.api import ReadAuthenticatedWriteAdmin
+from utils.api import EncodedJSON, EncodedJSONList, EventStreamRenderer, \
+    ReadAuthenticatedWriteAdmin, conditional_response, make_etag
 from utils.constants import RoomingStatus
 
+ACCEPTS_GZIP = re.compile(r"\bgzip\b")
+
+
+def room_json_cache_key(pk, version):
+    return f"rooms.room_json.{pk}.{version}"
+
 
 def _check_rooming(user, sender):
     if not sender.is_staff:
         zosia = Zosia.objects.find_active_or_404()
-        user_prefs = get_object_or_404(UserPreferences, zosia=zosia, user=user)
-        rooming_status = zosia.get_rooming_status(user_prefs)
+        rooming_schedule = UserPreferences.objects.rooming_schedule(zosia)
+
+        if user.pk not in rooming_schedule:
+            raise Http404("User is not registered for the conference")
+
+        rooming_status = zosia.get_rooming_status_from(rooming_schedule[user.pk])
 
         if rooming_status == RoomingStatus.BEFORE_ROOMING:
             raise exceptions.ValidationError(_("Rooming for user has not started yet."),
@@ -37,7 +57,7 @@ def _check_rooming(user, sender):
 
 
 class UserRoomViewSet(ReadOnlyModelViewSet):
-    queryset = UserRoom.objects.all()
+    queryset = UserRoom.objects.select_related("room", "user")
     serializer_class = UserRoomSerializer
     permission_classes = [IsAdminUser]
 
@@ -47,36 +67,154 @@ class RoomViewSet(ModelViewSet):
     permission_classes = [ReadAuthenticatedWriteAdmin]
 
     def get_queryset(self):
+        # Fetch locks and members of all rooms at once instead of querying them room by room
+        return self._get_visible_rooms().select_related("lock__user") \
+            .prefetch_related("userroom_set__user")
+
+    def list(self, request, *args, **kwargs):
+        # Any change of rooms bumps the rooming version, so it tags the whole list
+        etag = self._make_etag(current_rooming_version())
+
+        return conditional_response(
+            request, etag,
+            lambda: Response(self._serialize_rooms(self.get_queryset()), status=status.HTTP_200_OK))
+
+    def retrieve(self, request, *args, **kwargs):
+        version = self._get_visible_rooms().filter(pk=kwargs["pk"]) \
+            .values_list("version", flat=True).first()
+
+        if version is None:
+            return super().retrieve(request, *args, **kwargs)
+
+        return conditional_response(
+            request, self._make_etag(version),
+            lambda: super(RoomViewSet, self).retrieve(request, *args, **kwargs))
+
+    def _get_visible_rooms(self):
         sender = self.request.user
 
         return Room.objects.all() if sender.is_staff else \
             Room.objects.all_visible_with_member(sender)
 
+    def _serialize_rooms(self, rooms):
+        """Serializes rooms, reusing JSON of rooms already encoded for their current versions.
+
+        Rooms locked by the sender are serialized every time, as only the sender gets the lock
+        password.
+        """
+        sender = self.request.user
+        rows = list(rooms.prefetch_related(None).values_list("pk", "version", "lock__user"))
+        keys = {pk: room_json_cache_key(pk, version)
+                for pk, version, lock_user in rows if lock_user != sender.pk}
+        cached = cache.get_many(keys.values())
+        encoded = {pk: cached[key] for pk, key in keys.items() if key in cached}
+        missing = [pk for pk, _, _ in rows if pk not in encoded]
+
+        if missing:
+            fresh = {}
+
+            for room in rooms.filter(pk__in=missing):
+                encoded[room.pk] = EncodedJSON(self.get_serializer(room).data)
+
+                if room.lock is None or room.lock.user_id != sender.pk:
+                    fresh[room_json_cache_key(room.pk, room.version)] = encoded[room.pk]
+
+            cache.set_many(fresh, settings.ROOMS_FRAGMENT_CACHE_TIMEOUT)
+
+        # Rooms removed in the meantime are skipped
+        return EncodedJSONList(encoded[pk] for pk, _, _ in rows if pk in encoded)
+
+    def _make_etag(self, *versions):
+        # Data depends on the sender, who sees own lock password and own hidden room
+        return make_etag(*versions, self.request.user.pk, self.request.accepted_renderer.format)
+
     @action(detail=True, methods=["POST"])
     def hide(self, request, pk):
         room = self.get_object()
-        room.hidden = True
-        room.save()
+        room.hide()
 
         return Response(self.get_serializer(room).data, status=status.HTTP_200_OK)
 
     @action(detail=True, methods=["DELETE"])
     def unhide(self, request, pk):
         room = self.get_object()
-        room.hidden = False
-        room.save()
+        room.unhide()
 
         return Response(self.get_serializer(room).data, status=status.HTTP_200_OK)
 
+    @action(detail=False, methods=["GET"])
+    def changes(self, request):
+        try:
+            since = int(request.query_params.get("since", 0))
+        except ValueError:
+            since = -1
+
+        if since < 0:
+            return Response(_("Cursor must be a non-negative integer."),
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Read the cursor before rooms, so no change committed in between can be skipped
+        cursor = current_rooming_version()
+        changed_ids = set(Room.objects.filter(version__gt=since).values_list("id", flat=True))
+        rooms = self._serialize_rooms(
+            self.get_queryset().filter(pk__in=changed_ids).order_by("version"))
+        removed = changed_ids.difference(room["id"] for room in rooms)
+
+        # Clients without a cursor have no rooms yet, so they don't need tombstones
+        if since > 0:
+            removed.update(RemovedRoom.objects.filter(version__gt=since)
+                           .values_list("room_id", flat=True))
+
+        return Response({"cursor": cursor, "rooms": rooms, "removed": sorted(removed)},
+                        status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=["GET"])
+    def snapshot(self, request):
+        # Snapshot is shared by all users, so only the rooming version tags it
+        version = current_rooming_version()
+
+        def get_response():
+            body = get_snapshot(version)["body"]
+
+            if ACCEPTS_GZIP.search(request.META.get("HTTP_ACCEPT_ENCODING", "")):
+                response = HttpResponse(body, content_type="application/json")
+                response["Content-Encoding"] = "gzip"
+            else:
+                response = HttpResponse(gzip.decompress(body), content_type="application/json")
+
+            patch_vary_headers(response, ("Accept-Encoding",))
+
+            return response
+
+        return conditional_response(request, make_etag("snapshot", version), get_response)
+
+    @action(detail=False, methods=["GET"], renderer_classes=[EventStreamRenderer])
+    def events(self, request):
+        if not settings.ROOMS_EVENTS_ENABLED:
+            raise Http404
+
+        # Subscribe before responding, so no event is lost until the stream starts
+        response = StreamingHttpResponse(event_stream(get_broadcaster().subscribe()),
+                                         content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+
+        return response
+
     @action(detail=True, methods=["GET"])
     def user_member(self, request):
         sender = request.user
-        room = sender.room_of_user.all().first()
+        room_version = sender.room_of_user.values_list("pk", "version").first()
 
-        if not room:
+        if room_version is None:
             return Response(status=status.HTTP_204_NO_CONTENT)
 
-        return Response(self.get_serializer(room).data, status=status.HTTP_200_OK)
+        def get_response():
+            room = self.get_queryset().get(pk=room_version[0])
+
+            return Response(self.get_serializer(room).data, status=status.HTTP_200_OK)
+
+        return conditional_response(request, self._make_etag(*room_version), get_response)
 
 
 class RoomMemberViewSet(ViewSet):
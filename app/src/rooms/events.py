@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import queue
+import select
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Events are dropped for a subscriber that falls this far behind. Clients only use events
+# as a signal to fetch the changes feed, so the next delivered event makes up for any loss.
+SUBSCRIPTION_QUEUE_SIZE = 100
+
+
+class LocalBroadcaster:
+    """Delivers room events to subscribers within the current process only."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+
+    def subscribe(self):
+        subscription = queue.Queue(maxsize=SUBSCRIPTION_QUEUE_SIZE)
+
+        with self._lock:
+            self._subscriptions.add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, event):
+        self._dispatch(event)
+
+    def _dispatch(self, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+
+        for subscription in subscriptions:
+            try:
+                subscription.put_nowait(event)
+            except queue.Full:
+                pass
+
+
+class PostgresBroadcaster(LocalBroadcaster):
+    """Delivers room events to subscribers in all processes using Postgres LISTEN / NOTIFY.
+
+    Every process listens on its own connection in a background thread, started with the first
+    subscription, and dispatches received notifications to its local subscribers.
+    """
+    CHANNEL = "rooms_events"
+    POLL_TIMEOUT = 5
+    RECONNECT_DELAY = 1
+
+    def __init__(self):
+        super().__init__()
+        self._connection_params = None
+        self._listener = None
+        self._closed = threading.Event()
+
+    def subscribe(self):
+        subscription = super().subscribe()
+
+        with self._lock:
+            if self._listener is None:
+                self._connection_params = connection.get_connection_params()
+                self._listener = threading.Thread(target=self._listen, daemon=True)
+                self._listener.start()
+
+        return subscription
+
+    def publish(self, event):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [self.CHANNEL, json.dumps(event)])
+
+    def close(self):
+        self._closed.set()
+
+        if self._listener is not None:
+            self._listener.join()
+
+    def _listen(self):
+        import psycopg2
+        from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+        while not self._closed.is_set():
+            try:
+                listen_connection = psycopg2.connect(**self._connection_params)
+            except psycopg2.Error:
+                logger.exception("Cannot connect to listen for room events")
+                time.sleep(self.RECONNECT_DELAY)
+                continue
+
+            try:
+                listen_connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+
+                with listen_connection.cursor() as cursor:
+                    cursor.execute(f"LISTEN {self.CHANNEL}")
+
+                while not self._closed.is_set():
+                    if select.select([listen_connection], [], [], self.POLL_TIMEOUT) == \
+                            ([], [], []):
+                        continue
+
+                    listen_connection.poll()
+
+                    while listen_connection.notifies:
+                        notify = listen_connection.notifies.pop(0)
+                        self._dispatch(json.loads(notify.payload))
+            except psycopg2.Error:
+                logger.exception("Lost connection listening for room events")
+                time.sleep(self.RECONNECT_DELAY)
+            finally:
+                listen_connection.close()
+
+
+_broadcaster = None
+_broadcaster_lock = threading.Lock()
+
+
+def get_broadcaster():
+    global _broadcaster
+
+    with _broadcaster_lock:
+        if _broadcaster is None:
+            _broadcaster = import_string(settings.ROOMS_EVENTS_BROADCASTER)()
+
+        return _broadcaster
+
+
+def publish_room_event(event_type, room):
+    if not settings.ROOMS_EVENTS_ENABLED:
+        return
+
+    event = {"type": event_type, "room": room.pk, "version": room.version}
+    transaction.on_commit(lambda: get_broadcaster().publish(event))
+
+
+def format_event(event):
+    return f"id: {event['version']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+def event_stream(subscription):
+    """Yields Server-Sent Events from subscription until the stream timeout passes.
+
+    The client reconnects by itself afterwards, so a single stream never holds a worker thread
+    for long. The database connection is released first, as the stream doesn't need it.
+    """
+    if not connection.in_atomic_block:
+        connection.close()
+
+    deadline = time.monotonic() + settings.ROOMS_EVENTS_STREAM_TIMEOUT
+
+    try:
+        yield f"retry: {settings.ROOMS_EVENTS_RETRY * 1000}\n\n"
+
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                event = subscription.get(
+                    timeout=min(remaining, settings.ROOMS_EVENTS_HEARTBEAT))
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+            else:
+                yield format_event(event)
+    finally:
+        get_broadcaster().unsubscribe(subscription)
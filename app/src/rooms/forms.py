@@ -1,5 +1,26 @@
 from django import forms
+from django.contrib.postgres.forms import SimpleArrayField
+from django.utils.translation import ugettext_lazy as _
 
 
 class UploadFileForm(forms.Form):
     file = forms.FileField()
+    dry_run = forms.BooleanField(required=False,
+                                 label=_("Only check the file, without importing rooms"))
+
+
+class RoomAllocationForm(forms.Form):
+    """Carries the previewed allocation, so exactly the previewed one is applied."""
+    users = SimpleArrayField(forms.IntegerField(), widget=forms.HiddenInput, label=_("Users"))
+    rooms = SimpleArrayField(forms.IntegerField(), widget=forms.HiddenInput, label=_("Rooms"))
+
+    def clean(self):
+        cleaned_data = super().clean()
+
+        if len(cleaned_data.get('users', [])) != len(cleaned_data.get('rooms', [])):
+            raise forms.ValidationError(_("Every user must have a room"))
+
+        return cleaned_data
+
+    def assignment(self):
+        return dict(zip(self.cleaned_data['users'], self.cleaned_data['rooms']))
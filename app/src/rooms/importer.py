@@ -0,0 +1,211 @@
+import csv
+from collections import defaultdict
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils.translation import ugettext_lazy as _
+
+from rooms.models import MAX_BEDS, Room, bump_rooming_version, validate_beds
+from utils.constants import CSV_CHUNK_SIZE
+
+COLUMNS = ("name", "description", "hidden", "available_beds_single", "available_beds_double",
+           "beds_single", "beds_double")
+BEDS_COLUMNS = COLUMNS[3:]
+UPDATED_FIELDS = COLUMNS[1:]
+
+TRUE_VALUES = {"true", "yes", "1"}
+FALSE_VALUES = {"false", "no", "0", ""}
+
+# Only the first errors are reported, so a completely wrong file doesn't fill the memory
+MAX_REPORTED_ERRORS = 100
+
+
+def parse_room(row):
+    """Returns fields of a room read from a CSV row, raises ValidationError for invalid values."""
+    if len(row) != len(COLUMNS):
+        raise ValidationError(_("Expected %(expected)s columns, got %(count)s"), code="invalid",
+                              params={"expected": len(COLUMNS), "count": len(row)})
+
+    values = dict(zip(COLUMNS, (value.strip() for value in row)))
+
+    if not values["name"]:
+        raise ValidationError(_("Name is missing"), code="invalid")
+
+    if len(values["name"]) > Room._meta.get_field("name").max_length:
+        raise ValidationError(_("Name %(name)s is too long"), code="invalid",
+                              params={"name": values["name"]})
+
+    hidden = values["hidden"].lower()
+
+    if hidden not in TRUE_VALUES | FALSE_VALUES:
+        raise ValidationError(_("%(value)s is neither True nor False"), code="invalid",
+                              params={"value": values["hidden"]})
+
+    values["hidden"] = hidden in TRUE_VALUES
+
+    for column in BEDS_COLUMNS:
+        values[column] = parse_beds(values[column])
+
+    return values
+
+
+def parse_beds(value):
+    try:
+        beds = int(value)
+    except ValueError:
+        beds = None
+
+    if beds is None or not 0 <= beds <= MAX_BEDS:
+        raise ValidationError(_("%(value)s is not a number of beds from 0 to %(max)s"),
+                              code="invalid", params={"value": value, "max": MAX_BEDS})
+
+    return beds
+
+
+def _batches(csvfile, batch_size):
+    """Yields rows of the file with their line numbers in lists of batch_size rows. The header
+    and empty lines are skipped."""
+    batch = []
+
+    for line, row in enumerate(csv.reader(csvfile, delimiter=","), start=1):
+        if not any(value.strip() for value in row) or line == 1 and row[0] == "Name":
+            continue
+
+        batch.append((line, row))
+
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+class RoomImport:
+    """Upserts rooms read from CSV by their names, one batch of rows at a time, so only a single
+    batch is kept in memory.
+
+    Rows are validated like rooms sent to the API, against members of existing rooms. Once any
+    row is invalid, nothing is written anymore and the rest of rows is only validated.
+    """
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.created = 0
+        self.updated = 0
+        self.errors = []
+        self.errors_count = 0
+        self.hidden_count = 0
+        self.lines = {}
+        self.changed = []
+
+    @property
+    def writes(self):
+        return not self.dry_run and not self.errors_count
+
+    def error(self, line, error):
+        self.errors_count += 1
+
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.extend({"line": line, "message": message} for message in error.messages)
+        else:
+            self.hidden_count += 1
+
+    def parse(self, batch):
+        rooms = []
+
+        for line, row in batch:
+            try:
+                values = parse_room(row)
+                name = values["name"]
+
+                if name in self.lines:
+                    raise ValidationError(_("Room %(name)s is already on line %(line)s"),
+                                          code="invalid",
+                                          params={"name": name, "line": self.lines[name]})
+            except ValidationError as e:
+                self.error(line, e)
+            else:
+                self.lines[name] = line
+                rooms.append((line, values))
+
+        return rooms
+
+    def add(self, batch):
+        rooms = self.parse(batch)
+        existing = Room.objects.filter(name__in=[values["name"] for line, values in rooms])
+
+        if self.writes:
+            # Rooms are locked, so nobody joins them between validation and update
+            existing = existing.select_for_update().order_by("pk")
+
+        by_name = defaultdict(list)
+
+        for room in existing:
+            by_name[room.name].append(room)
+
+        created, updated = [], []
+
+        for line, values in rooms:
+            matching = by_name[values["name"]]
+
+            try:
+                if len(matching) > 1:
+                    raise ValidationError(_("There are %(count)s rooms named %(name)s"),
+                                          code="invalid", params={"count": len(matching),
+                                                                  "name": values["name"]})
+
+                validate_beds(values["beds_single"], values["beds_double"],
+                              values["available_beds_single"], values["available_beds_double"],
+                              matching[0].members_count if matching else 0)
+            except ValidationError as e:
+                self.error(line, e)
+                continue
+
+            if matching:
+                for field in UPDATED_FIELDS:
+                    setattr(matching[0], field, values[field])
+
+                updated.append(matching[0])
+            else:
+                created.append(Room(**values))
+
+        self.created += len(created)
+        self.updated += len(updated)
+
+        if self.writes:
+            Room.objects.bulk_create(created)
+            Room.objects.bulk_update(updated, UPDATED_FIELDS)
+            self.changed.extend(room.pk for room in created + updated)
+
+    def finish(self):
+        """Tags changed rooms with a new rooming version and returns the report of import."""
+        if self.writes and self.changed:
+            # Bulk operations skip Room.save, so rooms are tagged here with a single version
+            Room.objects.filter(pk__in=self.changed).update(version=bump_rooming_version())
+
+        return {"created": self.created, "updated": self.updated,
+                "errors": sorted(self.errors, key=lambda error: error["line"]),
+                "errors_count": self.errors_count, "hidden_count": self.hidden_count,
+                "dry_run": self.dry_run}
+
+
+def import_rooms(csvfile, dry_run=False, batch_size=CSV_CHUNK_SIZE):
+    """Adds rooms from CSV file and updates existing rooms with the same names.
+
+    Nothing is imported if any line is invalid or in dry run, the report shows what would
+    happen then. Returns numbers of created and updated rooms and errors with their lines, and
+    numbers of lines with errors and of those lines whose errors are not reported.
+    """
+    room_import = RoomImport(dry_run)
+
+    with transaction.atomic():
+        for batch in _batches(csvfile, batch_size):
+            room_import.add(batch)
+
+        report = room_import.finish()
+
+        if not room_import.writes:
+            transaction.set_rollback(True)
+
+    return report
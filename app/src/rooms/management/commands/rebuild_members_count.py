@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from rooms.models import Room, bump_rooming_version
+
+
+class Command(BaseCommand):
+    help = 'Verify members count of rooms against room members and rebuild wrong counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report wrong counts, without fixing them')
+
+    @transaction.atomic
+    def handle(self, *args, **kwargs):
+        # Lock all rooms, so no one joins or leaves them until counts are rebuilt
+        list(Room.objects.select_for_update().order_by('pk').values_list('pk', flat=True))
+        rooms = list(Room.objects.with_wrong_members_count())
+
+        for room in rooms:
+            self.stdout.write(f'{room}: members count is {room.members_count}, '
+                              f'but room has {room.real_members_count} members')
+
+        if kwargs['check']:
+            if rooms:
+                raise CommandError(f'Found {len(rooms)} rooms with wrong members count')
+
+            self.stdout.write('All members counts are correct')
+            return
+
+        if rooms:
+            # Bulk update skips Room.save, so rooms are tagged here with a single version, then
+            # the snapshot and changes of rooms include the rebuilt counts
+            version = bump_rooming_version()
+
+            for room in rooms:
+                room.members_count = room.real_members_count
+                room.version = version
+
+            Room.objects.bulk_update(rooms, ['members_count', 'version'])
+
+        self.stdout.write(f'Rebuilt members count of {len(rooms)} rooms')
@@ -0,0 +1,257 @@
+from collections import defaultdict
+from importlib import import_module
+import json
+import random
+import statistics
+import threading
+import time
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils.crypto import get_random_string
+
+from conferences.models import Zosia
+from rooms.models import Room, RoomLock, UserRoom, bump_rooming_version
+from users.models import User
+
+ENDPOINT_LIST = 'GET /api/v2/rooms/'
+ENDPOINT_JOIN = 'POST /api/v2/rooms/<pk>/member/'
+ENDPOINT_LOCK = 'POST /api/v2/rooms/<pk>/lock/'
+
+
+def create_session_cookie(user):
+    # Log users in without the login form, so password hashing doesn't distort the results
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+
+    return session.session_key
+
+
+def percentile(values, percent):
+    if len(values) == 1:
+        return values[0]
+
+    return statistics.quantiles(values, n=100, method='inclusive')[percent - 1]
+
+
+class Results:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(list)
+        self.queries = defaultdict(list)
+
+    def record(self, endpoint, status, latency, queries):
+        with self._lock:
+            self.latencies[endpoint].append(latency)
+            self.statuses[endpoint].append(status)
+
+            if queries is not None:
+                self.queries[endpoint].append(queries)
+
+    def summary(self, elapsed):
+        summary = {}
+
+        for endpoint, latencies in self.latencies.items():
+            statuses = self.statuses[endpoint]
+            queries = self.queries[endpoint]
+            summary[endpoint] = {
+                'requests': len(latencies),
+                'throughput': len(latencies) / elapsed,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                # Server errors and failed connections, rejections like full rooms are expected
+                'error_rate': sum(1 for s in statuses if s == 0 or s >= 500) / len(statuses),
+                'rejected_rate': sum(1 for s in statuses if 400 <= s < 500) / len(statuses),
+                'queries_mean': statistics.mean(queries) if queries else None,
+                'queries_max': max(queries) if queries else None,
+            }
+
+        return summary
+
+
+class Client:
+    def __init__(self, base_url, user, timeout, results):
+        self.base_url = base_url.rstrip('/')
+        self.user = user
+        self.timeout = timeout
+        self.results = results
+        self.csrf_token = get_random_string(32)
+        self.session_key = create_session_cookie(user)
+
+    def request(self, endpoint, method, path, data=None):
+        headers = {
+            'Accept': 'application/json',
+            'Cookie': f'{settings.SESSION_COOKIE_NAME}={self.session_key}; '
+                      f'{settings.CSRF_COOKIE_NAME}={self.csrf_token}',
+            'X-CSRFToken': self.csrf_token,
+        }
+        body = None
+
+        if data is not None:
+            headers['Content-Type'] = 'application/json'
+            body = json.dumps(data).encode()
+
+        start = time.perf_counter()
+
+        try:
+            with urlopen(Request(self.base_url + path, data=body, headers=headers, method=method),
+                         timeout=self.timeout) as response:
+                status, response_headers, content = response.status, response.headers, \
+                                                    response.read()
+        except HTTPError as e:
+            status, response_headers, content = e.code, e.headers, e.read()
+        except (URLError, OSError):
+            status, response_headers, content = 0, {}, b''
+
+        queries = response_headers.get('X-Query-Count')
+        self.results.record(endpoint, status, time.perf_counter() - start,
+                            int(queries) if queries is not None else None)
+
+        return status, content
+
+    def choose_room(self, rooms):
+        free = [room for room in rooms if room['lock'] is None and
+                room['available_beds_single'] + 2 * room['available_beds_double'] >
+                len(room['members'])]
+
+        return random.choice(free or rooms)
+
+    def run(self, iterations, lock_ratio):
+        # Every iteration is what a user does on the rooming page: looks at rooms, joins one of
+        # the free ones and sometimes locks it
+        for _ in range(iterations):
+            status, content = self.request(ENDPOINT_LIST, 'GET', '/api/v2/rooms/')
+
+            if status != 200:
+                continue
+
+            rooms = json.loads(content)
+
+            if not rooms:
+                return
+
+            room = self.choose_room(rooms)
+            status, _ = self.request(ENDPOINT_JOIN, 'POST', f'/api/v2/rooms/{room["id"]}/member/',
+                                     {'user': self.user.pk})
+
+            if status == 201 and random.random() < lock_ratio:
+                self.request(ENDPOINT_LOCK, 'POST', f'/api/v2/rooms/{room["id"]}/lock/',
+                             {'user': self.user.pk})
+
+
+class Command(BaseCommand):
+    help = 'Replay the opening of rooming: drive concurrent clients through the rooms API ' \
+           'of a running server and report latency, throughput, errors and queries per endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:8000',
+                            help='Address of the server under test')
+        parser.add_argument('--clients', type=int, default=50,
+                            help='Number of concurrent clients, each logged in as other user')
+        parser.add_argument('--iterations', type=int, default=5,
+                            help='Number of list, join and lock rounds done by each client')
+        parser.add_argument('--lock-ratio', type=float, default=0.3,
+                            help='Probability of locking a room after joining it')
+        parser.add_argument('--timeout', type=float, default=30,
+                            help='Timeout of a single request in seconds')
+        parser.add_argument('--wait', type=float, default=30,
+                            help='Seconds to wait for the server to start')
+        parser.add_argument('--reset', action='store_true',
+                            help='Remove all room members and locks before the test')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Seed for random choices of clients')
+        parser.add_argument('--json', dest='json_path', default=None,
+                            help='Also write results as JSON to this file, to compare runs')
+
+    def handle(self, *args, **kwargs):
+        random.seed(kwargs['seed'])
+        zosia = Zosia.objects.find_active()
+
+        if zosia is None:
+            raise CommandError('There is no active ZOSIA, run create_data first')
+
+        users = list(User.objects.filter(preferences__zosia=zosia,
+                                         preferences__payment_accepted=True)
+                     .order_by('?')[:kwargs['clients']])
+
+        if not users:
+            raise CommandError('There are no users with accepted payment')
+
+        if kwargs['reset']:
+            self.reset_rooms()
+
+        self.wait_for_server(kwargs['url'], kwargs['wait'])
+
+        results = Results()
+        clients = [Client(kwargs['url'], user, kwargs['timeout'], results) for user in users]
+        # Connections are not shared with threads, close ours so it doesn't hold the database
+        connection.close()
+
+        barrier = threading.Barrier(len(clients))
+
+        def run(client):
+            barrier.wait()
+            client.run(kwargs['iterations'], kwargs['lock_ratio'])
+
+        threads = [threading.Thread(target=run, args=(client,)) for client in clients]
+        start = time.perf_counter()
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.perf_counter() - start
+        summary = results.summary(elapsed)
+        self.print_summary(summary, len(clients), elapsed)
+
+        if kwargs['json_path']:
+            with open(kwargs['json_path'], 'w') as f:
+                json.dump({'clients': len(clients), 'iterations': kwargs['iterations'],
+                           'elapsed': elapsed, 'endpoints': summary}, f, indent=2)
+
+    @transaction.atomic
+    def reset_rooms(self):
+        UserRoom.objects.all().delete()
+        Room.objects.update(members_count=0, lock=None,
+                            version=bump_rooming_version())
+        RoomLock.objects.all().delete()
+        self.stdout.write('Removed all room members and locks')
+
+    def wait_for_server(self, url, timeout):
+        deadline = time.monotonic() + timeout
+
+        while True:
+            try:
+                urlopen(url, timeout=1).close()
+                return
+            except HTTPError:
+                return
+            except (URLError, OSError):
+                if time.monotonic() > deadline:
+                    raise CommandError(f'Server at {url} is not responding')
+
+                time.sleep(0.5)
+
+    def print_summary(self, summary, clients, elapsed):
+        self.stdout.write(f'{clients} clients, {elapsed:.2f}s')
+        self.stdout.write(f'{"endpoint":<32} {"requests":>8} {"req/s":>8} {"p50 ms":>8} '
+                          f'{"p95 ms":>8} {"p99 ms":>8} {"errors":>7} {"rejected":>8} '
+                          f'{"queries":>7}')
+
+        for endpoint, row in summary.items():
+            queries = '-' if row['queries_mean'] is None else f'{row["queries_mean"]:.1f}'
+            self.stdout.write(f'{endpoint:<32} {row["requests"]:>8} {row["throughput"]:>8.1f} '
+                              f'{row["p50_ms"]:>8.1f} {row["p95_ms"]:>8.1f} '
+                              f'{row["p99_ms"]:>8.1f} {row["error_rate"]:>7.1%} '
+                              f'{row["rejected_rate"]:>8.1%} {queries:>7}')
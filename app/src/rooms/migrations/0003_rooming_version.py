@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0002_relations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomingVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='version',
+            field=models.PositiveBigIntegerField(db_index=True, default=0),
+        ),
+    ]
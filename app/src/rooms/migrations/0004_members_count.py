@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:22
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def count_members(apps, schema_editor):
+    Room = apps.get_model('rooms', 'Room')
+    UserRoom = apps.get_model('rooms', 'UserRoom')
+
+    members_count = UserRoom.objects.filter(room=OuterRef('pk')).values('room') \
+        .annotate(count=Count('pk')).values('count')
+    Room.objects.update(members_count=Coalesce(Subquery(members_count), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0003_rooming_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='members_count',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_members, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0004_members_count'),
+    ]
+
+    operations = [
+        # Sequence continues after the last version handed out by the counter row
+        migrations.RunSQL(
+            sql="""
+                CREATE SEQUENCE rooms_rooming_version MINVALUE 0 START 0;
+                SELECT setval('rooms_rooming_version', GREATEST(
+                    (SELECT COALESCE(MAX(value), 0) FROM rooms_roomingversion),
+                    (SELECT COALESCE(MAX(version), 0) FROM rooms_room)));
+            """,
+            reverse_sql="""
+                INSERT INTO rooms_roomingversion (id, value)
+                SELECT 1, last_value FROM rooms_rooming_version;
+                DROP SEQUENCE rooms_rooming_version;
+            """,
+        ),
+        migrations.DeleteModel(
+            name='RoomingVersion',
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 12:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0005_rooming_version_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RemovedRoom',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_id', models.PositiveIntegerField(unique=True)),
+                ('version', models.PositiveBigIntegerField(db_index=True)),
+            ],
+        ),
+    ]
@@ -3,12 +3,14 @@ import re
 import string
 
 from django.core.exceptions import ValidationError
-from django.db import models, transaction
+from django.db import connection, models, transaction
+from django.db.models import Count, F, Q
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
+from rooms.events import publish_room_event
 from users.models import User
-from utils.constants import DELIMITER, ROOM_LOCK_TIMEOUT
+from utils.constants import DELIMITER, ROOM_LOCK_TIMEOUT, RoomEventType
 from utils.time_manager import now, timedelta_since_now
 
 
@@ -17,6 +19,35 @@ def random_string(length=10):
             string.ascii_uppercase + string.digits) for _ in range(length))
 
 
+# Accepted beds number range is from 0 to 42. You don't expect 43 beds in one room, do you?
+MAX_BEDS = 42
+
+
+def validate_beds(beds_single, beds_double, available_beds_single, available_beds_double,
+                  members_count=0):
+    """Checks that available beds fit in real beds, with double beds available as single ones,
+    and that there are enough of them for members who already joined the room."""
+    if available_beds_single > beds_single + beds_double:
+        raise ValidationError(
+            _("Available single beds cannot exceed real single beds plus double beds"),
+            code="invalid"
+        )
+
+    double_as_single = max(0, available_beds_single - beds_single)
+
+    if available_beds_double > beds_double - double_as_single:
+        raise ValidationError(
+            _("Available double beds cannot exceed real double beds minus double-as-single beds"),
+            code="invalid"
+        )
+
+    if available_beds_single + 2 * available_beds_double < members_count:
+        raise ValidationError(
+            _("Available beds must exceed already joined members"),
+            code="invalid"
+        )
+
+
 class RoomLockManager(models.Manager):
     def make(self, user, expiration_date=None):
         if expiration_date is None:
@@ -44,12 +75,55 @@ class RoomLock(models.Model):
         return self.user == user
 
 
+# Rooming version is a global counter of changes made to rooms, used as a cursor by API clients.
+# Versions are taken from a sequence under a lock held until the transaction ends, so they are
+# committed in the order they were taken. Only the end of transactions changing rooms, from the
+# first version until commit, waits for other such transactions. Checks and row locks before it
+# run in parallel.
+ROOMING_VERSION_SEQUENCE = "rooms_rooming_version"
+# Key of the advisory lock on taking versions
+ROOMING_VERSION_LOCK = (1901, 0)
+
+
+def bump_rooming_version():
+    """Returns a new rooming version. Other transactions can't take versions until the current
+    one ends."""
+    with connection.cursor() as cursor:
+        # The lock is taken before the version, so it's never handed out unlocked
+        cursor.execute("SELECT nextval(%s) FROM pg_advisory_xact_lock(%s, %s)",
+                       [ROOMING_VERSION_SEQUENCE, *ROOMING_VERSION_LOCK])
+
+        return cursor.fetchone()[0]
+
+
+def current_rooming_version():
+    """Returns the last committed rooming version. Versions are committed in order, so all
+    changes up to it are visible, and changes committed later have greater versions."""
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT GREATEST((SELECT MAX(version) FROM {Room._meta.db_table}), "
+                       f"(SELECT MAX(version) FROM {RemovedRoom._meta.db_table}), 0)")
+
+        return cursor.fetchone()[0]
+
+
 class RoomManager(models.Manager):
     def all_visible(self):
         return self.filter(hidden=False)
 
     def all_visible_with_member(self, user):
-        return self.filter(hidden=False) | self.filter(members__pk=user.pk)
+        # Subquery instead of join with members, which would repeat room once per member
+        return self.filter(Q(hidden=False) |
+                           Q(pk__in=UserRoom.objects.filter(user=user).values("room")))
+
+    def lock(self, *pks):
+        # Rooms are always locked in order of primary keys, so transactions locking the same rooms
+        # wait for each other instead of deadlocking
+        return list(self.select_for_update().filter(pk__in=pks).order_by("pk")
+                    .values_list("pk", flat=True))
+
+    def with_wrong_members_count(self):
+        return self.annotate(real_members_count=Count("userroom")) \
+            .exclude(members_count=F("real_members_count"))
 
     def filter_visible(self, **params):
         if params.get("hidden"):
@@ -75,6 +149,11 @@ class Room(models.Model):
                                 blank=True, null=True)
 
     members = models.ManyToManyField(User, through="UserRoom", related_name="room_of_user")
+    # Number of room members, maintained by join and leave to avoid counting them on every read
+    members_count = models.PositiveSmallIntegerField(default=0, editable=False)
+
+    # Value of global rooming version at the time of the last change of this room
+    version = models.PositiveBigIntegerField(default=0, db_index=True)
 
     @property
     def beds(self):
@@ -88,10 +167,6 @@ class Room(models.Model):
     def capacity(self):
         return self.available_beds_single + 2 * self.available_beds_double
 
-    @property
-    def members_count(self):
-        return self.members.count()
-
     @property
     def is_locked(self):
         return self.lock and not self.lock.is_expired
@@ -107,6 +182,33 @@ class Room(models.Model):
     def __str__(self):
         return "Room " + self.name
 
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            Room.objects.lock(self.pk)
+
+        self.version = bump_rooming_version()
+
+        # Members count is changed only by join and leave with F expressions. Other saves leave
+        # it out, so a room read before the lock doesn't overwrite concurrent changes of it.
+        if kwargs.get("update_fields") is None and not self._state.adding and \
+                not hasattr(self.members_count, "resolve_expression"):
+            kwargs["update_fields"] = {field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key} - {"members_count"}
+
+        if kwargs.get("update_fields") is not None:
+            kwargs["update_fields"] = {*kwargs["update_fields"], "version"}
+
+        super().save(*args, **kwargs)
+
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        # Clients following changes learn about the removed room from its tombstone
+        Room.objects.lock(self.pk)
+        RemovedRoom.objects.create(room_id=self.pk, version=bump_rooming_version())
+
+        return super().delete(*args, **kwargs)
+
     @transaction.atomic
     def join(self, user, sender=None, password=None):
         if sender is None:
@@ -115,6 +217,12 @@ class Room(models.Model):
         if not sender.is_staff and sender != user:
             raise ValidationError(_("Only staff can add other users to rooms."), code="invalid")
 
+        # Lock the user first and then rooms, to check capacity and previous room of the user
+        # against their current state. Joins to other rooms are not blocked.
+        prev_room_id = self._lock_user(user)
+        Room.objects.lock(self.pk, prev_room_id)
+        self.refresh_from_db()
+
         if self.hidden and not sender.is_staff:
             raise ValidationError(_("Cannot join %(room)s, room is unavailable."),
                                   code="invalid",
@@ -132,13 +240,14 @@ class Room(models.Model):
                                   params={"room": self})
 
         # Remove user from previous room
-        prev_room = user.room_of_user.all().first()
-
-        if prev_room is not None:
-            prev_room.leave(user)
+        if prev_room_id is not None:
+            Room.objects.get(pk=prev_room_id).leave(user)
 
         self.members.add(user)
+        self.members_count = F("members_count") + 1
         self.save()
+        self.refresh_from_db(fields=["members_count"])
+        publish_room_event(RoomEventType.JOINED, self)
 
     @transaction.atomic
     def leave(self, user, sender=None):
@@ -149,13 +258,21 @@ class Room(models.Model):
             raise ValidationError(_("Only staff can remove other users from rooms."),
                                   code="invalid")
 
+        self._lock_user(user)
+        Room.objects.lock(self.pk)
+        self.refresh_from_db()
+
         try:
             self.unlock(user, True)
         except ValidationError:
             pass
 
-        self.members.remove(user)
+        if self.userroom_set.filter(user=user).delete()[0] > 0:
+            self.members_count = F("members_count") - 1
+
         self.save()
+        self.refresh_from_db(fields=["members_count"])
+        publish_room_event(RoomEventType.LEFT, self)
 
     @transaction.atomic
     def set_lock(self, owner, sender=None, expiration_date=None):
@@ -165,6 +282,9 @@ class Room(models.Model):
         if not sender.is_staff and sender != owner:
             raise ValidationError(_("Only staff can lock rooms for other users."), code="invalid")
 
+        Room.objects.lock(self.pk)
+        self.refresh_from_db()
+
         if not self.members.filter(pk__exact=owner.pk).exists():
             raise ValidationError(_("Cannot lock %(room)s, user must first join the room."),
                                   code="invalid",
@@ -183,9 +303,13 @@ class Room(models.Model):
         self.lock = RoomLock.objects.make(owner, expiration_date=expiration_date)
         self.lock.save()
         self.save()
+        publish_room_event(RoomEventType.LOCKED, self)
 
     @transaction.atomic
     def unlock(self, sender, leaving=False):
+        Room.objects.lock(self.pk)
+        self.refresh_from_db()
+
         if self.is_locked:
             if not self.lock.is_owned_by(sender) and (not sender.is_staff or leaving):
                 raise ValidationError(_("Cannot unlock %(room)s, lock belongs to other user."),
@@ -196,6 +320,26 @@ class Room(models.Model):
             self.lock = None
             self.save()
             lock.delete()
+            publish_room_event(RoomEventType.UNLOCKED, self)
+
+    @transaction.atomic
+    def hide(self):
+        self.hidden = True
+        self.save()
+        publish_room_event(RoomEventType.HIDDEN, self)
+
+    @transaction.atomic
+    def unhide(self):
+        self.hidden = False
+        self.save()
+        publish_room_event(RoomEventType.UNHIDDEN, self)
+
+    @staticmethod
+    def _lock_user(user):
+        """Locks the user and returns id of the room they are in."""
+        User.objects.select_for_update().filter(pk=user.pk).exists()
+
+        return UserRoom.objects.filter(user=user).values_list("room", flat=True).first()
 
     @staticmethod
     def name_to_key_orderable(room):
@@ -204,6 +348,15 @@ class Room(models.Model):
         return tuple(int(g) if re.match(r"\d+", g) else g for g in groups)
 
 
+class RemovedRoom(models.Model):
+    """Tombstone of a deleted room, tagged with the rooming version of its removal."""
+    room_id = models.PositiveIntegerField(unique=True)
+    version = models.PositiveBigIntegerField(db_index=True)
+
+    def __str__(self):
+        return f"Removed room {self.room_id}"
+
+
 class UserRoom(models.Model):
     room = models.ForeignKey(Room, on_delete=models.CASCADE)
     user = models.OneToOneField(User, on_delete=models.CASCADE)
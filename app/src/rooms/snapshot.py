@@ -0,0 +1,68 @@
+import gzip
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+
+from rooms.models import Room
+
+SNAPSHOT_CACHE_KEY = "rooms.snapshot"
+
+
+def room_fragment(room):
+    """Returns the part of snapshot describing a single room, with lists instead of objects
+    for beds and members to keep it small."""
+    # Expiring locks don't bump the rooming version, so clients compare the time themselves
+    lock = room.lock
+
+    return {
+        "id": room.pk,
+        "name": room.name,
+        "description": room.description,
+        "beds": [room.available_beds_single, room.available_beds_double],
+        "capacity": room.capacity,
+        "occupancy": room.members_count,
+        "locked_until": lock.expiration_date.isoformat() if lock is not None else None,
+        "members": [[member.user_id, member.user.first_name, member.user.last_name]
+                    for member in room.userroom_set.all()],
+    }
+
+
+def _read_fragments(rooms):
+    rooms = rooms.select_related("lock").prefetch_related("userroom_set__user")
+
+    return {room.pk: (room.version, room_fragment(room)) for room in rooms}
+
+
+def build_snapshot(version, previous=None):
+    """Returns snapshot of all visible rooms tagged with rooming version.
+
+    Only rooms changed since the previous snapshot are read again, fragments of other rooms are
+    reused. The body is gzipped once here, so it's served as it is.
+    """
+    if previous is None:
+        fragments = _read_fragments(Room.objects.all_visible())
+    else:
+        versions = dict(Room.objects.all_visible().values_list("pk", "version"))
+        fragments = {pk: previous["rooms"][pk] for pk, room_version in versions.items()
+                     if previous["rooms"].get(pk, (None,))[0] == room_version}
+        fragments.update(_read_fragments(
+            Room.objects.filter(pk__in=versions.keys() - fragments.keys())))
+
+    body = json.dumps({"version": version,
+                       "rooms": [fragments[pk][1] for pk in sorted(fragments)]},
+                      separators=(",", ":"))
+
+    return {"version": version, "rooms": fragments,
+            "body": gzip.compress(body.encode(), mtime=0)}
+
+
+def get_snapshot(version):
+    """Returns cached snapshot of rooms for rooming version, rebuilt when it's outdated."""
+    snapshot = cache.get(SNAPSHOT_CACHE_KEY)
+
+    if snapshot is None or snapshot["version"] != version:
+        snapshot = build_snapshot(version, snapshot)
+        cache.set(SNAPSHOT_CACHE_KEY, snapshot, settings.ROOMS_SNAPSHOT_CACHE_TIMEOUT)
+
+    return snapshot
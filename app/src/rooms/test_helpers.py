@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 from unittest import TestCase
 
-from rooms.models import Room
+from rooms.models import Room, RoomLock, UserRoom
+from utils.test_helpers import create_users_in_bulk
+from utils.time_manager import timedelta_since_now
 
 
 def create_room(number, capacity=0, commit=True, **override):
@@ -15,6 +17,24 @@ def create_room(number, capacity=0, commit=True, **override):
     return room
 
 
+def create_locked_rooms_with_members(count):
+    """Creates count rooms in bulk, each with one member who also holds the room lock."""
+    users = create_users_in_bulk(count)
+    locks = RoomLock.objects.bulk_create([
+        RoomLock(user=user, password="1234", expiration_date=timedelta_since_now(hours=1))
+        for user in users
+    ])
+    rooms = Room.objects.bulk_create([
+        Room(name=f"Bulk {i}", beds_double=1, available_beds_double=1, members_count=1,
+             lock=lock)
+        for i, lock in enumerate(locks)
+    ])
+    UserRoom.objects.bulk_create([UserRoom(room=room, user=user)
+                                  for room, user in zip(rooms, users)])
+
+    return rooms
+
+
 class RoomAssertions(TestCase):
     def assertEmpty(self, room):
         self.assertEqual(room.members_count, 0)
@@ -1,8 +1,31 @@
+from collections import Counter, defaultdict
+import io
+import queue
+import random
+import threading
+import time
+from unittest import skipUnless
+
+from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.test import TestCase
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, modify_settings, override_settings
+from django.urls import reverse
 
+from rooms.allocation import RoomAllocator
+from rooms.events import PostgresBroadcaster, get_broadcaster
+from rooms.importer import MAX_REPORTED_ERRORS, import_rooms
+from rooms.management.commands.rooming_loadtest import create_session_cookie
+from rooms.models import Room, UserRoom, current_rooming_version
+from rooms.snapshot import get_snapshot
 from rooms.test_helpers import RoomAssertions, create_room
-from utils.test_helpers import create_user
+from users.models import UserPreferences
+from utils.constants import CSV_CHUNK_SIZE, RoomEventType
+from utils.test_helpers import create_organization, create_user, create_user_preferences, \
+    create_users_in_bulk, create_zosia, login_as_user, report_benchmark
 from utils.time_manager import timedelta_since_now
 
 room_assertions = RoomAssertions()
@@ -71,6 +94,7 @@ class RoomTestCase(TestCase):
     def test_user_can_join_another_room_leaving_previous_room(self):
         self.room_1.join(self.normal_1)
         self.room_2.join(self.normal_1)
+        self.refresh()
         self.assertEqual(self.room_1.members_count, 0)
         room_assertions.assertJoined(self.normal_1, self.room_2)
 
@@ -251,3 +275,786 @@ class RoomTestCase(TestCase):
         room_assertions.assertLocked(self.room_3, self.normal_1)
 
     # endregion
+
+
+class RoomMembersCountTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.normal_1 = create_user(0)
+        self.normal_2 = create_user(1)
+        self.room_1 = create_room(111, capacity=2)
+        self.room_2 = create_room(222, capacity=1)
+
+    def assertMembersCount(self, room, count):
+        self.assertEqual(room.members_count, count)
+        room.refresh_from_db()
+        self.assertEqual(room.members_count, count)
+
+    def test_join_increments_members_count(self):
+        self.room_1.join(self.normal_1)
+        self.room_1.join(self.normal_2)
+
+        self.assertMembersCount(self.room_1, 2)
+
+    def test_leave_decrements_members_count(self):
+        self.room_1.join(self.normal_1)
+        self.room_1.join(self.normal_2)
+
+        self.room_1.leave(self.normal_1)
+
+        self.assertMembersCount(self.room_1, 1)
+
+    def test_leave_by_non_member_keeps_members_count(self):
+        self.room_1.join(self.normal_1)
+
+        self.room_1.leave(self.normal_2)
+
+        self.assertMembersCount(self.room_1, 1)
+
+    def test_changing_room_moves_members_count(self):
+        self.room_1.join(self.normal_1)
+
+        self.room_2.join(self.normal_1)
+        self.room_1.refresh_from_db()
+
+        self.assertMembersCount(self.room_1, 0)
+        self.assertMembersCount(self.room_2, 1)
+
+    def test_stale_room_does_not_overwrite_members_count(self):
+        stale = Room.objects.get(pk=self.room_1.pk)
+        self.room_1.join(self.normal_1)
+
+        stale.hide()
+
+        stale.refresh_from_db()
+        self.assertTrue(stale.hidden)
+        self.assertEqual(stale.members_count, 1)
+
+    def test_is_full_does_not_query_database(self):
+        self.room_2.join(self.normal_1)
+
+        with self.assertNumQueries(0):
+            self.assertTrue(self.room_2.is_full)
+
+
+class RebuildMembersCountCommandTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.normal_1 = create_user(0)
+        self.normal_2 = create_user(1)
+        self.room_1 = create_room(111, capacity=2)
+        self.room_2 = create_room(222, capacity=1)
+
+        self.room_1.join(self.normal_1)
+        # Changes made outside of join and leave, e.g. in admin, don't update the counters
+        UserRoom.objects.create(room=self.room_1, user=self.normal_2)
+        Room.objects.filter(pk=self.room_2.pk).update(members_count=3)
+
+    def test_check_reports_wrong_counts(self):
+        out = io.StringIO()
+
+        with self.assertRaises(CommandError):
+            call_command("rebuild_members_count", check=True, stdout=out)
+
+        self.assertIn("Room 111: members count is 1, but room has 2 members", out.getvalue())
+        self.assertIn("Room 222: members count is 3, but room has 0 members", out.getvalue())
+        self.room_1.refresh_from_db()
+        self.assertEqual(self.room_1.members_count, 1)
+
+    def test_rebuild_fixes_wrong_counts(self):
+        call_command("rebuild_members_count", stdout=io.StringIO())
+
+        self.room_1.refresh_from_db()
+        self.room_2.refresh_from_db()
+        self.assertEqual(self.room_1.members_count, 2)
+        self.assertEqual(self.room_2.members_count, 0)
+        call_command("rebuild_members_count", check=True, stdout=io.StringIO())
+
+    def test_rebuilt_rooms_are_in_snapshot(self):
+        get_snapshot(current_rooming_version())
+
+        call_command("rebuild_members_count", stdout=io.StringIO())
+
+        self.room_1.refresh_from_db()
+        self.room_2.refresh_from_db()
+        self.assertEqual(self.room_1.version, current_rooming_version())
+        self.assertEqual(self.room_2.version, current_rooming_version())
+        snapshot = get_snapshot(current_rooming_version())
+        self.assertEqual(snapshot["rooms"][self.room_1.pk][1]["occupancy"], 2)
+        self.assertEqual(snapshot["rooms"][self.room_2.pk][1]["occupancy"], 0)
+
+
+@skipUnless(connection.vendor == "postgresql", "Row locking requires Postgres")
+class RoomConcurrencyTestCase(TransactionTestCase):
+    THREADS_COUNT = 24
+
+    def run_concurrently(self, operations):
+        """Runs all operations at the same moment, each in its own thread and database connection.
+        Returns errors raised by operations and the time it took."""
+        barrier = threading.Barrier(len(operations))
+        errors = []
+
+        def run(operation):
+            try:
+                barrier.wait()
+                operation()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(operation,)) for operation in operations]
+        start = time.perf_counter()
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.perf_counter() - start
+        report_benchmark(self, f"{len(operations)} operations in {elapsed:.3f}s, "
+                               f"{len(operations) / elapsed:.1f} operations per second")
+
+        return errors, elapsed
+
+    def test_concurrent_joins_never_exceed_capacity(self):
+        room = create_room(111, capacity=5)
+        users = create_users_in_bulk(self.THREADS_COUNT)
+
+        errors, _ = self.run_concurrently([lambda user=user: room.join(user) for user in users])
+
+        room.refresh_from_db()
+        self.assertEqual(UserRoom.objects.filter(room=room).count(), room.capacity)
+        self.assertEqual(room.members_count, room.capacity)
+        self.assertEqual(len(errors), self.THREADS_COUNT - room.capacity)
+        self.assertTrue(all(isinstance(error, ValidationError) for error in errors))
+
+    def test_concurrent_joins_to_different_rooms_all_succeed(self):
+        rooms = [create_room(number, capacity=1) for number in range(self.THREADS_COUNT)]
+        users = create_users_in_bulk(self.THREADS_COUNT)
+
+        errors, _ = self.run_concurrently([lambda room=room, user=user: room.join(user)
+                                           for room, user in zip(rooms, users)])
+
+        self.assertEqual(errors, [])
+        self.assertEqual(UserRoom.objects.count(), self.THREADS_COUNT)
+        self.assertEqual(list(Room.objects.with_wrong_members_count()), [])
+
+    def test_users_swapping_rooms_do_not_deadlock(self):
+        room_1 = create_room(111, capacity=self.THREADS_COUNT)
+        room_2 = create_room(222, capacity=self.THREADS_COUNT)
+        users = create_users_in_bulk(self.THREADS_COUNT)
+
+        for i, user in enumerate(users):
+            (room_1 if i % 2 else room_2).join(user)
+
+        errors, _ = self.run_concurrently([
+            lambda user=user, target=(room_2 if i % 2 else room_1): target.join(user)
+            for i, user in enumerate(users)
+        ])
+
+        self.assertEqual(errors, [])
+        self.assertEqual(UserRoom.objects.filter(room=room_1).count(), self.THREADS_COUNT // 2)
+        self.assertEqual(UserRoom.objects.filter(room=room_2).count(), self.THREADS_COUNT // 2)
+        self.assertEqual(list(Room.objects.with_wrong_members_count()), [])
+
+    def hold_change(self, room):
+        """Saves room in a transaction left open in another thread until the returned event is
+        set. Returns the event and the thread."""
+        saved, release = threading.Event(), threading.Event()
+
+        def run():
+            try:
+                with transaction.atomic():
+                    room.save()
+                    saved.set()
+                    release.wait(timeout=10)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        saved.wait(timeout=10)
+
+        return release, thread
+
+    def test_changes_are_committed_in_order_of_versions(self):
+        room_1, room_2 = create_room(111), create_room(222)
+        cursor = current_rooming_version()
+        release, thread = self.hold_change(room_1)
+        saving = threading.Thread(target=lambda: self.run_concurrently([room_2.save]))
+        saving.start()
+
+        # The later change waits for the open transaction, so its version isn't visible first
+        saving.join(timeout=0.5)
+        self.assertTrue(saving.is_alive())
+        self.assertEqual(current_rooming_version(), cursor)
+
+        release.set()
+        thread.join()
+        saving.join()
+
+        room_1.refresh_from_db()
+        room_2.refresh_from_db()
+        self.assertLess(room_1.version, room_2.version)
+        self.assertEqual(current_rooming_version(), room_2.version)
+
+    def test_reader_following_changes_sees_every_change(self):
+        rooms = [create_room(number) for number in range(self.THREADS_COUNT)]
+        start = current_rooming_version()
+        seen = {}
+        finished = threading.Event()
+
+        def follow():
+            cursor = start
+
+            try:
+                while True:
+                    # Checked before reading, so the last pass reads all finished changes
+                    done = finished.is_set()
+                    next_cursor = current_rooming_version()
+                    seen.update(Room.objects.filter(version__gt=cursor)
+                                .values_list("pk", "version"))
+                    cursor = next_cursor
+
+                    if done:
+                        return
+            finally:
+                connection.close()
+
+        reader = threading.Thread(target=follow)
+        reader.start()
+        errors, _ = self.run_concurrently([room.save for room in rooms])
+        finished.set()
+        reader.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(seen, dict(Room.objects.values_list("pk", "version")))
+
+
+class RoomingScheduleViewTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.zosia = create_zosia(active=True, rooming_start=timedelta_since_now(minutes=20))
+        self.normal_1 = create_user(0)
+        self.normal_2 = create_user(1)
+        self.staff_1 = create_user(2, is_staff=True)
+        self.url = reverse("rooms_rooming_schedule")
+
+        create_user_preferences(self.normal_1, self.zosia, payment_accepted=True,
+                                bonus_minutes=10)
+        create_user_preferences(self.normal_2, self.zosia, payment_accepted=True)
+        create_user_preferences(self.staff_1, self.zosia)
+
+    def test_normal_user_cannot_see_schedule(self):
+        login_as_user(self.normal_1, self.client)
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 302)
+
+    def test_staff_sees_users_opening_in_next_minutes(self):
+        login_as_user(self.staff_1, self.client)
+
+        response = self.client.get(self.url, {"minutes": 15})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([users for _, users in response.context["waves"]], [[self.normal_1]])
+        self.assertEqual(response.context["opened_count"], 0)
+        self.assertEqual(response.context["unavailable_count"], 1)
+
+    def test_staff_sees_waves_ordered_by_opening_time(self):
+        login_as_user(self.staff_1, self.client)
+
+        response = self.client.get(self.url, {"minutes": 30})
+
+        self.assertEqual([users for _, users in response.context["waves"]],
+                         [[self.normal_1], [self.normal_2]])
+
+
+class RoomCsvTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.zosia = create_zosia(active=True)
+        self.staff_1 = create_user(0, is_staff=True)
+        self.room_1 = create_room(111, capacity=20)
+        self.room_2 = create_room(222, capacity=20)
+        users = create_users_in_bulk(20)
+
+        for user in users:
+            create_user_preferences(user, self.zosia, payment_accepted=True)
+
+        UserRoom.objects.bulk_create([UserRoom(room=self.room_1, user=user)
+                                      for user in users[:10]])
+        login_as_user(self.staff_1, self.client)
+
+    def read_csv(self, url_name, queries):
+        # Session and user of the sender are queried on top of queries made by the export
+        with self.assertNumQueries(queries + 2):
+            response = self.client.get(reverse(url_name))
+            content = b"".join(response.streaming_content).decode()
+
+        return [line.split(",", 1) for line in content.splitlines()]
+
+    def test_rooms_by_user_are_read_with_single_query(self):
+        create_user_preferences(self.staff_1, self.zosia)
+
+        rows = self.read_csv("list_csv_room_by_user", 1)
+
+        self.assertEqual(len(rows), 22)
+        self.assertIn(["User0 Bulk", "Room 111,True"], rows)
+        self.assertIn(["User19 Bulk", ",True"], rows)
+
+    def test_rooms_by_member_are_read_with_single_query(self):
+        rows = self.read_csv("list_csv_room_by_member", 1)
+
+        self.assertEqual(rows[0], ["User", "Room"])
+        self.assertEqual(len(rows), 11)
+        self.assertTrue(all(room == "Room 111" for _, room in rows[1:]))
+
+    def test_members_by_room_are_read_with_two_queries(self):
+        rows = self.read_csv("list_csv_members_by_room", 2)
+
+        self.assertEqual(rows[1][0], "Room 111")
+        self.assertEqual(rows[1][1].count("Bulk"), 10)
+        self.assertEqual(rows[2], ["Room 222", ""])
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class RoomsIndexViewTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.zosia = create_zosia(active=True, rooming_start=timedelta_since_now(minutes=-10))
+        self.normal_1 = create_user(0)
+        self.normal_2 = create_user(1)
+        self.preferences_1 = create_user_preferences(self.normal_1, self.zosia,
+                                                     payment_accepted=True,
+                                                     accommodation_day_1=True)
+        create_user_preferences(self.normal_2, self.zosia, payment_accepted=True,
+                                accommodation_day_1=True)
+        self.room_1 = create_room(111, capacity=2)
+        self.url = reverse("rooms_index")
+
+    def tearDown(self):
+        cache.clear()
+        super().tearDown()
+
+    def test_eligibility_is_checked_on_every_request(self):
+        login_as_user(self.normal_1, self.client)
+
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+        self.preferences_1.payment_accepted = False
+        self.preferences_1.save()
+
+        self.assertEqual(self.client.get(self.url).status_code, 302)
+
+
+class RoomAllocatorTestCase(TestCase):
+    DAYS = (True, True, True)
+
+    def participant(self, pk, organization=None, days=DAYS):
+        return {"pk": pk, "organization": organization, "days": days}
+
+    def test_organization_is_kept_together(self):
+        rooms = [{"pk": 1, "free": 2, "members": []}, {"pk": 2, "free": 3, "members": []}]
+        participants = [self.participant(1), self.participant(2, 7), self.participant(3, 7),
+                        self.participant(4, 7)]
+
+        assignment, unplaced = RoomAllocator(rooms, participants).solve()
+
+        self.assertEqual(assignment, {1: 1, 2: 2, 3: 2, 4: 2})
+        self.assertEqual(unplaced, [])
+
+    def test_participants_join_their_organization_and_partially_occupied_rooms(self):
+        rooms = [{"pk": 1, "free": 2, "members": []},
+                 {"pk": 2, "free": 1, "members": [(None, self.DAYS)]},
+                 {"pk": 3, "free": 1, "members": [(7, self.DAYS)]}]
+        participants = [self.participant(1), self.participant(2, 7)]
+
+        assignment, unplaced = RoomAllocator(rooms, participants).solve()
+
+        self.assertEqual(assignment, {1: 2, 2: 3})
+
+    def test_local_search_puts_participants_staying_on_the_same_days_together(self):
+        short = (True, False, False)
+        rooms = [{"pk": 1, "free": 2, "members": [(None, short)]},
+                 {"pk": 2, "free": 2, "members": [(None, self.DAYS)]}]
+        participants = [self.participant(1, days=short), self.participant(2),
+                        self.participant(3, days=short), self.participant(4)]
+
+        assignment, unplaced = RoomAllocator(rooms, participants).solve()
+
+        self.assertEqual(assignment, {1: 1, 3: 1, 2: 2, 4: 2})
+
+    def test_participants_without_free_places_are_unplaced(self):
+        rooms = [{"pk": 1, "free": 1, "members": []}]
+
+        assignment, unplaced = RoomAllocator(
+            rooms, [self.participant(1), self.participant(2)]).solve()
+
+        self.assertEqual(len(assignment), 1)
+        self.assertEqual(len(unplaced), 1)
+
+    def test_hundreds_of_participants_are_allocated_quickly(self):
+        rng = random.Random(0)
+        rooms = [{"pk": pk, "free": rng.choice([2, 3, 4]),
+                  "members": [(rng.randint(1, 20), self.DAYS)] if pk <= 30 else []}
+                 for pk in range(1, 101)]
+        participants = []
+        organization = 100
+
+        while len(participants) < 300:
+            size = rng.choice([1, 1, 2, 3, 4])
+            days = (True, True, rng.random() < 0.8)
+            participants.extend(
+                self.participant(len(participants) + 1, organization if size > 1 else None, days)
+                for _ in range(size))
+            organization += 1
+
+        start = time.process_time()
+        assignment, unplaced = RoomAllocator(rooms, participants).solve()
+        elapsed = time.process_time() - start
+
+        report_benchmark(self, f"{len(participants)} participants in {len(rooms)} rooms "
+                               f"allocated in {elapsed:.3f}s")
+        self.assertLess(elapsed, 1)
+        self.assertEqual(unplaced, [])
+        free = {room["pk"]: room["free"] for room in rooms}
+        self.assertFalse([room for room, count in Counter(assignment.values()).items()
+                          if count > free[room]])
+        organization_rooms = defaultdict(set)
+
+        for participant in participants:
+            if participant["organization"] is not None:
+                organization_rooms[participant["organization"]].add(
+                    assignment[participant["pk"]])
+
+        self.assertEqual([rooms for rooms in organization_rooms.values() if len(rooms) > 1], [])
+
+
+class RoomAllocationViewTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.zosia = create_zosia(active=True, rooming_start=timedelta_since_now(days=-2),
+                                  rooming_end=timedelta_since_now(days=-1))
+        self.staff = create_user(0, is_staff=True)
+        self.users = create_users_in_bulk(5)
+        organization = create_organization("Org")
+
+        for i, user in enumerate(self.users):
+            create_user_preferences(user, self.zosia, payment_accepted=i < 4,
+                                    accommodation_day_1=True,
+                                    organization=organization if i < 2 else None)
+
+        self.room_1 = create_room(111, capacity=2)
+        self.room_2 = create_room(222, capacity=3)
+        self.room_3 = create_room(333, capacity=4, hidden=True)
+        self.room_4 = create_room(444, capacity=4)
+        self.room_4.join(self.staff)
+        self.room_4.set_lock(self.staff)
+        self.room_2.join(self.users[2])
+        login_as_user(self.staff, self.client)
+
+    def members(self, room):
+        return set(room.members.values_list("pk", flat=True))
+
+    def test_preview_does_not_change_rooms(self):
+        response = self.client.get(reverse("rooms_allocation"))
+
+        assignment = response.context["allocation"]["assignment"]
+        # Unpaid participant is skipped, hidden and locked rooms aren't used
+        self.assertEqual(set(assignment), {self.users[0].pk, self.users[1].pk, self.users[3].pk})
+        self.assertEqual(set(assignment.values()), {self.room_1.pk, self.room_2.pk})
+        self.assertEqual(assignment[self.users[0].pk], assignment[self.users[1].pk])
+        self.assertEqual(response.context["allocation"]["unplaced"], [])
+        self.assertEqual(self.members(self.room_1), set())
+
+    def test_previewed_allocation_is_applied(self):
+        response = self.client.get(reverse("rooms_allocation"))
+        form, assignment = response.context["form"], response.context["allocation"]["assignment"]
+        version = Room.objects.get(pk=self.room_1.pk).version
+
+        response = self.client.post(reverse("rooms_allocation_apply"), {
+            "users": form["users"].value(), "rooms": form["rooms"].value()})
+
+        self.assertRedirects(response, reverse("rooms_allocation"))
+        self.assertEqual(dict(UserRoom.objects.filter(user__in=assignment.keys())
+                              .values_list("user", "room")), assignment)
+        self.room_1.refresh_from_db()
+        self.room_2.refresh_from_db()
+        self.assertEqual(self.room_1.members_count + self.room_2.members_count, 4)
+        self.assertEqual(self.room_1.members_count, len(self.members(self.room_1)))
+        self.assertGreater(self.room_1.version, version)
+
+    def test_nothing_is_applied_if_a_user_has_joined_a_room_since_preview(self):
+        form = self.client.get(reverse("rooms_allocation")).context["form"]
+        self.room_2.join(self.users[0], sender=self.staff)
+
+        self.client.post(reverse("rooms_allocation_apply"), {
+            "users": form["users"].value(), "rooms": form["rooms"].value()})
+
+        self.assertEqual(self.members(self.room_1), set())
+        self.assertEqual(self.members(self.room_2), {self.users[0].pk, self.users[2].pk})
+        self.assertEqual(Room.objects.get(pk=self.room_2.pk).members_count, 2)
+
+    def apply_preview_after(self, change):
+        form = self.client.get(reverse("rooms_allocation")).context["form"]
+        change()
+
+        self.client.post(reverse("rooms_allocation_apply"), {
+            "users": form["users"].value(), "rooms": form["rooms"].value()})
+
+        self.assertEqual(self.members(self.room_1), set())
+        self.assertEqual(self.members(self.room_2), {self.users[2].pk})
+
+    def test_nothing_is_applied_if_a_room_was_hidden_since_preview(self):
+        self.apply_preview_after(self.room_1.hide)
+
+    def test_nothing_is_applied_if_a_room_was_locked_since_preview(self):
+        self.apply_preview_after(lambda: self.room_2.set_lock(self.users[2]))
+
+    def test_nothing_is_applied_if_a_payment_was_withdrawn_since_preview(self):
+        self.apply_preview_after(lambda: UserPreferences.objects.filter(
+            user=self.users[3], zosia=self.zosia).update(payment_accepted=False))
+
+    def test_rooms_are_not_allocated_before_rooming_is_over(self):
+        self.zosia.rooming_end = timedelta_since_now(days=1)
+        self.zosia.save()
+
+        self.client.post(reverse("rooms_allocation_apply"), {
+            "users": str(self.users[0].pk), "rooms": str(self.room_1.pk)})
+
+        self.assertEqual(self.members(self.room_1), set())
+
+
+class RoomImportTestCase(TestCase):
+    HEADER = "Name,Description,Hidden,AvailableBedsSingle,AvailableBedsDouble,ActualBedsSingle," \
+             "ActualBedsDouble\n"
+
+    def setUp(self):
+        super().setUp()
+        self.staff = create_user(0, is_staff=True)
+        self.normal = create_user(1)
+        self.room = create_room(111, capacity=2, description="Old")
+        self.room.join(self.normal)
+        login_as_user(self.staff, self.client)
+
+    def post(self, content, dry_run=False):
+        return self.client.post(reverse("rooms_import"), {
+            "file": SimpleUploadedFile("rooms.csv", (self.HEADER + content).encode()),
+            "dry_run": dry_run,
+        })
+
+    def rooms(self):
+        return list(Room.objects.order_by("name").values_list(
+            "name", "description", "hidden", "available_beds_single", "available_beds_double",
+            "beds_single", "beds_double"))
+
+    def test_rooms_are_added_and_updated_by_name(self):
+        version = Room.objects.get(pk=self.room.pk).version
+
+        response = self.post("111,New,False,1,1,1,1\n222,Balcony,True,2,0,1,1\n")
+
+        self.assertRedirects(response, reverse("admin"))
+        self.assertEqual(self.rooms(), [("111", "New", False, 1, 1, 1, 1),
+                                        ("222", "Balcony", True, 2, 0, 1, 1)])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.members_count, 1)
+        self.assertGreater(self.room.version, version)
+        self.assertEqual(Room.objects.get(name="222").version, self.room.version)
+
+    def test_reimport_does_not_duplicate_rooms(self):
+        self.post("222,Balcony,True,2,0,1,1\n")
+        self.post("222,Balcony,True,2,0,1,1\n")
+
+        self.assertEqual(Room.objects.filter(name="222").count(), 1)
+
+    def test_errors_are_reported_per_line_and_nothing_is_imported(self):
+        response = self.post("222,Ok,False,1,0,1,0\n"
+                             "333,Too many,False,43,0,43,0\n"
+                             "444,Hidden?,maybe,1,0,1,0\n"
+                             "555,Columns,False,1\n"
+                             "666,Beds,False,3,0,1,1\n"
+                             "111,Members,False,0,0,1,0\n"
+                             "222,Again,False,1,0,1,0\n")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([error["line"] for error in response.context["report"]["errors"]],
+                         [3, 4, 5, 6, 7, 8])
+        self.assertEqual(response.context["report"]["errors"][-1]["message"],
+                         "Room 222 is already on line 2")
+        self.assertEqual(self.rooms(), [("111", "Old", False, 2, 0, 2, 0)])
+
+    def test_only_first_errors_are_reported(self):
+        rows = "".join(f"{number},,False,1,0,0,0\n" for number in range(200, 350))
+
+        response = self.post(rows)
+
+        report = response.context["report"]
+        self.assertEqual(len(report["errors"]), MAX_REPORTED_ERRORS)
+        self.assertEqual((report["errors_count"], report["hidden_count"]),
+                         (150, 150 - MAX_REPORTED_ERRORS))
+        self.assertContains(response, "there are errors in 150 lines, 50 of them are not shown")
+
+    def test_dry_run_reports_changes_without_importing(self):
+        response = self.post("111,New,False,2,0,2,0\n222,Balcony,False,1,0,1,0\n",
+                             dry_run=True)
+
+        report = response.context["report"]
+        self.assertEqual((report["created"], report["updated"], report["errors"]), (1, 1, []))
+        self.assertEqual(self.rooms(), [("111", "Old", False, 2, 0, 2, 0)])
+
+    def test_rooms_are_imported_in_batches(self):
+        rows = "".join(f"{number},,False,1,0,1,0\n" for number in range(200, 235))
+
+        # Each of 4 batches reads existing rooms and creates them, the first one also updates
+        # room 111, then rooming version is bumped and rooms are tagged with it, in a savepoint
+        with self.assertNumQueries(4 * 2 + 1 + 2 + 2):
+            report = import_rooms(io.StringIO("111,,False,2,0,2,0\n" + rows), batch_size=10)
+
+        self.assertEqual((report["created"], report["updated"]), (35, 1))
+        self.assertEqual(Room.objects.count(), 36)
+
+    def test_import_of_many_rooms(self):
+        rows = "".join(f"{number},Room {number},False,2,1,2,1\n" for number in range(1000, 6000))
+
+        batches = 5000 // CSV_CHUNK_SIZE
+        start = time.process_time()
+
+        # Each batch looks up existing rooms and creates new ones, then all of them are tagged
+        # with a version, inside a savepoint of the test
+        with self.assertNumQueries(2 * batches + 4):
+            report = import_rooms(io.StringIO(rows))
+
+        elapsed = time.process_time() - start
+
+        report_benchmark(self, f"imported 5000 rooms in {elapsed:.3f} s of processor time")
+        self.assertEqual(report["created"], 5000)
+        # Processor time of this process only, so a slow database or machine doesn't fail it
+        self.assertLess(elapsed, 20)
+
+
+@modify_settings(MIDDLEWARE={"prepend": "utils.query_count.QueryCountMiddleware"})
+class RoomingLoadTestTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.zosia = create_zosia(active=True)
+        self.normal_1 = create_user(0)
+        create_user_preferences(self.normal_1, self.zosia, payment_accepted=True)
+        create_room(111)
+
+    def test_session_cookie_logs_user_in_and_queries_are_reported(self):
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = create_session_cookie(self.normal_1)
+
+        response = self.client.get(reverse("rooms_api2_list"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(int(response["X-Query-Count"]), 0)
+
+
+@override_settings(ROOMS_EVENTS_ENABLED=True)
+class RoomEventsTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.normal_1 = create_user(0)
+        self.staff_1 = create_user(2, is_staff=True)
+        self.room_1 = create_room(111, capacity=2)
+        self.room_2 = create_room(222, capacity=1)
+        self.subscription = get_broadcaster().subscribe()
+
+    def tearDown(self):
+        get_broadcaster().unsubscribe(self.subscription)
+        super().tearDown()
+
+    def received_events(self):
+        events = []
+
+        while not self.subscription.empty():
+            event = self.subscription.get_nowait()
+            events.append((event["type"], event["room"]))
+
+        return events
+
+    def test_events_are_published_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            self.room_1.join(self.normal_1)
+
+        self.assertEqual(self.received_events(), [])
+
+        for callback in callbacks:
+            callback()
+
+        self.assertEqual(self.received_events(), [(RoomEventType.JOINED, self.room_1.pk)])
+
+    def test_event_is_published_for_each_operation(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room_1.join(self.normal_1)
+            self.room_1.set_lock(self.normal_1)
+            self.room_1.unlock(self.normal_1)
+            self.room_1.hide()
+            self.room_1.unhide()
+            self.room_1.leave(self.normal_1)
+
+        self.assertEqual(self.received_events(), [
+            (RoomEventType.JOINED, self.room_1.pk),
+            (RoomEventType.LOCKED, self.room_1.pk),
+            (RoomEventType.UNLOCKED, self.room_1.pk),
+            (RoomEventType.HIDDEN, self.room_1.pk),
+            (RoomEventType.UNHIDDEN, self.room_1.pk),
+            (RoomEventType.LEFT, self.room_1.pk),
+        ])
+
+    def test_events_are_published_for_both_rooms_when_changing_room(self):
+        self.room_1.join(self.normal_1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room_2.join(self.normal_1)
+
+        self.assertEqual(self.received_events(), [
+            (RoomEventType.LEFT, self.room_1.pk),
+            (RoomEventType.JOINED, self.room_2.pk),
+        ])
+
+    def test_no_event_is_published_for_failed_operation(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(ValidationError):
+                self.room_1.set_lock(self.normal_1)
+
+        self.assertEqual(self.received_events(), [])
+
+    @override_settings(ROOMS_EVENTS_ENABLED=False)
+    def test_no_event_is_published_when_events_are_disabled(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room_1.join(self.normal_1)
+
+        self.assertEqual(self.received_events(), [])
+
+
+@skipUnless(connection.vendor == "postgresql", "LISTEN / NOTIFY requires Postgres")
+class PostgresBroadcasterTestCase(TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.broadcaster = PostgresBroadcaster()
+
+    def tearDown(self):
+        self.broadcaster.close()
+        super().tearDown()
+
+    def test_subscriber_receives_event_published_through_database(self):
+        subscription = self.broadcaster.subscribe()
+        event = {"type": RoomEventType.JOINED, "room": 1, "version": 1}
+
+        # Listener subscribes asynchronously, so keep publishing until it receives something
+        for _ in range(50):
+            self.broadcaster.publish(event)
+
+            try:
+                self.assertEqual(subscription.get(timeout=0.1), event)
+                break
+            except queue.Empty:
+                pass
+        else:
+            self.fail("Event has not been received")
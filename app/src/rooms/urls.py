@@ -4,6 +4,9 @@ from rooms import views
 
 urlpatterns = [
     path('', views.index, name='rooms_index'),
+    path('schedule/', views.rooming_schedule, name='rooms_rooming_schedule'),
+    path('allocation/', views.allocation, name='rooms_allocation'),
+    path('allocation/apply/', views.allocate_rooms, name='rooms_allocation_apply'),
     path('list/room_by_user', views.list_csv_room_by_user, name='list_csv_room_by_user'),
     path('list/room_by_member', views.list_csv_room_by_member, name='list_csv_room_by_member'),
     path('list/members_by_room', views.list_csv_members_by_room,
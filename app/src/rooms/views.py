@@ -1,35 +1,36 @@
-import csv
+from collections import defaultdict
 from io import TextIOWrapper
-import json
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ValidationError
+from django.db.models import Prefetch
 from django.http import HttpResponseRedirect
 from django.shortcuts import redirect, render, reverse
 from django.utils.translation import ugettext_lazy as _
-from django.views.decorators.cache import cache_page
 from django.views.decorators.http import require_http_methods
-from django.views.decorators.vary import vary_on_cookie
 
 from conferences.models import Zosia
-from rooms.forms import UploadFileForm
+from rooms.allocation import apply_allocation, make_allocation
+from rooms.forms import RoomAllocationForm, UploadFileForm
+from rooms.importer import import_rooms
 from rooms.models import Room
-from rooms.serializers import room_to_dict
-from users.models import UserPreferences
+from users.models import User, UserPreferences
+from utils.constants import CSV_CHUNK_SIZE, DELIMITER
+from utils.forms import errors_format
+from utils.time_manager import now, timedelta_since
 from utils.views import csv_response, validation_format
 
 
-@cache_page(60 * 15)  # Cache hard (15mins)
-@vary_on_cookie
 @login_required
 @require_http_methods(['GET'])
 def index(request):
     # Return HTML w/ rooms layout
-    try:
-        zosia = Zosia.objects.get(active=True)
-    except Zosia.DoesNotExist:
+    zosia = Zosia.objects.find_active()
+
+    if zosia is None:
         messages.error(request, _('There is no active conference'))
         return redirect(reverse('index'))
 
@@ -62,89 +63,151 @@ def index(request):
         messages.error(request, _('Room registration is over'))
         return redirect(reverse('accounts_profile'))
 
-    rooms = Room.objects.all_visible().prefetch_related('members').all()
-    rooms = sorted(rooms, key=lambda x: x.pk)
-    rooms_json = json.dumps(list(map(room_to_dict, rooms)))
+    # Rooms are loaded by the page from the snapshot endpoint
+    return render(request, 'rooms/index.html', {'rooms_events': settings.ROOMS_EVENTS_ENABLED})
+
+
+@staff_member_required
+@require_http_methods(['GET'])
+def rooming_schedule(request):
+    # Shows users who will be able to choose a room in the next few minutes, grouped by opening
+    # time, so organizers can predict load of the rooming page
+    zosia = Zosia.objects.find_active_or_404()
+
+    try:
+        minutes = max(1, int(request.GET.get('minutes', 30)))
+    except ValueError:
+        minutes = 30
+
+    start = now()
+    end = timedelta_since(start, minutes=minutes)
+    schedule = UserPreferences.objects.rooming_schedule(zosia)
+    opening = {user_id: time for user_id, time in schedule.items()
+               if time is not None and start <= time < end}
+    users = User.objects.in_bulk(opening.keys())
+    waves = defaultdict(list)
+
+    for user_id, time in opening.items():
+        waves[time].append(users[user_id])
+
     context = {
-        'rooms': rooms,
-        'rooms_json': rooms_json,
+        'minutes': minutes,
+        'waves': [(time, sorted(waves[time], key=lambda u: (u.last_name, u.first_name)))
+                  for time in sorted(waves)],
+        'opened_count': sum(1 for time in schedule.values() if time is not None and time < start),
+        'unavailable_count': sum(1 for time in schedule.values() if time is None),
     }
-    return render(request, 'rooms/index.html', context)
+    return render(request, 'rooms/rooming_schedule.html', context)
 
 
 @staff_member_required
 @require_http_methods(['GET'])
-def list_csv_room_by_user(request):
-    prefs = UserPreferences.objects.prefetch_related("user").order_by("user__last_name",
-                                                                      "user__first_name")
-    data_list = [(str(p.user), str(p.room) if p.room else '', str(p.payment_accepted))
-                 for p in prefs]
-    return csv_response(("User", "Room", "Paid"), data_list, filename='list_csv_room_by_user')
+def allocation(request):
+    # Previews placing participants who haven't chosen a room, nothing is changed until applied
+    zosia = Zosia.objects.find_active_or_404()
+    allocation = make_allocation(zosia)
+    assignment = allocation['assignment']
+
+    context = {
+        'allocation': allocation,
+        'form': RoomAllocationForm(initial={'users': list(assignment.keys()),
+                                            'rooms': list(assignment.values())}),
+        'is_rooming_over': zosia.is_rooming_over,
+    }
+    return render(request, 'rooms/allocation.html', context)
 
 
 @staff_member_required
-@require_http_methods(['GET'])
-def list_csv_room_by_member(request):
-    prefs = UserPreferences.objects.prefetch_related("user") \
-        .filter(user__room_of_user__isnull=False).order_by("user__last_name", "user__first_name")
-    data_list = [(str(p.user), str(p.room)) for p in prefs]
-    return csv_response(("User", "Room"), data_list, filename='list_csv_room_by_member')
+@require_http_methods(['POST'])
+def allocate_rooms(request):
+    zosia = Zosia.objects.find_active_or_404()
+
+    if not zosia.is_rooming_over:
+        messages.error(request, _('Rooms can be allocated only after room registration is over'))
+        return redirect(reverse('rooms_allocation'))
+
+    form = RoomAllocationForm(request.POST)
+
+    if not form.is_valid():
+        messages.error(request, errors_format(form))
+        return redirect(reverse('rooms_allocation'))
+
+    try:
+        count = apply_allocation(zosia, form.assignment())
+    except ValidationError as e:
+        messages.error(request, validation_format(e, _('Could not allocate rooms')))
+    else:
+        messages.success(request, _('%(count)s participants have been added to rooms') %
+                         {'count': count})
+
+    return redirect(reverse('rooms_allocation'))
 
 
 @staff_member_required
 @require_http_methods(['GET'])
-def list_csv_members_by_room(request):
-    rooms = Room.objects.prefetch_related('members').all()
-    data_list = [(str(r), r.members_to_string) for r in
-                 sorted(rooms, key=Room.name_to_key_orderable)]
-    return csv_response(("Room", "Members"), data_list, filename='list_csv_members_by_room')
-
+def list_csv_room_by_user(request):
+    # Room of every user is joined in the same query, user belongs to at most one room
+    prefs = UserPreferences.objects.order_by("user__last_name", "user__first_name") \
+        .values_list("user__first_name", "user__last_name", "user__userroom__room__name",
+                     "payment_accepted") \
+        .iterator(chunk_size=CSV_CHUNK_SIZE)
+    data = ((f"{first_name} {last_name}", '' if room is None else f"Room {room}", str(paid))
+            for first_name, last_name, room, paid in prefs)
+    return csv_response(("User", "Room", "Paid"), data, filename='list_csv_room_by_user')
 
-def handle_uploaded_file(csvfile):
-    rooms = []
 
-    for line, row in enumerate(csv.reader(csvfile, delimiter=','), start=1):
-        try:
-            name, desc, hidden, av_single, av_double, b_single, b_double = row
-        except ValueError as e:
-            raise ValidationError("Line %(line)s - %(error)s", code="invalid",
-                                  params={"line": line, "error": e})
+@staff_member_required
+@require_http_methods(['GET'])
+def list_csv_room_by_member(request):
+    prefs = UserPreferences.objects.filter(user__userroom__isnull=False) \
+        .order_by("user__last_name", "user__first_name") \
+        .values_list("user__first_name", "user__last_name", "user__userroom__room__name") \
+        .iterator(chunk_size=CSV_CHUNK_SIZE)
+    data = ((f"{first_name} {last_name}", f"Room {room}") for first_name, last_name, room in prefs)
+    return csv_response(("User", "Room"), data, filename='list_csv_room_by_member')
 
-        if name != "Name":
-            rooms.append(
-                Room(name=name, description=desc, hidden=hidden,
-                     available_beds_single=av_single,
-                     available_beds_double=av_double, beds_single=b_single,
-                     beds_double=b_double))
 
-    try:
-        Room.objects.bulk_create(rooms)
-    except ValueError:
-        raise ValidationError(
-            "Could not add rooms, check whether the file is properly formed and all values are "
-            "correct.",
-            code="invalid")
+@staff_member_required
+@require_http_methods(['GET'])
+def list_csv_members_by_room(request):
+    rooms = Room.objects.prefetch_related(
+        Prefetch('members', queryset=User.objects.order_by("last_name", "first_name"),
+                 to_attr='ordered_members'))
+    data = ((str(r), DELIMITER.join(map(str, r.ordered_members)))
+            for r in sorted(rooms, key=Room.name_to_key_orderable))
+    return csv_response(("Room", "Members"), data, filename='list_csv_members_by_room')
 
 
 @staff_member_required
 @require_http_methods(['GET', 'POST'])
 def import_room(request):
+    report = None
+
     if request.method == 'POST':
         form = UploadFileForm(request.POST, request.FILES)
 
         if form.is_valid():
             try:
-                handle_uploaded_file(TextIOWrapper(request.FILES['file'].file,
-                                                   encoding=request.encoding))
-            except ValidationError as e:
-                messages.error(request,
-                               validation_format(e, _("There were errors when adding rooms")))
-            except Exception:
-                messages.error(request, _("There were errors when adding rooms"))
+                report = import_rooms(
+                    TextIOWrapper(request.FILES['file'].file, encoding='utf-8-sig'),
+                    form.cleaned_data['dry_run'])
+            except UnicodeDecodeError:
+                messages.error(request, _("File with rooms must be encoded in UTF-8"))
             else:
-                messages.success(request, _("Rooms have been successfully added"))
-                return HttpResponseRedirect(reverse('admin'))
+                counts = {'created': report['created'], 'updated': report['updated'],
+                          'errors': report['errors_count']}
+
+                if report['errors_count']:
+                    messages.error(request, _("There were errors in %(errors)s lines, no rooms "
+                                              "have been imported") % counts)
+                elif report['dry_run']:
+                    messages.info(request, _("File is correct, %(created)s rooms would be added "
+                                             "and %(updated)s rooms updated") % counts)
+                else:
+                    messages.success(request, _("%(created)s rooms have been added and "
+                                                "%(updated)s rooms updated") % counts)
+                    return HttpResponseRedirect(reverse('admin'))
     else:
         form = UploadFileForm()
 
-    return render(request, 'rooms/import.html', {'form': form})
+    return render(request, 'rooms/import.html', {'form': form, 'report': report})
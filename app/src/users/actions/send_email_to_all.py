@@ -1,20 +1,13 @@
-
-from django.template import loader
-from django.core.mail import send_mass_mail
-from django.utils.encoding import force_bytes
-from django.utils.http import urlsafe_base64_encode
-from django.conf import settings
-
-EMAIL_TEMPLATE_NAME = 'users/generic_email.html'
+from users.models import MailJob
 
 
 class SendEmailToAll:
-    def __init__(self, users, use_https=False):
+    def __init__(self, users, sender=None):
         self.users = users
-        self.use_https = use_https
+        self.sender = sender
 
     def call(self, subject, text):
-        emails = [
-            (subject, text, settings.DEFAULT_MAIL, [user.email])
-            for user in self.users]
-        send_mass_mail(emails, fail_silently=False)
+        # Messages are only queued here, the cron job sends them later
+        return MailJob.objects.create_for(subject, text,
+                                          (user.email for user in self.users),
+                                          created_by=self.sender)
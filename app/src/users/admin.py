@@ -1,11 +1,15 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ActionForm
 from django.db.models import Exists, F, OuterRef, Q, Value
 from django.db.models.functions import Concat
+from django.utils.translation import ngettext, ugettext_lazy as _
 
 from lectures.models import Lecture
 from rooms.models import Room, UserRoom
 from users.models import Organization, User, UserFilters, UserPreferences
-from utils.constants import SHIRT_SIZE_CHOICES, SHIRT_TYPES_CHOICES
+from utils.constants import MAX_BONUS_MINUTES, MIN_BONUS_MINUTES, SHIRT_SIZE_CHOICES, \
+    SHIRT_TYPES_CHOICES
 
 
 @admin.action(description='Accept selected organizations')
@@ -29,6 +33,50 @@ def activate_user(modeladmin, request, queryset):
         user.save()
 
 
+class UserPreferencesActionForm(ActionForm):
+    bonus_minutes = forms.IntegerField(required=False, min_value=MIN_BONUS_MINUTES,
+                                       max_value=MAX_BONUS_MINUTES)
+
+
+class BonusMinutesForm(forms.Form):
+    """Checks bonus minutes of the action form, required only by the bonus action."""
+    bonus_minutes = forms.IntegerField(min_value=MIN_BONUS_MINUTES, max_value=MAX_BONUS_MINUTES)
+
+
+@admin.action(description='Accept payment of selected users')
+def accept_payment(modeladmin, request, queryset):
+    count = UserPreferences.objects.bulk_set(queryset, payment_accepted=True)
+    modeladmin.message_user(request, ngettext('Accepted payment of %(count)s user',
+                                              'Accepted payment of %(count)s users',
+                                              count) % {'count': count})
+
+
+@admin.action(description='Reject payment of selected users')
+def reject_payment(modeladmin, request, queryset):
+    count = UserPreferences.objects.bulk_set(queryset, payment_accepted=False)
+    modeladmin.message_user(request, ngettext('Rejected payment of %(count)s user',
+                                              'Rejected payment of %(count)s users',
+                                              count) % {'count': count})
+
+
+@admin.action(description='Set bonus minutes of selected users')
+def set_bonus_minutes(modeladmin, request, queryset):
+    form = BonusMinutesForm(request.POST)
+
+    if not form.is_valid():
+        modeladmin.message_user(
+            request, _('Bonus minutes must be between %(min)s and %(max)s')
+            % {'min': MIN_BONUS_MINUTES, 'max': MAX_BONUS_MINUTES}, messages.ERROR)
+        return
+
+    bonus = form.cleaned_data['bonus_minutes']
+
+    count = UserPreferences.objects.bulk_set(queryset, bonus_minutes=bonus)
+    modeladmin.message_user(request, ngettext('Set bonus minutes of %(count)s user to %(bonus)s',
+                                              'Set bonus minutes of %(count)s users to %(bonus)s',
+                                              count) % {'count': count, 'bonus': bonus})
+
+
 class OrganizationAdmin(admin.ModelAdmin):
     actions = [accept_organization, reject_organization]
 
@@ -69,6 +117,8 @@ class UserPreferencesAdmin(admin.ModelAdmin):
                     'accommodation_day_2', 'accommodation_day_3', 'vegetarian',
                     'bonus_minutes', 'discount_round')
     readonly_fields = ('user', 'zosia', 'terms_accepted')
+    actions = [accept_payment, reject_payment, set_bonus_minutes]
+    action_form = UserPreferencesActionForm
     list_filter = ('payment_accepted', 'is_student', OrganizationNameListFilter, 'accommodation_day_1',
                    'accommodation_day_2', 'accommodation_day_3', 'vegetarian', 'discount_round')
 
@@ -0,0 +1,90 @@
+from collections import Counter
+from itertools import chain
+
+from django.db import transaction
+from django.utils.translation import ugettext_lazy as _
+
+from users.models import UserPreferences, rooming_schedule_cache_key
+from utils.cache import invalidate
+from utils.constants import BONUS_STEP, MAX_BONUS_MINUTES, MIN_BONUS_MINUTES
+from utils.time_manager import timedelta_since
+
+ORDER_REGISTRATION = "registration"
+ORDER_BONUS = "bonus"
+ORDER_HASHES = "hashes"
+
+ORDERS = (
+    (ORDER_REGISTRATION, _("Registration order")),
+    (ORDER_BONUS, _("Current bonus minutes")),
+    (ORDER_HASHES, _("Order of user hashes in file, e.g. payment order")),
+)
+
+
+# Planned bonuses are multiples of BONUS_STEP, like the ones set by hand in the admin
+LOWEST_PLANNED_BONUS = -(-MIN_BONUS_MINUTES // BONUS_STEP) * BONUS_STEP
+HIGHEST_PLANNED_BONUS = MAX_BONUS_MINUTES // BONUS_STEP * BONUS_STEP
+
+
+def plan_bonus_minutes(count, per_minute):
+    """Returns bonus minutes for count participants ordered from the first to the last admitted,
+    so at most per_minute of them start rooming in the same minute.
+
+    The last participants get the lowest bonus and every earlier group BONUS_STEP minutes more.
+    Participants who don't fit below the highest bonus all get the highest one.
+    """
+    return [min(LOWEST_PLANNED_BONUS + (count - 1 - i) // per_minute * BONUS_STEP,
+                HIGHEST_PLANNED_BONUS)
+            for i in range(count)]
+
+
+def ordered_participants(zosia, order, hashes=()):
+    """Returns keys and current bonus minutes of paid participants of zosia in the order of
+    admission. Participants missing in hashes follow the listed ones in registration order."""
+    preferences = UserPreferences.objects.filter(zosia=zosia, payment_accepted=True)
+    preferences = preferences.order_by("-bonus_minutes", "pk") if order == ORDER_BONUS else \
+        preferences.order_by("pk")
+    rows = list(preferences.values_list("pk", "user__hash", "bonus_minutes"))
+
+    if order == ORDER_HASHES:
+        positions = {}
+
+        for position, hash_ in enumerate(hashes):
+            positions.setdefault(hash_.strip().lower()[:8], position)
+
+        rows.sort(key=lambda row: positions.get((row[1] or "").lower()[:8], len(positions)))
+
+    return [(pk, bonus) for pk, hash_, bonus in rows]
+
+
+def make_bonus_plan(zosia, order, per_minute, hashes=()):
+    """Returns paid participants of zosia in the order of admission and numbers of participants
+    admitted in every minute with current and with planned bonus minutes."""
+    participants = ordered_participants(zosia, order, hashes)
+    current = Counter(bonus for pk, bonus in participants)
+    planned = Counter(plan_bonus_minutes(len(participants), per_minute))
+
+    return {
+        "participants": [pk for pk, bonus in participants],
+        "histogram": [{"time": timedelta_since(zosia.rooming_start, minutes=-bonus),
+                       "bonus": bonus, "current": current[bonus], "planned": planned[bonus]}
+                      for bonus in sorted(current.keys() | planned.keys(), reverse=True)],
+        "peak": max(chain(current.values(), planned.values()), default=0),
+        "overflow": max(0, planned[HIGHEST_PLANNED_BONUS] - per_minute),
+    }
+
+
+@transaction.atomic
+def apply_bonus_plan(zosia, participants, per_minute):
+    """Sets bonus minutes planned for participants of zosia, given in the order of admission, with
+    a single bulk update. Participants who are not paid participants of zosia are skipped."""
+    paid = set(UserPreferences.objects.filter(zosia=zosia, payment_accepted=True,
+                                              pk__in=participants).values_list("pk", flat=True))
+    participants = [pk for pk in dict.fromkeys(participants) if pk in paid]
+    preferences = [UserPreferences(pk=pk, bonus_minutes=bonus) for pk, bonus in
+                   zip(participants, plan_bonus_minutes(len(participants), per_minute))]
+
+    # Bulk update skips `save`, so the rooming schedule is invalidated here
+    UserPreferences.objects.bulk_update(preferences, ["bonus_minutes"])
+    invalidate(rooming_schedule_cache_key(zosia))
+
+    return len(preferences)
@@ -1,6 +1,7 @@
 from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.tokens import default_token_generator
+from django.contrib.postgres.forms import SimpleArrayField
 from django.contrib.sites.shortcuts import get_current_site
 from django.urls import reverse
 from django.utils.safestring import mark_safe
@@ -10,8 +11,11 @@ from django_recaptcha.widgets import ReCaptchaV2Checkbox
 
 from conferences.models import Transport, Zosia
 from users.actions import SendActivationEmail, SendEmailToAll
+from users.bonus_plan import ORDERS, ORDER_HASHES
 from users.models import Organization, User, UserPreferences
-from utils.constants import PAYMENT_GROUPS
+from utils.constants import ADMIN_USER_PREFERENCES_COMMAND_CHANGE_BONUS, \
+    ADMIN_USER_PREFERENCES_COMMAND_SET_PAYMENT, MAX_BONUS_MINUTES, MIN_BONUS_MINUTES, \
+    PAYMENT_GROUPS
 
 GROUPS = (
     ('pick', 'Pick users'),
@@ -25,70 +29,56 @@ GROUPS = (
 )
 
 
+def recipients_of_group(group):
+    """Returns users in a group of mail recipients. Groups are resolved when mail is sent, so the
+    form never lists all users."""
+    if group == 'all_Users':
+        return User.objects.all()
+    if group == 'staff':
+        return User.objects.filter(is_staff=True)
+    if group == 'active':
+        return User.objects.filter(is_active=True)
+    if group == 'inactive':
+        return User.objects.filter(is_active=False)
+    if group == 'registered':
+        return User.objects.filter(preferences__isnull=False).distinct()
+    if group == 'payed':
+        return User.objects.filter(preferences__payment_accepted=True).distinct()
+    if group == 'not_Payed':
+        return User.objects.filter(preferences__payment_accepted=False).distinct()
+
+    return User.objects.none()
+
+
 class MailForm(forms.Form):
-    subject = forms.CharField()
+    subject = forms.CharField(max_length=300)
     text = forms.CharField(widget=forms.Textarea)
     select_groups = forms.ChoiceField(choices=GROUPS)
-    pick = forms.ModelMultipleChoiceField(
-        queryset=User.objects.all(), to_field_name="email", required=False)
-    all_Users = forms.ModelMultipleChoiceField(
-        queryset=User.objects.all(), to_field_name="email", required=False)
-    staff = forms.ModelMultipleChoiceField(
-        queryset=User.objects.filter(is_staff=True),
-        to_field_name="email", required=False)
-    active = forms.ModelMultipleChoiceField(
-        queryset=User.objects.filter(is_active=True),
-        to_field_name="email", required=False)
-    inactive = forms.ModelMultipleChoiceField(
-        queryset=User.objects.filter(is_active=False),
-        to_field_name="email", required=False)
-    registered = forms.ModelMultipleChoiceField(
-        queryset=User.objects.filter(preferences__isnull=False).distinct(),
-        to_field_name="email", required=False)
-    payed = forms.ModelMultipleChoiceField(
-        queryset=User.objects.filter(preferences__payment_accepted=True).distinct(),
-        to_field_name="email", required=False)
-    not_Payed = forms.ModelMultipleChoiceField(
-        queryset=User.objects.filter(preferences__payment_accepted=False).distinct(),
-        to_field_name="email", required=False)
+    # Picked emails are sent as a single comma separated field
+    pick = SimpleArrayField(forms.EmailField(), required=False, widget=forms.HiddenInput)
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.fields["all_Users"].initial = (
-            User.objects.all().values_list('email', flat=True)
-        )
-        self.fields["staff"].initial = (
-            User.objects.filter(is_staff=True).values_list('email', flat=True)
-        )
-        self.fields["active"].initial = (
-            User.objects.filter(is_active=True).values_list('email', flat=True)
-        )
-        self.fields["inactive"].initial = (
-            User.objects.filter(is_active=False).values_list('email', flat=True)
-        )
-        self.fields["registered"].initial = (
-            User.objects.filter(preferences__isnull=False).distinct()
-                .values_list('email', flat=True)
-        )
-        self.fields["payed"].initial = (
-            User.objects.filter(preferences__payment_accepted=True).distinct()
-                .values_list('email', flat=True)
-        )
-        self.fields["not_Payed"].initial = (
-            User.objects.filter(preferences__payment_accepted=False).distinct()
-                .values_list('email', flat=True)
-        )
+    def clean(self):
+        cleaned_data = super().clean()
+
+        if cleaned_data.get('select_groups') == 'pick' and not cleaned_data.get('pick') and \
+                'pick' not in self.errors:
+            self.add_error('pick', _("Pick at least one user"))
+
+        return cleaned_data
 
     def receivers(self):
-        return self.cleaned_data[self.cleaned_data["select_groups"]]
+        group = self.cleaned_data["select_groups"]
+
+        if group == 'pick':
+            return User.objects.filter(email__in=self.cleaned_data['pick'])
+
+        return recipients_of_group(group)
 
-    def send_mail(self):
-        users = self.receivers()
-        SendEmailToAll(users=users).call(
+    def send_mail(self, sender=None):
+        return SendEmailToAll(users=self.receivers().only('email'), sender=sender).call(
             self.cleaned_data['subject'],
             self.cleaned_data['text']
         )
-        print(users)
 
 
 class UserForm(UserCreationForm):
@@ -285,3 +275,106 @@ class UserPreferencesAdminForm(UserPreferencesWithTransportForm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.fields['contact'].disabled = True
+
+
+def read_hashes(file):
+    """Returns user hashes from an uploaded file with one hash per line."""
+    if file is None:
+        return []
+
+    try:
+        return file.read().decode('utf-8-sig').split()
+    except UnicodeDecodeError:
+        raise forms.ValidationError(_("File with user hashes must be encoded in UTF-8"))
+
+
+class BankStatementForm(forms.Form):
+    file = forms.FileField(label=_("Bank statement (CSV)"))
+    title_column = forms.CharField(initial="Title", label=_("Column with transfer title"))
+    amount_column = forms.CharField(initial="Amount", label=_("Column with amount"))
+
+
+class AcceptPaymentsForm(forms.Form):
+    preferences = forms.TypedMultipleChoiceField(coerce=int, label=_("Participants"))
+
+    def __init__(self, zosia, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['preferences'].choices = [
+            (pk, pk) for pk in
+            UserPreferences.objects.filter(zosia=zosia).values_list('pk', flat=True)]
+
+
+class UserPreferencesBulkEditForm(forms.Form):
+    """Selects preferences by comma separated keys or by an uploaded file with one user hash
+    per line."""
+    command = forms.ChoiceField(choices=(
+        (ADMIN_USER_PREFERENCES_COMMAND_SET_PAYMENT, _("Set payment status")),
+        (ADMIN_USER_PREFERENCES_COMMAND_CHANGE_BONUS, _("Change bonus")),
+    ))
+    keys = SimpleArrayField(forms.IntegerField(), required=False)
+    hashes = forms.FileField(required=False, label=_("File with user hashes"))
+    payment_accepted = forms.BooleanField(required=False)
+    bonus = forms.IntegerField(required=False, min_value=MIN_BONUS_MINUTES,
+                               max_value=MAX_BONUS_MINUTES)
+
+    def clean_hashes(self):
+        return read_hashes(self.cleaned_data['hashes'])
+
+    def clean(self):
+        cleaned_data = super().clean()
+
+        if cleaned_data.get('command') == ADMIN_USER_PREFERENCES_COMMAND_CHANGE_BONUS and \
+                cleaned_data.get('bonus') is None and 'bonus' not in self.errors:
+            self.add_error('bonus', _("Bonus is required to change it"))
+
+        return cleaned_data
+
+    def selected(self, zosia):
+        """Returns preferences for zosia selected by keys or hashes."""
+        preferences = UserPreferences.objects.filter(zosia=zosia)
+
+        return preferences.filter(pk__in=self.cleaned_data['keys']) | \
+            preferences.filter(pk__in=UserPreferences.objects.filter_by_hashes(
+                self.cleaned_data['hashes']).values('pk'))
+
+    def missing_hashes(self, zosia):
+        """Returns uploaded hashes which don't match any preferences for zosia."""
+        found = {hash_[:8] for hash_ in UserPreferences.objects.filter_by_hashes(
+            self.cleaned_data['hashes']).filter(zosia=zosia).values_list('user__hash', flat=True)}
+
+        return [hash_ for hash_ in self.cleaned_data['hashes'] if hash_.lower()[:8] not in found]
+
+    def save(self, zosia):
+        values = {'payment_accepted': self.cleaned_data['payment_accepted']} \
+            if self.cleaned_data['command'] == ADMIN_USER_PREFERENCES_COMMAND_SET_PAYMENT \
+            else {'bonus_minutes': self.cleaned_data['bonus']}
+
+        return UserPreferences.objects.bulk_set(self.selected(zosia), **values)
+
+
+class BonusPlanForm(forms.Form):
+    per_minute = forms.IntegerField(min_value=1, initial=5,
+                                    label=_("Participants starting rooming in a minute at most"))
+    order = forms.ChoiceField(choices=ORDERS, label=_("Order of participants"))
+    hashes = forms.FileField(required=False,
+                             label=_("File with user hashes, the first starts rooming first"))
+
+    def clean_hashes(self):
+        return read_hashes(self.cleaned_data['hashes'])
+
+    def clean(self):
+        cleaned_data = super().clean()
+
+        if cleaned_data.get('order') == ORDER_HASHES and not cleaned_data.get('hashes') and \
+                'hashes' not in self.errors:
+            self.add_error('hashes', _("File with user hashes is required for this order"))
+
+        return cleaned_data
+
+
+class BonusPlanApplyForm(forms.Form):
+    """Carries the previewed order of participants, so exactly the previewed plan is applied."""
+    per_minute = forms.IntegerField(min_value=1, widget=forms.HiddenInput,
+                                    label=_("Participants starting rooming in a minute at most"))
+    participants = SimpleArrayField(forms.IntegerField(), widget=forms.HiddenInput,
+                                    label=_("Participants"))
@@ -0,0 +1,126 @@
+import logging
+import smtplib
+import time
+
+from anymail.exceptions import AnymailInvalidAddress, AnymailRecipientsRefused
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+
+from users.models import MailRecipient
+from utils.constants import MailInternals
+from utils.time_manager import now, timedelta_since_now
+
+logger = logging.getLogger(__name__)
+
+# Errors which don't go away when the message is sent again
+PERMANENT_ERRORS = (AnymailInvalidAddress, AnymailRecipientsRefused, smtplib.SMTPRecipientsRefused)
+
+
+class RateLimiter:
+    """Spaces out consecutive calls of `wait`, so at most `rate` happen per second."""
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.interval = 1 / rate if rate else 0
+        self.clock = clock
+        self.sleep = sleep
+        self.next_time = None
+
+    def wait(self):
+        current = self.clock()
+
+        if self.next_time is not None and current < self.next_time:
+            self.sleep(self.next_time - current)
+            current = self.next_time
+
+        self.next_time = current + self.interval
+
+
+def claim_batch(batch_size):
+    """Returns up to batch_size due recipients, leased to the caller for MAIL_QUEUE_LEASE seconds.
+
+    The lease moves their next attempt past the time needed to send them, so other workers skip
+    them without holding row locks during sending. Messages of a worker which stopped before
+    recording results are sent again once the lease runs out.
+    """
+    with transaction.atomic():
+        recipients = list(MailRecipient.objects.select_for_update(skip_locked=True, of=("self",))
+                          .filter(status=MailInternals.STATUS_PENDING,
+                                  next_attempt_at__lte=now())
+                          .select_related("job").order_by("pk")[:batch_size])
+
+        MailRecipient.objects.filter(pk__in=[recipient.pk for recipient in recipients]) \
+            .update(next_attempt_at=timedelta_since_now(seconds=settings.MAIL_QUEUE_LEASE))
+
+    return recipients
+
+
+def send_batch(batch_size, limiter):
+    """Sends a batch of due messages over a single connection and returns how many recipients
+    were processed.
+
+    Recipients are claimed first and sent outside of a transaction, with the result of every
+    message saved right after it is sent. Failed messages are retried later, with the delay
+    doubled after every attempt.
+    """
+    recipients = claim_batch(batch_size)
+
+    if not recipients:
+        return 0
+
+    with get_connection() as connection:
+        for recipient in recipients:
+            limiter.wait()
+            send_to(recipient, connection)
+            recipient.save(update_fields=["status", "attempts", "next_attempt_at", "sent_at",
+                                          "error"])
+
+    return len(recipients)
+
+
+def send_queued(batch_size, limiter, timeout=None, limit=None):
+    """Sends batches of due messages until there are none left, timeout seconds pass or limit
+    recipients are processed, and returns how many recipients were processed."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    processed = 0
+
+    while deadline is None or time.monotonic() < deadline:
+        if limit is not None:
+            batch_size = min(batch_size, limit - processed)
+
+            if batch_size <= 0:
+                break
+
+        sent = send_batch(batch_size, limiter)
+
+        if not sent:
+            break
+
+        processed += sent
+
+    return processed
+
+
+def send_to(recipient, connection):
+    job = recipient.job
+    recipient.attempts += 1
+
+    try:
+        EmailMessage(job.subject, job.text, settings.DEFAULT_MAIL, [recipient.email],
+                     connection=connection).send()
+    except PERMANENT_ERRORS as e:
+        recipient.status = MailInternals.STATUS_FAILED
+        recipient.error = str(e)
+    except Exception as e:
+        logger.warning("Cannot send mail to %s: %s", recipient.email, e)
+        recipient.error = str(e)
+
+        if recipient.attempts >= settings.MAIL_QUEUE_MAX_ATTEMPTS:
+            recipient.status = MailInternals.STATUS_FAILED
+        else:
+            delay = settings.MAIL_QUEUE_RETRY_DELAY * 2 ** (recipient.attempts - 1)
+            recipient.next_attempt_at = timedelta_since_now(seconds=delay)
+    else:
+        recipient.status = MailInternals.STATUS_SENT
+        recipient.sent_at = now()
+        recipient.error = ""
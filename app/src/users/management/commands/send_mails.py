@@ -0,0 +1,32 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from users.mail_queue import RateLimiter, send_batch
+
+
+class Command(BaseCommand):
+    help = 'Send messages queued by the mail form in batches, retrying failed ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.MAIL_QUEUE_BATCH_SIZE,
+                            help='Number of messages sent over a single connection')
+        parser.add_argument('--rate', type=float, default=settings.MAIL_QUEUE_RATE,
+                            help='Messages sent per second, 0 disables the limit')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit when there are no more messages to send now, instead of '
+                                 'waiting for new ones')
+
+    def handle(self, *args, **kwargs):
+        limiter = RateLimiter(kwargs['rate'])
+
+        while True:
+            sent = send_batch(kwargs['batch_size'], limiter)
+
+            if sent:
+                self.stdout.write(f'Processed {sent} messages')
+            elif kwargs['once']:
+                return
+            else:
+                time.sleep(settings.MAIL_QUEUE_POLL_INTERVAL)
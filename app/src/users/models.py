@@ -1,15 +1,21 @@
 import hashlib
 import re
 
+from django.conf import settings
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Greatest, Substr
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from conferences.models import Transport, Zosia
-from utils.constants import II_UWR_EMAIL_DOMAIN, MAX_BONUS_MINUTES, MIN_BONUS_MINUTES, \
-    PAYMENT_GROUPS, PERSON_TYPE, SHIRT_SIZE_CHOICES, SHIRT_TYPES_CHOICES, UserInternals
+from utils.cache import get_cached, invalidate
+from utils.constants import II_UWR_EMAIL_DOMAIN, MAIL_STATUS, MAX_BONUS_MINUTES, \
+    MIN_BONUS_MINUTES, MailInternals, PAYMENT_GROUPS, PERSON_TYPE, SHIRT_SIZE_CHOICES, \
+    SHIRT_TYPES_CHOICES, UserInternals
 from utils.time_manager import timedelta_since
 
 
@@ -121,6 +127,11 @@ class Organization(models.Model):
         return f"{self.name}{owner}"
 
 
+def rooming_schedule_cache_key(zosia):
+    # Changing rooming start of the conference moves all start times, so it's a part of the key
+    return f"users.rooming_schedule.{zosia.pk}.{zosia.rooming_start.timestamp()}"
+
+
 class UserPreferencesManager(models.Manager):
     def for_zosia(self, zosia, **override):
         defaults = {
@@ -129,6 +140,120 @@ class UserPreferencesManager(models.Manager):
         defaults.update(**override)
         return self.filter(**defaults)
 
+    def rooming_schedule(self, zosia):
+        """Returns a dict mapping every user registered for zosia to their rooming start time,
+        which is None for users who cannot choose a room."""
+        return get_cached(rooming_schedule_cache_key(zosia),
+                          lambda: self._build_rooming_schedule(zosia),
+                          settings.ROOMING_SCHEDULE_CACHE_TIMEOUT)
+
+    def filter_by_hashes(self, hashes):
+        """Returns preferences of users with given hashes, which may be shortened to
+        `User.short_hash` like in transfer titles."""
+        short_hashes = {hash_.strip().lower()[:8] for hash_ in hashes if hash_.strip()}
+
+        return self.annotate(user_short_hash=Substr("user__hash", 1, 8)) \
+            .filter(user_short_hash__in=short_hashes)
+
+    def bulk_set(self, preferences, **values):
+        """Sets values of all given preferences with a single UPDATE. The update skips `save`, so
+        rooming schedules of their conferences are invalidated here, once per conference."""
+        zosias = list(Zosia.objects.filter(pk__in=preferences.values("zosia_id")))
+        updated = preferences.update(**values)
+
+        for zosia in zosias:
+            invalidate(rooming_schedule_cache_key(zosia))
+
+        return updated
+
+    def annotate_price(self):
+        """Annotates preferences with `computed_price`, the same as `price`, but computed by the
+        database, so prices of many preferences are read, summed or grouped in a single query."""
+        # Discount is subtracted only for days with non-zero price, so those are computed first
+        day_prices = {f"price_day_{day}": self._day_price_expression(accommodation, meals)
+                      for day, (accommodation, meals) in enumerate(PAYMENT_GROUPS.items(), 1)}
+        discount = Case(When(discount_round=1, then=F("zosia__first_discount")),
+                        When(discount_round=2, then=F("zosia__second_discount")),
+                        When(discount_round=3, then=F("zosia__third_discount")),
+                        default=Value(0))
+        transport = Case(When(transport__isnull=True, then=Value(0)),
+                         When(is_student=True, then=F("zosia__price_transport_with_discount")),
+                         default=F("zosia__price_transport"))
+        baggage = Case(When(transport_baggage=True, then=F("zosia__price_transfer_baggage")),
+                       default=Value(0))
+        payment = F("zosia__price_base") + transport + baggage
+
+        for day_price in day_prices:
+            payment = payment + F(day_price) - Case(
+                When(Q(is_student=True, **{f"{day_price}__gt": 0}), then=discount),
+                default=Value(0))
+
+        return self.alias(**day_prices).annotate(computed_price=Greatest(Value(0), payment))
+
+    @staticmethod
+    def _day_price_expression(accommodation, meals):
+        # Same as UserPreferences._price_for
+        dinner, breakfast = meals["dinner"], meals["breakfast"]
+
+        return Case(When(Q(**{dinner: True, breakfast: True}), then=F("zosia__price_whole_day")),
+                    When(Q(**{dinner: True}), then=F("zosia__price_accommodation_dinner")),
+                    When(Q(**{breakfast: True}), then=F("zosia__price_accommodation_breakfast")),
+                    When(Q(**{accommodation: True}), then=F("zosia__price_accommodation")),
+                    default=Value(0))
+
+    def prices(self, preferences):
+        """Returns prices of given preferences, the same as their `price`, but computed at once
+        for preferences already loaded into memory. Conferences are fetched once."""
+        zosias = Zosia.objects.in_bulk({prefs.zosia_id for prefs in preferences})
+        # Price of a day for every choice of accommodation, dinner and breakfast
+        day_prices = {
+            pk: {(acc, dinner, breakfast): UserPreferences(zosia=zosia)._price_for(
+                {"accommodation": acc, "dinner": dinner, "breakfast": breakfast})
+                for acc in (False, True) for dinner in (False, True) for breakfast in (False, True)}
+            for pk, zosia in zosias.items()
+        }
+
+        return [self._price_from_table(prefs, zosias[prefs.zosia_id], day_prices[prefs.zosia_id])
+                for prefs in preferences]
+
+    @staticmethod
+    def _price_from_table(prefs, zosia, day_prices):
+        payment = zosia.price_base
+
+        if prefs.transport_id is not None:
+            payment += zosia.price_transport_with_discount if prefs.is_student else \
+                zosia.price_transport
+
+        if prefs.transport_baggage:
+            payment += zosia.price_transfer_baggage
+
+        discount = zosia.get_discount_for_round(prefs.discount_round) if prefs.is_student else 0
+
+        for accommodation, meals in PAYMENT_GROUPS.items():
+            day_price = day_prices[getattr(prefs, accommodation), getattr(prefs, meals["dinner"]),
+                                   getattr(prefs, meals["breakfast"])]
+
+            payment += day_price
+
+            if day_price > 0:
+                payment -= discount
+
+        return max(0, payment)
+
+    def _build_rooming_schedule(self, zosia):
+        schedule = {}
+
+        for prefs in self.filter(zosia=zosia).only('user', 'payment_accepted', 'bonus_minutes'):
+            prefs.zosia = zosia
+            schedule[prefs.user_id] = prefs.rooming_start_time
+
+        return schedule
+
+
+def transfer_title(first_name, last_name, hash_):
+    """Returns title which participants copy into their transfers, so payments are matched."""
+    return f"ZOSIA - {first_name} {last_name} - {hash_[:8]}"
+
 
 def validate_terms(value):
     if not value:
@@ -274,7 +399,7 @@ class UserPreferences(models.Model):
     def price(self):
         payment = self.zosia.price_base
 
-        if self.transport is not None:
+        if self.transport_id is not None:
             if self.is_student:
                 payment += self.zosia.price_transport_with_discount
             else:
@@ -316,7 +441,7 @@ class UserPreferences(models.Model):
 
     @property
     def transfer_title(self):
-        return f"ZOSIA - {self.user.full_name} - {self.user.short_hash}"
+        return transfer_title(self.user.first_name, self.user.last_name, self.user.short_hash)
 
     @property
     def rooming_start_time(self):
@@ -324,3 +449,62 @@ class UserPreferences(models.Model):
             return None
 
         return timedelta_since(self.zosia.rooming_start, minutes=-self.bonus_minutes)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        invalidate(rooming_schedule_cache_key(self.zosia))
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        invalidate(rooming_schedule_cache_key(self.zosia))
+
+        return result
+
+
+class MailJobManager(models.Manager):
+    def create_for(self, subject, text, emails, created_by=None):
+        """Queues a message to all emails. It is sent later by the cron job or the
+        `send_mails` command."""
+        job = self.create(subject=subject, text=text, created_by=created_by)
+        MailRecipient.objects.bulk_create(
+            (MailRecipient(job=job, email=email) for email in emails),
+            batch_size=settings.MAIL_QUEUE_BATCH_SIZE)
+
+        return job
+
+
+class MailJob(models.Model):
+    objects = MailJobManager()
+
+    subject = models.CharField(max_length=300)
+    text = models.TextField()
+    created_by = models.ForeignKey(User, related_name="mail_jobs", null=True,
+                                   on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.subject
+
+    def progress(self):
+        """Returns numbers of recipients in every status, counted in a single query."""
+        return self.recipients.aggregate(
+            total=models.Count("pk"),
+            **{status: models.Count("pk", filter=Q(status=status)) for status, _ in MAIL_STATUS})
+
+
+class MailRecipient(models.Model):
+    class Meta:
+        indexes = [models.Index(fields=["status", "next_attempt_at"])]
+
+    job = models.ForeignKey(MailJob, related_name="recipients", on_delete=models.CASCADE)
+    email = models.EmailField()
+    status = models.CharField(max_length=10, choices=MAIL_STATUS,
+                              default=MailInternals.STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    # Failed messages wait before they are retried
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"{self.email} ({self.status})"
@@ -0,0 +1,237 @@
+from collections import defaultdict
+import csv
+from decimal import Decimal, InvalidOperation
+import re
+import unicodedata
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.utils.translation import ugettext_lazy as _
+
+from conferences.models import Transport
+from users.models import UserPreferences, transfer_title
+from utils.constants import CSV_CHUNK_SIZE
+
+PAYMENTS_CSV_HEADER = ("User", "Email", "Transfer title", "Expected amount", "Paid",
+                       "Discount round", "Transport")
+PAYMENTS_CSV_FIELDS = ("user__first_name", "user__last_name", "user__email", "user__hash",
+                       "computed_price", "payment_accepted", "discount_round", "transport_id")
+
+
+def _transport_names(zosia):
+    return {transport.pk: str(transport) for transport in Transport.objects.filter(zosia=zosia)}
+
+
+def payment_rows(zosia):
+    """Yields expected amount and payment status of every participant of zosia, with prices
+    computed by the database, so the whole list is read in a single streamed query."""
+    transports = _transport_names(zosia)
+    rows = UserPreferences.objects.annotate_price().filter(zosia=zosia) \
+        .order_by("user__last_name", "user__first_name") \
+        .values_list(*PAYMENTS_CSV_FIELDS).iterator(chunk_size=CSV_CHUNK_SIZE)
+
+    for first_name, last_name, email, hash_, price, paid, discount_round, transport in rows:
+        yield (f"{first_name} {last_name}", email, transfer_title(first_name, last_name, hash_),
+               str(price), str(paid), str(discount_round), transports.get(transport, ""))
+
+
+def _totals():
+    return {
+        "participants": Count("pk"),
+        "paid_participants": Count("pk", filter=Q(payment_accepted=True)),
+        "expected": Sum("computed_price"),
+        "received": Sum("computed_price", filter=Q(payment_accepted=True)),
+    }
+
+
+def _with_outstanding(totals):
+    expected, received = totals["expected"] or 0, totals["received"] or 0
+
+    return {**totals, "expected": expected, "received": received,
+            "outstanding": expected - received}
+
+
+def payment_totals(zosia):
+    """Returns expected, received and outstanding amounts in total, per discount round and per
+    transport. Every group is summed by the database in a single query."""
+    prefs = UserPreferences.objects.annotate_price().filter(zosia=zosia)
+    transports = _transport_names(zosia)
+    by_round = prefs.values("discount_round").annotate(**_totals()).order_by("discount_round")
+    by_transport = prefs.values("transport").annotate(**_totals()) \
+        .order_by("transport__departure_time", "transport")
+
+    return {
+        "total": _with_outstanding(prefs.aggregate(**_totals())),
+        "discount_rounds": [{**_with_outstanding(totals), "name": totals["discount_round"]}
+                            for totals in by_round],
+        "transports": [{**_with_outstanding(totals),
+                        "name": transports.get(totals["transport"])}
+                       for totals in by_transport],
+    }
+
+
+MATCH_OK = "ok"
+MATCH_WRONG_AMOUNT = "wrong_amount"
+MATCH_ALREADY_PAID = "already_paid"
+MATCH_AMBIGUOUS = "ambiguous"
+MATCH_NOT_FOUND = "not_found"
+
+MATCH_STATUSES = {
+    MATCH_OK: _("Amount matches"),
+    MATCH_WRONG_AMOUNT: _("Amount differs from expected"),
+    MATCH_ALREADY_PAID: _("Payment already accepted"),
+    MATCH_AMBIGUOUS: _("More participants match"),
+    MATCH_NOT_FOUND: _("No participant matches"),
+}
+
+# Longest name looked up in transfer titles, in words
+MAX_NAME_WORDS = 4
+
+# Letters which unicode normalization doesn't strip to ASCII
+_LETTERS = str.maketrans({"ł": "l", "đ": "d", "ø": "o", "ß": "ss"})
+
+
+def normalize_words(text):
+    """Returns lowercase words of text without diacritics, so names match the way people type
+    them in transfer titles."""
+    text = unicodedata.normalize("NFKD", text.lower().translate(_LETTERS))
+
+    return re.findall(r"[a-z0-9]+", text.encode("ascii", "ignore").decode())
+
+
+def parse_amount(value):
+    """Returns amount written with a decimal comma or point, raises InvalidOperation when it
+    isn't a number. Thousands may be separated by spaces, points or commas, e.g. 1 234,50 and
+    1,234.50 are the same amount."""
+    value = re.sub(r"\s|PLN|zł", "", value, flags=re.IGNORECASE)
+    separators = [separator for separator in ",." if separator in value]
+
+    if len(separators) == 2:
+        # The later separator is the decimal one
+        thousands = "," if value.rfind(",") < value.rfind(".") else "."
+        value = value.replace(thousands, "")
+    elif separators and value.count(separators[0]) > 1:
+        value = value.replace(separators[0], "")
+
+    amount = Decimal(value.replace(",", "."))
+
+    if not amount.is_finite():
+        raise InvalidOperation(value)
+
+    return amount
+
+
+def read_bank_statement(csvfile, title_column, amount_column):
+    """Returns incoming transfers from a bank statement CSV file, with the delimiter detected
+    from the header. Outgoing transfers are skipped."""
+    header = csvfile.readline()
+
+    try:
+        dialect = csv.Sniffer().sniff(header, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+
+    columns = next(csv.reader([header], dialect), [])
+
+    for column in (title_column, amount_column):
+        if column not in columns:
+            raise ValidationError(_("There is no column %(column)s in the file"), code="invalid",
+                                  params={"column": column})
+
+    transfers = []
+
+    for line, row in enumerate(csv.DictReader(csvfile, columns, dialect=dialect), start=2):
+        try:
+            amount = parse_amount(row[amount_column] or "")
+        except InvalidOperation:
+            raise ValidationError(_("Line %(line)s - %(value)s is not an amount"), code="invalid",
+                                  params={"line": line, "value": row[amount_column]})
+
+        if amount > 0:
+            transfers.append({"line": line, "title": row[title_column] or "", "amount": amount})
+
+    return transfers
+
+
+class PaymentIndex:
+    """Participants of zosia indexed by short hash and normalized names, read with a single
+    query, so transfers are matched in memory."""
+
+    def __init__(self, zosia):
+        self.by_hash = {}
+        self.by_name = defaultdict(list)
+        rows = UserPreferences.objects.annotate_price().filter(zosia=zosia).values_list(
+            "pk", "user__first_name", "user__last_name", "user__hash", "computed_price",
+            "payment_accepted")
+
+        for pk, first_name, last_name, hash_, price, paid in rows:
+            participant = {"pk": pk, "name": f"{first_name} {last_name}", "expected": price,
+                           "paid": paid}
+
+            if hash_:
+                self.by_hash[hash_[:8]] = participant
+
+            for name in (f"{first_name} {last_name}", f"{last_name} {first_name}"):
+                self.by_name[" ".join(normalize_words(name))].append(participant)
+
+    def find(self, title):
+        """Returns participants whose short hash or else name is found in transfer title."""
+        words = normalize_words(title)
+
+        for word in words:
+            if word in self.by_hash:
+                return [self.by_hash[word]]
+
+        found = {}
+
+        for size in range(2, MAX_NAME_WORDS + 1):
+            for start in range(len(words) - size + 1):
+                for participant in self.by_name.get(" ".join(words[start:start + size]), []):
+                    found[participant["pk"]] = participant
+
+        return list(found.values())
+
+
+def match_transfers(zosia, transfers):
+    """Matches transfers to participants of zosia. A participant paying in several transfers
+    is compared with the sum of them."""
+    index = PaymentIndex(zosia)
+    matches = []
+    received = defaultdict(Decimal)
+
+    for transfer in transfers:
+        participants = index.find(transfer["title"])
+        participant = participants[0] if len(participants) == 1 else None
+        matches.append({**transfer, "participant": participant,
+                        "status": MATCH_AMBIGUOUS if len(participants) > 1 else MATCH_NOT_FOUND})
+
+        if participant is not None:
+            received[participant["pk"]] += transfer["amount"]
+
+    for match in matches:
+        participant = match["participant"]
+
+        if participant is None:
+            continue
+
+        if participant["paid"]:
+            match["status"] = MATCH_ALREADY_PAID
+        elif received[participant["pk"]] == participant["expected"]:
+            match["status"] = MATCH_OK
+        else:
+            match["status"] = MATCH_WRONG_AMOUNT
+
+        match["received"] = received[participant["pk"]]
+
+    return matches
+
+
+@transaction.atomic
+def accept_payments(zosia, preferences_pks):
+    """Accepts payments of given participants of zosia at once and returns how many were
+    accepted."""
+    preferences = UserPreferences.objects.filter(zosia=zosia, pk__in=preferences_pks,
+                                                 payment_accepted=False)
+
+    return UserPreferences.objects.bulk_set(preferences, payment_accepted=True)
@@ -1,12 +1,33 @@
-from django.test import TestCase
+from collections import Counter
+import csv
+from decimal import Decimal, InvalidOperation
+import io
+import random
+
+from anymail.exceptions import AnymailRecipientsRefused
+from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends import locmem
+from django.core.management import call_command
+from django.test import TestCase, override_settings
 from django.urls import reverse
 
+from users.bonus_plan import ORDER_BONUS, ORDER_HASHES, ORDER_REGISTRATION, \
+    ordered_participants, plan_bonus_minutes
 from users.forms import UserPreferencesAdminForm, UserPreferencesForm
-from users.models import UserPreferences
-from utils.constants import UserInternals
+from users.mail_queue import RateLimiter, claim_batch
+from users.models import MailJob, MailRecipient, User, UserPreferences
+from users.payments import MATCH_ALREADY_PAID, MATCH_AMBIGUOUS, MATCH_NOT_FOUND, MATCH_OK, \
+    MATCH_WRONG_AMOUNT, match_transfers, normalize_words, parse_amount, \
+    read_bank_statement
+from utils.constants import BONUS_STEP, MAIL_RECIPIENTS_SEARCH_LIMIT, MAX_BONUS_MINUTES, \
+    MIN_BONUS_MINUTES, MailInternals, PAYMENT_GROUPS, UserInternals
 from utils.test_helpers import PRICE_BASE, PRICE_BREAKFAST, PRICE_DINNER, PRICE_FULL, \
-    create_organization, create_user, create_user_preferences, create_zosia, login_as_user
-from utils.time_manager import timedelta_since_now
+    create_organization, create_transport, create_user, create_user_preferences, \
+    create_users_in_bulk, create_zosia, login_as_user
+from utils.time_manager import timedelta_since, timedelta_since_now
 
 
 class UserPreferencesTestCase(TestCase):
@@ -150,6 +171,67 @@ class UserPreferencesModelTestCase(UserPreferencesTestCase):
         self.assertTrue(user_prefs.payment_accepted)
 
 
+class UserPreferencesPriceTestCase(TestCase):
+    """Compares prices computed in bulk with `price` on randomly generated preferences."""
+    SEED = 2016
+    PREFERENCES_COUNT = 300
+    ZOSIA_PRICES = ("price_base", "price_transport", "price_transport_with_discount",
+                    "price_transfer_baggage", "price_accommodation", "price_accommodation_breakfast",
+                    "price_accommodation_dinner", "price_whole_day", "first_discount",
+                    "second_discount", "third_discount")
+    CHOICES = ("is_student", "transport_baggage", *PAYMENT_GROUPS,
+               *(meal for meals in PAYMENT_GROUPS.values() for meal in meals.values()))
+
+    def setUp(self):
+        super().setUp()
+        rng = random.Random(self.SEED)
+        # Zero prices and discounts higher than prices are the edge cases of price computation
+        zosias = [create_zosia(**{price: rng.choice([0, rng.randrange(1, 300)])
+                                  for price in self.ZOSIA_PRICES})
+                  for _ in range(3)]
+        transports = {zosia.pk: create_transport(zosia) for zosia in zosias}
+        users = create_users_in_bulk(self.PREFERENCES_COUNT)
+        preferences = []
+
+        for user in users:
+            zosia = rng.choice(zosias)
+            preferences.append(UserPreferences(
+                user=user, zosia=zosia, terms_accepted=True,
+                transport=rng.choice([None, transports[zosia.pk]]),
+                discount_round=rng.randrange(0, 4),
+                **{choice: rng.random() < 0.5 for choice in self.CHOICES}))
+
+        UserPreferences.objects.bulk_create(preferences)
+
+    def expected_prices(self):
+        return {prefs.pk: prefs.price for prefs in
+                UserPreferences.objects.select_related("zosia").order_by("pk")}
+
+    def test_annotated_price_equals_price(self):
+        with self.assertNumQueries(1):
+            prices = dict(UserPreferences.objects.annotate_price()
+                          .values_list("pk", "computed_price"))
+
+        self.assertEqual(prices, self.expected_prices(), f"seed {self.SEED}")
+
+    def test_batch_prices_equal_price(self):
+        preferences = list(UserPreferences.objects.order_by("pk"))
+
+        with self.assertNumQueries(1):
+            prices = UserPreferences.objects.prices(preferences)
+
+        self.assertEqual(dict(zip((prefs.pk for prefs in preferences), prices)),
+                         self.expected_prices(), f"seed {self.SEED}")
+
+    def test_annotated_price_can_be_filtered_by_conference(self):
+        prefs = UserPreferences.objects.select_related("zosia").first()
+
+        prices = UserPreferences.objects.annotate_price().filter(zosia=prefs.zosia) \
+            .values_list("pk", "computed_price")
+
+        self.assertIn((prefs.pk, prefs.price), prices)
+
+
 class UserPreferencesFormTestCase(TestCase):
     def setUp(self):
         super().setUp()
@@ -210,6 +292,283 @@ class UserPreferencesIndexTestCase(UserPreferencesTestCase):
                          list(UserPreferences.objects.filter(zosia=self.zosia).all()))
 
 
+class UserPreferencesCsvTestCase(UserPreferencesTestCase):
+    def setUp(self):
+        super().setUp()
+        organization = create_organization("ksi", accepted=True)
+        create_user_preferences(self.normal, self.zosia, organization=organization,
+                                payment_accepted=True, dinner_day_1=True)
+        create_user_preferences(self.staff, self.zosia)
+        login_as_user(self.staff, self.client)
+
+    def read_csv(self, response):
+        self.assertTrue(response.streaming)
+
+        return list(csv.reader(io.StringIO(b"".join(response.streaming_content).decode())))
+
+    def test_all_preferences(self):
+        rows = self.read_csv(self.client.get(reverse('list_csv_preferences_all')))
+
+        self.assertEqual(rows[0][:4], ["User", "Student", "Organization", "Paid"])
+        self.assertEqual(len(rows), 3)
+        normal_row = next(row for row in rows if row[0] == str(self.normal))
+        self.assertEqual(normal_row[2:5], ["ksi", "True", "False"])
+        self.assertEqual(normal_row[8], "True")
+        self.assertEqual(normal_row[-2:], ["S", "classic"])
+
+    def test_paid_preferences(self):
+        rows = self.read_csv(self.client.get(reverse('list_csv_preferences_paid')))
+
+        self.assertNotIn("Paid", rows[0])
+        self.assertEqual([row[0] for row in rows[1:]], [str(self.normal)])
+        self.assertEqual(len(rows[0]), len(rows[1]))
+
+    def test_shirt_no_longer_in_choices_is_listed_as_stored(self):
+        UserPreferences.objects.filter(user=self.normal).update(shirt_size="XXXXL", shirt_type="x")
+
+        rows = self.read_csv(self.client.get(reverse('list_csv_preferences_all')))
+
+        normal_row = next(row for row in rows if row[0] == str(self.normal))
+        self.assertEqual(normal_row[-2:], ["XXXXL", "x"])
+
+    def test_preferences_are_read_with_single_query(self):
+        for user in create_users_in_bulk(50):
+            create_user_preferences(user, self.zosia)
+
+        response = self.client.get(reverse('list_csv_preferences_all'))
+
+        with self.assertNumQueries(1):
+            rows = self.read_csv(response)
+
+        self.assertEqual(len(rows), 53)
+
+
+class PaymentsReportTestCase(UserPreferencesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.zosia.first_discount = 20
+        self.zosia.save()
+        self.transport = create_transport(self.zosia, name="Bus")
+        users = create_users_in_bulk(20)
+
+        for i, user in enumerate(users):
+            create_user_preferences(user, self.zosia, is_student=i % 2 == 0,
+                                    discount_round=i % 3, payment_accepted=i % 4 == 0,
+                                    transport=self.transport if i % 5 else None,
+                                    accommodation_day_1=True, dinner_day_1=i % 2 == 1)
+
+        create_user_preferences(self.normal, create_zosia(), payment_accepted=True)
+        self.preferences = list(UserPreferences.objects.filter(zosia=self.zosia)
+                                .select_related("user", "zosia", "transport"))
+
+    def read_csv(self, response):
+        self.assertTrue(response.streaming)
+
+        return list(csv.reader(io.StringIO(b"".join(response.streaming_content).decode())))
+
+    def totals(self, preferences):
+        expected = sum(prefs.price for prefs in preferences)
+        received = sum(prefs.price for prefs in preferences if prefs.payment_accepted)
+
+        return expected, received, expected - received
+
+    def test_report_requires_staff(self):
+        login_as_user(self.normal, self.client)
+        response = self.client.get(reverse('payments_report'))
+        self.assertRedirects(response, '/admin/login/?next=/accounts/preferences/payments/')
+        response = self.client.get(reverse('list_csv_payments'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_report_totals_equal_prices(self):
+        login_as_user(self.staff, self.client)
+
+        # Session, user, zosia, transports and three groupings of preferences
+        with self.assertNumQueries(7):
+            response = self.client.get(reverse('payments_report'))
+
+        total = response.context['total']
+        self.assertEqual((total['expected'], total['received'], total['outstanding']),
+                         self.totals(self.preferences))
+        self.assertEqual(total['participants'], 20)
+
+        for row in response.context['discount_rounds']:
+            group = [prefs for prefs in self.preferences if prefs.discount_round == row['name']]
+            self.assertEqual((row['expected'], row['received'], row['outstanding']),
+                             self.totals(group))
+            self.assertEqual(row['participants'], len(group))
+
+        self.assertEqual([row['name'] for row in response.context['transports']],
+                         [str(self.transport), None])
+
+        for row in response.context['transports']:
+            group = [prefs for prefs in self.preferences
+                     if (str(prefs.transport) if prefs.transport else None) == row['name']]
+            self.assertEqual((row['expected'], row['received'], row['outstanding']),
+                             self.totals(group))
+
+    def test_csv_lists_expected_amounts(self):
+        login_as_user(self.staff, self.client)
+        response = self.client.get(reverse('list_csv_payments'))
+
+        # Transports and the whole list of participants
+        with self.assertNumQueries(2):
+            rows = self.read_csv(response)
+
+        self.assertEqual(rows[0][:4], ["User", "Email", "Transfer title", "Expected amount"])
+        self.assertEqual(len(rows), 21)
+        by_title = {row[2]: row for row in rows[1:]}
+
+        for prefs in self.preferences:
+            row = by_title[prefs.transfer_title]
+            self.assertEqual(row[3:], [str(prefs.price), str(prefs.payment_accepted),
+                                       str(prefs.discount_round),
+                                       str(prefs.transport) if prefs.transport else ""])
+
+
+class PaymentsImportTestCase(UserPreferencesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = create_users_in_bulk(300)
+        self.preferences = [create_user_preferences(user, self.zosia, accommodation_day_1=True)
+                            for user in self.users[:4]]
+        self.preferences[3].payment_accepted = True
+        self.preferences[3].save()
+
+    def statement(self, *rows, delimiter=";"):
+        lines = [delimiter.join(("Date", "Title", "Amount"))]
+        lines.extend(delimiter.join(("2020-01-01", title, amount)) for title, amount in rows)
+
+        return io.StringIO("\n".join(lines) + "\n")
+
+    def match(self, *rows):
+        return match_transfers(self.zosia, read_bank_statement(self.statement(*rows),
+                                                               "Title", "Amount"))
+
+    def test_normalize_words(self):
+        self.assertEqual(normalize_words("ZOSIA - Łukasz Żółć-Nowak - 0a1b2c3d"),
+                         ["zosia", "lukasz", "zolc", "nowak", "0a1b2c3d"])
+
+    def test_read_bank_statement(self):
+        transfers = read_bank_statement(
+            self.statement(("First", "1 234,50"), ("Outgoing", "-20,00"), ("Second", "15")),
+            "Title", "Amount")
+
+        self.assertEqual(transfers, [
+            {"line": 2, "title": "First", "amount": Decimal("1234.50")},
+            {"line": 4, "title": "Second", "amount": Decimal("15")},
+        ])
+
+    def test_parse_amount(self):
+        for value in ("1234.50", "1234,5", "1 234,50", "1.234,50", "1,234.50", "1 234.50 PLN",
+                      "1234,50 zł"):
+            self.assertEqual(parse_amount(value), Decimal("1234.50"), value)
+
+        self.assertEqual(parse_amount("1,234,567"), Decimal("1234567"))
+        self.assertEqual(parse_amount("-20,00"), Decimal("-20"))
+
+        for value in ("ten", "1,2.3,4", "NaN", "Infinity", ""):
+            with self.assertRaises(InvalidOperation, msg=value):
+                parse_amount(value)
+
+    def test_read_bank_statement_errors(self):
+        with self.assertRaises(ValidationError):
+            read_bank_statement(self.statement(("First", "10")), "Description", "Amount")
+
+        with self.assertRaises(ValidationError):
+            read_bank_statement(self.statement(("First", "ten")), "Title", "Amount")
+
+    def test_match_transfers(self):
+        price = str(self.preferences[0].price)
+        matches = self.match(
+            (self.preferences[0].transfer_title, price),
+            ("Oplata bulk user1", price),
+            ("zosia", price),
+            (f"ZOSIA {self.users[2].short_hash}", "1"),
+            (self.preferences[3].transfer_title, price),
+        )
+
+        self.assertEqual([match["status"] for match in matches],
+                         [MATCH_OK, MATCH_OK, MATCH_NOT_FOUND, MATCH_WRONG_AMOUNT,
+                          MATCH_ALREADY_PAID])
+        self.assertEqual([match["participant"]["pk"] for match in matches if match["participant"]],
+                         [self.preferences[i].pk for i in (0, 1, 2, 3)])
+
+    def test_match_ambiguous_name(self):
+        for user in (self.normal, User.objects.create_user(
+                "other@example.com", first_name=self.normal.first_name,
+                last_name=self.normal.last_name)):
+            create_user_preferences(user, self.zosia)
+
+        matches = self.match((f"ZOSIA {self.normal.full_name}", "10"))
+
+        self.assertEqual(matches[0]["status"], MATCH_AMBIGUOUS)
+
+    def test_match_sums_split_transfers(self):
+        price = self.preferences[0].price
+        title = self.preferences[0].transfer_title
+        matches = self.match((title, str(price - 10)), (title, "10"))
+
+        self.assertEqual([match["status"] for match in matches], [MATCH_OK, MATCH_OK])
+
+    def test_match_many_transfers_with_single_query(self):
+        users = self.users[4:]
+        UserPreferences.objects.bulk_create(
+            UserPreferences(user=user, zosia=self.zosia, terms_accepted=True) for user in users)
+        transfers = [{"line": i, "title": f"ZOSIA - {user.full_name} - {user.short_hash}",
+                      "amount": Decimal(10)}
+                     for i, user in enumerate(users * 10)]
+
+        with self.assertNumQueries(1):
+            matches = match_transfers(self.zosia, transfers)
+
+        self.assertEqual(len(matches), len(transfers))
+        self.assertTrue(all(match["participant"] for match in matches))
+
+    def test_upload_statement(self):
+        login_as_user(self.staff, self.client)
+        statement = self.statement((self.preferences[0].transfer_title,
+                                    str(self.preferences[0].price)))
+        response = self.client.post(reverse('payments_import'), {
+            'file': SimpleUploadedFile("statement.csv", statement.getvalue().encode()),
+            'title_column': "Title",
+            'amount_column': "Amount",
+        })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['matches'][0]['status'], MATCH_OK)
+        self.assertContains(response, f'value="{self.preferences[0].pk}"')
+
+    def test_accept_payments(self):
+        login_as_user(self.staff, self.client)
+        response = self.client.post(reverse('payments_accept'), {
+            'preferences': [self.preferences[0].pk, self.preferences[1].pk,
+                            self.preferences[3].pk],
+        })
+
+        self.assertRedirects(response, reverse('payments_report'))
+        self.assertEqual(
+            list(UserPreferences.objects.filter(zosia=self.zosia).order_by("pk")
+                 .values_list("payment_accepted", flat=True)),
+            [True, True, False, True])
+
+    def test_invalid_participants_are_rejected(self):
+        login_as_user(self.staff, self.client)
+        response = self.client.post(reverse('payments_accept'), {
+            'preferences': [self.preferences[0].pk, 'x'],
+        })
+
+        self.assertRedirects(response, reverse('payments_import'))
+        self.preferences[0].refresh_from_db()
+        self.assertFalse(self.preferences[0].payment_accepted)
+
+    def test_accept_payments_requires_staff(self):
+        login_as_user(self.normal, self.client)
+        self.client.post(reverse('payments_accept'), {'preferences': [self.preferences[0].pk]})
+
+        self.preferences[0].refresh_from_db()
+        self.assertFalse(self.preferences[0].payment_accepted)
+
+
 class UserPreferencesAdminEditTestCase(UserPreferencesTestCase):
     def setUp(self):
         super().setUp()
@@ -251,6 +610,502 @@ class UserPreferencesAdminEditTestCase(UserPreferencesTestCase):
             UserPreferences.objects.filter(pk=self.user_prefs.pk).first().bonus_minutes, 20)
 
 
+class UserPreferencesBulkEditTestCase(UserPreferencesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = create_users_in_bulk(30)
+        UserPreferences.objects.bulk_create(
+            UserPreferences(user=user, zosia=self.zosia, terms_accepted=True)
+            for user in self.users)
+        self.preferences = list(UserPreferences.objects.filter(zosia=self.zosia).order_by("pk"))
+        self.other_prefs = create_user_preferences(self.users[0], create_zosia())
+        self.url = reverse('user_preferences_admin_bulk_edit')
+
+    def post(self, data):
+        login_as_user(self.staff, self.client)
+
+        return self.client.post(self.url, data)
+
+    def payments(self):
+        return list(UserPreferences.objects.filter(zosia=self.zosia).order_by("pk")
+                    .values_list("payment_accepted", flat=True))
+
+    def test_post_normal_user(self):
+        login_as_user(self.normal, self.client)
+        response = self.client.post(self.url, {'keys': str(self.preferences[0].pk),
+                                               'command': 'set_payment_accepted',
+                                               'payment_accepted': 'true'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn(True, self.payments())
+
+    def test_set_payment_by_keys(self):
+        keys = [prefs.pk for prefs in self.preferences[:20]]
+        login_as_user(self.staff, self.client)
+
+        # Session, user, zosia, zosias of selected preferences and the update
+        with self.assertNumQueries(5):
+            response = self.client.post(self.url, {
+                'keys': ",".join(map(str, keys)), 'command': 'set_payment_accepted',
+                'payment_accepted': 'true'})
+
+        self.assertEqual(response.json()['count'], 20)
+        self.assertEqual(self.payments(), [True] * 20 + [False] * 10)
+
+    def test_set_bonus_by_hashes(self):
+        hashes = [self.users[1].hash, self.users[2].short_hash.upper(), "", "abcdef12"]
+        response = self.post({
+            'hashes': SimpleUploadedFile("hashes.txt", "\n".join(hashes).encode()),
+            'command': 'change_bonus', 'bonus': 30})
+
+        self.assertEqual(response.json()['count'], 2)
+        self.assertEqual(response.json()['not_found'], ["abcdef12"])
+        self.assertEqual(
+            list(UserPreferences.objects.filter(bonus_minutes=30).values_list("pk", flat=True)
+                 .order_by("pk")),
+            [self.preferences[1].pk, self.preferences[2].pk])
+
+    def test_preferences_of_other_zosia_are_not_changed(self):
+        self.post({'keys': str(self.other_prefs.pk), 'command': 'set_payment_accepted',
+                   'payment_accepted': 'true'})
+
+        self.other_prefs.refresh_from_db()
+        self.assertFalse(self.other_prefs.payment_accepted)
+
+    def test_bonus_out_of_range(self):
+        for data in ({}, {'bonus': MAX_BONUS_MINUTES + 1}):
+            response = self.post({'keys': str(self.preferences[0].pk),
+                                  'command': 'change_bonus', **data})
+
+            self.assertEqual(response.status_code, 400)
+
+        self.assertFalse(UserPreferences.objects.exclude(bonus_minutes=0).exists())
+
+    def test_admin_actions(self):
+        admin = create_user(2, is_staff=True, is_superuser=True)
+        login_as_user(admin, self.client)
+        selected = [prefs.pk for prefs in self.preferences[:3]]
+        url = reverse('admin:users_userpreferences_changelist')
+
+        self.client.post(url, {'action': 'accept_payment', '_selected_action': selected})
+        self.client.post(url, {'action': 'set_bonus_minutes', '_selected_action': selected,
+                               'bonus_minutes': 40})
+
+        self.assertEqual(self.payments(), [True] * 3 + [False] * 27)
+        self.assertEqual(
+            list(UserPreferences.objects.filter(bonus_minutes=40).values_list("pk", flat=True)
+                 .order_by("pk")), selected)
+
+    def test_admin_action_rejects_invalid_bonus(self):
+        admin = create_user(2, is_staff=True, is_superuser=True)
+        login_as_user(admin, self.client)
+        url = reverse('admin:users_userpreferences_changelist')
+
+        for bonus in ('', 'x', MAX_BONUS_MINUTES + 1):
+            self.client.post(url, {'action': 'set_bonus_minutes', 'bonus_minutes': bonus,
+                                   '_selected_action': [self.preferences[0].pk]})
+
+        self.assertFalse(UserPreferences.objects.exclude(bonus_minutes=0).exists())
+
+
+class BonusPlanTestCase(UserPreferencesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = create_users_in_bulk(10)
+        UserPreferences.objects.bulk_create(
+            UserPreferences(user=user, zosia=self.zosia, terms_accepted=True,
+                            payment_accepted=i < 7, bonus_minutes=i)
+            for i, user in enumerate(self.users))
+        self.preferences = list(UserPreferences.objects.filter(zosia=self.zosia).order_by("pk"))
+        self.other_prefs = create_user_preferences(self.normal, create_zosia(),
+                                                   payment_accepted=True)
+
+    def bonuses(self):
+        return list(UserPreferences.objects.filter(zosia=self.zosia).order_by("pk")
+                    .values_list("bonus_minutes", flat=True))
+
+    def test_plan_bonus_minutes(self):
+        self.assertEqual(plan_bonus_minutes(7, 3), [6, 3, 3, 3, 0, 0, 0])
+        self.assertEqual(plan_bonus_minutes(0, 3), [])
+
+        bonuses = plan_bonus_minutes(10 * (MAX_BONUS_MINUTES // BONUS_STEP + 1) + 5, 10)
+
+        self.assertEqual(bonuses[:15], [MAX_BONUS_MINUTES] * 15)
+        self.assertEqual(max(Counter(bonuses[15:]).values()), 10)
+        self.assertTrue(all(bonus % BONUS_STEP == 0 for bonus in bonuses))
+        self.assertEqual(min(bonuses), MIN_BONUS_MINUTES)
+
+    def test_participants_are_ordered_by_hashes(self):
+        hashes = [self.users[5].hash[:8], self.users[9].hash, self.users[2].hash.upper()]
+
+        participants = ordered_participants(self.zosia, ORDER_HASHES, hashes)
+
+        self.assertEqual([pk for pk, bonus in participants],
+                         [self.preferences[i].pk for i in (5, 2, 0, 1, 3, 4, 6)])
+
+    def test_participants_are_ordered_by_current_bonus(self):
+        participants = ordered_participants(self.zosia, ORDER_BONUS)
+
+        self.assertEqual(participants,
+                         [(self.preferences[i].pk, i) for i in (6, 5, 4, 3, 2, 1, 0)])
+
+    def test_preview_shows_histogram(self):
+        login_as_user(self.staff, self.client)
+
+        response = self.client.post(reverse('bonus_plan'), {'per_minute': 3,
+                                                             'order': ORDER_REGISTRATION})
+
+        plan = response.context['plan']
+        self.assertEqual([(row['bonus'], row['current'], row['planned'])
+                          for row in plan['histogram']],
+                         [(6, 1, 1), (5, 1, 0), (4, 1, 0), (3, 1, 3), (2, 1, 0), (1, 1, 0),
+                          (0, 1, 3)])
+        self.assertEqual(plan['peak'], 3)
+        self.assertEqual(self.bonuses(), list(range(10)))
+
+    def test_hashes_are_required_for_order_of_hashes(self):
+        login_as_user(self.staff, self.client)
+
+        response = self.client.post(reverse('bonus_plan'), {'per_minute': 3,
+                                                            'order': ORDER_HASHES})
+
+        self.assertIn('hashes', response.context['form'].errors)
+        self.assertIsNone(response.context['plan'])
+
+    def test_apply_plan(self):
+        participants = [self.preferences[i].pk for i in (6, 5, 4, 3, 2, 1, 0, 8)] + \
+            [self.other_prefs.pk]
+        login_as_user(self.staff, self.client)
+
+        # Session, user, zosia, paid participants, the bulk update and its savepoint
+        with self.assertNumQueries(7):
+            response = self.client.post(reverse('bonus_plan_apply'), {
+                'per_minute': 2, 'participants': ",".join(map(str, participants))})
+
+        self.assertRedirects(response, reverse('rooms_rooming_schedule'),
+                             fetch_redirect_response=False)
+        self.assertEqual(self.bonuses(), [0, 0, 3, 3, 6, 6, 9, 7, 8, 9])
+        self.other_prefs.refresh_from_db()
+        self.assertEqual(self.other_prefs.bonus_minutes, 0)
+
+    def test_apply_plan_normal_user(self):
+        login_as_user(self.normal, self.client)
+
+        response = self.client.post(reverse('bonus_plan_apply'), {
+            'per_minute': 1, 'participants': str(self.preferences[0].pk)})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.bonuses(), list(range(10)))
+
+
+class MailFormTestCase(UserPreferencesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = create_users_in_bulk(50)
+        create_user_preferences(self.normal, self.zosia, payment_accepted=True)
+        create_user_preferences(self.staff, self.zosia)
+        login_as_user(self.staff, self.client)
+
+    def post(self, **data):
+        return self.client.post(reverse('mail_all'), {'subject': "Hello", 'text': "Text", **data})
+
+    def test_mail_page_doesnt_list_users(self):
+        # Session and user
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('mail_all'))
+
+        self.assertNotContains(response, self.users[0].email)
+
+    def test_groups_are_resolved_when_mail_is_sent(self):
+        for group, emails in (("payed", [self.normal.email]),
+                              ("not_Payed", [self.staff.email]),
+                              ("registered", [self.normal.email, self.staff.email]),
+                              ("staff", [self.staff.email])):
+            self.post(select_groups=group)
+
+            self.assertEqual(sorted(MailRecipient.objects.filter(job=MailJob.objects.last())
+                                    .values_list("email", flat=True)), sorted(emails), group)
+
+    def test_pick_users(self):
+        self.post(select_groups="pick", pick=f"{self.users[1].email},{self.users[2].email}")
+
+        self.assertEqual(sorted(MailRecipient.objects.values_list("email", flat=True)),
+                         sorted([self.users[1].email, self.users[2].email]))
+
+    def test_pick_requires_users(self):
+        response = self.post(select_groups="pick", pick="")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(MailJob.objects.exists())
+
+    def test_recipients_count(self):
+        for group, count in (("all_Users", 52), ("payed", 1), ("registered", 2), ("pick", 0)):
+            response = self.client.get(reverse('mail_recipients_count'), {'group': group})
+
+            self.assertEqual(response.json(), {'count': count})
+
+    def test_recipients_search(self):
+        response = self.client.get(reverse('mail_recipients_search'), {'q': "user1"})
+
+        self.assertEqual(len(response.json()['users']), MAIL_RECIPIENTS_SEARCH_LIMIT)
+        self.assertIn({'email': self.users[1].email, 'name': "User1 Bulk"},
+                      response.json()['users'])
+
+        response = self.client.get(reverse('mail_recipients_search'), {'q': "user49"})
+        self.assertEqual(response.json()['users'],
+                         [{'email': self.users[49].email, 'name': "User49 Bulk"}])
+
+    def test_recipients_endpoints_require_staff(self):
+        login_as_user(self.normal, self.client)
+
+        for url in ('mail_recipients_count', 'mail_recipients_search'):
+            self.assertEqual(self.client.get(reverse(url), {'q': "user"}).status_code, 302)
+
+
+class FailingEmailBackend(locmem.EmailBackend):
+    """Keeps messages like the locmem backend, but fails to send to chosen addresses."""
+    failing = {}
+    connections = 0
+
+    def open(self):
+        FailingEmailBackend.connections += 1
+
+    def send_messages(self, messages):
+        for message in messages:
+            for email in message.to:
+                if email in self.failing:
+                    raise self.failing[email]
+
+        return super().send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND=f"{__name__}.FailingEmailBackend", MAIL_QUEUE_MAX_ATTEMPTS=3,
+                   MAIL_QUEUE_RETRY_DELAY=60)
+class MailQueueTestCase(UserPreferencesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = create_users_in_bulk(5)
+        FailingEmailBackend.failing = {}
+        FailingEmailBackend.connections = 0
+
+    def send_mails(self, **kwargs):
+        call_command('send_mails', once=True, rate=0, stdout=io.StringIO(), **kwargs)
+
+    def statuses(self):
+        return dict(MailRecipient.objects.values_list("email", "status"))
+
+    def test_mail_form_queues_messages(self):
+        login_as_user(self.staff, self.client)
+        response = self.client.post(reverse('mail_all'), {
+            'subject': "Hello", 'text': "Text", 'select_groups': 'all_Users'})
+
+        job = MailJob.objects.get()
+        self.assertRedirects(response, reverse('mail_sent', kwargs={'pk': job.pk}))
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(job.created_by, self.staff)
+        self.assertEqual(job.progress(), {"total": 7, "pending": 7, "sent": 0, "failed": 0})
+
+    def test_messages_are_sent_in_batches(self):
+        MailJob.objects.create_for("Hello", "Text", [user.email for user in self.users])
+
+        self.send_mails(batch_size=2)
+
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         sorted(user.email for user in self.users))
+        self.assertEqual(mail.outbox[0].subject, "Hello")
+        self.assertEqual(FailingEmailBackend.connections, 3)
+        self.assertEqual(set(self.statuses().values()), {MailInternals.STATUS_SENT})
+
+    def test_failed_messages_are_retried(self):
+        FailingEmailBackend.failing = {self.users[0].email: OSError("Connection reset")}
+        job = MailJob.objects.create_for("Hello", "Text", [user.email for user in self.users])
+
+        self.send_mails()
+
+        recipient = job.recipients.get(email=self.users[0].email)
+        self.assertEqual((recipient.status, recipient.attempts, recipient.error),
+                         (MailInternals.STATUS_PENDING, 1, "Connection reset"))
+        self.assertEqual(len(mail.outbox), 4)
+
+        # The retry waits, until then the worker has nothing to send
+        self.send_mails()
+        self.assertEqual(len(mail.outbox), 4)
+
+        FailingEmailBackend.failing = {}
+        job.recipients.update(next_attempt_at=timedelta_since_now(seconds=-1))
+        self.send_mails()
+
+        recipient.refresh_from_db()
+        self.assertEqual((recipient.status, recipient.attempts, recipient.error),
+                         (MailInternals.STATUS_SENT, 2, ""))
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_messages_fail_after_all_attempts(self):
+        FailingEmailBackend.failing = {self.users[0].email: OSError("Connection reset")}
+        job = MailJob.objects.create_for("Hello", "Text", [self.users[0].email])
+
+        for _ in range(3):
+            job.recipients.update(next_attempt_at=timedelta_since_now(seconds=-1))
+            self.send_mails()
+
+        self.assertEqual(job.progress(), {"total": 1, "pending": 0, "sent": 0, "failed": 1})
+
+    def test_rejected_recipients_are_not_retried(self):
+        FailingEmailBackend.failing = {
+            self.users[0].email: AnymailRecipientsRefused("Recipient refused")}
+        job = MailJob.objects.create_for("Hello", "Text", [user.email for user in self.users])
+
+        self.send_mails()
+
+        self.assertEqual(job.progress(), {"total": 5, "pending": 0, "sent": 4, "failed": 1})
+
+    def test_claimed_messages_are_skipped_by_other_workers(self):
+        MailJob.objects.create_for("Hello", "Text", [user.email for user in self.users])
+
+        claimed = claim_batch(2)
+        self.send_mails()
+
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         sorted(user.email for user in self.users[2:]))
+        self.assertEqual([email for email, status in sorted(self.statuses().items())
+                          if status == MailInternals.STATUS_PENDING],
+                         sorted(recipient.email for recipient in claimed))
+
+    def test_messages_of_stopped_worker_are_sent_after_lease(self):
+        job = MailJob.objects.create_for("Hello", "Text", [user.email for user in self.users])
+        claim_batch(2)
+
+        job.recipients.update(next_attempt_at=timedelta_since_now(seconds=-1))
+        self.send_mails()
+
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(set(self.statuses().values()), {MailInternals.STATUS_SENT})
+
+    @override_settings(MAIL_QUEUE_RATE=0)
+    def test_cron_sends_queued_messages(self):
+        MailJob.objects.create_for("Hello", "Text", [user.email for user in self.users])
+
+        response = self.client.get(reverse('mail_queue_send'), HTTP_X_APPENGINE_CRON='true')
+
+        self.assertEqual(response.json(), {'processed': 5})
+        self.assertEqual(set(self.statuses().values()), {MailInternals.STATUS_SENT})
+
+    @override_settings(MAIL_QUEUE_RATE=0, MAIL_QUEUE_CRON_LIMIT=2)
+    def test_cron_sends_only_a_few_messages_per_request(self):
+        MailJob.objects.create_for("Hello", "Text", [user.email for user in self.users])
+
+        response = self.client.get(reverse('mail_queue_send'), HTTP_X_APPENGINE_CRON='true')
+
+        self.assertEqual(response.json(), {'processed': 2})
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(list(self.statuses().values()).count(MailInternals.STATUS_SENT), 2)
+
+    def test_only_cron_can_send_queued_messages(self):
+        MailJob.objects.create_for("Hello", "Text", [user.email for user in self.users])
+        login_as_user(self.staff, self.client)
+
+        response = self.client.get(reverse('mail_queue_send'))
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_progress_page(self):
+        job = MailJob.objects.create_for("Hello", "Text", [user.email for user in self.users])
+        FailingEmailBackend.failing = {
+            self.users[0].email: AnymailRecipientsRefused("Recipient refused")}
+        self.send_mails()
+        login_as_user(self.staff, self.client)
+
+        response = self.client.get(reverse('mail_sent', kwargs={'pk': job.pk}))
+
+        self.assertEqual(response.context['progress']['sent'], 4)
+        self.assertContains(response, "Recipient refused")
+
+    def test_rate_limiter_spaces_out_messages(self):
+        clock = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock[0] += seconds
+
+        limiter = RateLimiter(4, clock=lambda: clock[0], sleep=sleep)
+
+        for _ in range(3):
+            limiter.wait()
+
+        self.assertEqual(sleeps, [0.25, 0.25])
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class RoomingScheduleTestCase(UserPreferencesTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.normal_prefs = create_user_preferences(self.normal, self.zosia, bonus_minutes=10,
+                                                    payment_accepted=True)
+        self.staff_prefs = create_user_preferences(self.staff, self.zosia)
+
+    def tearDown(self):
+        cache.clear()
+        super().tearDown()
+
+    def test_schedule_contains_start_times_of_registered_users(self):
+        schedule = UserPreferences.objects.rooming_schedule(self.zosia)
+
+        self.assertEqual(schedule, {
+            self.normal.pk: timedelta_since(self.zosia.rooming_start, minutes=-10),
+            self.staff.pk: None,
+        })
+
+    def test_schedule_is_cached(self):
+        UserPreferences.objects.rooming_schedule(self.zosia)
+
+        with self.assertNumQueries(0):
+            UserPreferences.objects.rooming_schedule(self.zosia)
+
+    def test_schedule_is_rebuilt_after_admin_accepts_payment(self):
+        UserPreferences.objects.rooming_schedule(self.zosia)
+        login_as_user(self.staff, self.client)
+
+        self.client.post(reverse('user_preferences_admin_edit'),
+                         {'key': self.staff_prefs.pk, 'command': 'toggle_payment_accepted'})
+
+        self.assertEqual(UserPreferences.objects.rooming_schedule(self.zosia)[self.staff.pk],
+                         self.zosia.rooming_start)
+
+    def test_schedule_is_rebuilt_after_admin_changes_bonus(self):
+        UserPreferences.objects.rooming_schedule(self.zosia)
+        login_as_user(self.staff, self.client)
+
+        self.client.post(reverse('user_preferences_admin_edit'),
+                         {'key': self.normal_prefs.pk, 'command': 'change_bonus', 'bonus': 20})
+
+        self.assertEqual(UserPreferences.objects.rooming_schedule(self.zosia)[self.normal.pk],
+                         timedelta_since(self.zosia.rooming_start, minutes=-20))
+
+    def test_schedule_is_rebuilt_after_bulk_edit(self):
+        UserPreferences.objects.rooming_schedule(self.zosia)
+        login_as_user(self.staff, self.client)
+
+        self.client.post(reverse('user_preferences_admin_bulk_edit'), {
+            'keys': f"{self.normal_prefs.pk},{self.staff_prefs.pk}",
+            'command': 'set_payment_accepted', 'payment_accepted': 'true',
+        })
+
+        self.assertEqual(UserPreferences.objects.rooming_schedule(self.zosia)[self.staff.pk],
+                         self.zosia.rooming_start)
+
+    def test_schedule_follows_rooming_start_of_zosia(self):
+        UserPreferences.objects.rooming_schedule(self.zosia)
+
+        self.zosia.rooming_start = timedelta_since(self.zosia.rooming_start, minutes=30)
+        self.zosia.save()
+
+        self.assertEqual(UserPreferences.objects.rooming_schedule(self.zosia)[self.normal.pk],
+                         timedelta_since(self.zosia.rooming_start, minutes=-10))
+
+
 class UserPreferencesEditTestCase(UserPreferencesTestCase):
     def setUp(self):
         super().setUp()
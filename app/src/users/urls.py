@@ -9,6 +9,12 @@ urlpatterns = [
     re_path(r'^signup/$', anonymous_required(views.signup), name='accounts_signup'),
     re_path(r'^edit/$', views.account_edit, name='accounts_edit'),
     re_path(r'^mail/$', views.mail_to_all, name='mail_all'),
+    re_path(r'^mail/recipients/count/$', views.mail_recipients_count,
+            name='mail_recipients_count'),
+    re_path(r'^mail/recipients/search/$', views.mail_recipients_search,
+            name='mail_recipients_search'),
+    re_path(r'^mail/(?P<pk>\d+)/$', views.mail_sent, name='mail_sent'),
+    re_path(r'^mail/queue/send/$', views.mail_queue_send, name='mail_queue_send'),
     re_path(
         r'^activate/(?P<uidb64>[0-9A-Za-z_\-]+)/(?P<token>[0-9A-Za-z]{1,13}-[0-9A-Za-z]{1,40})/$',
         views.activate, name='accounts_activate'),
@@ -23,12 +29,22 @@ urlpatterns = [
     re_path(r'^preferences/$', views.user_preferences_index, name='user_preferences_index'),
     re_path(r'^preferences/admin/$', views.user_preferences_admin_edit,
             name='user_preferences_admin_edit'),
+    re_path(r'^preferences/admin/bulk/$', views.user_preferences_admin_bulk_edit,
+            name='user_preferences_admin_bulk_edit'),
     re_path(r'^preferences/(?P<pk>\d+)/edit$', views.user_preferences_edit,
             name='user_preferences_edit'),
     re_path(r'^preferences/list/all$', views.list_csv_preferences_all,
             name='list_csv_preferences_all'),
     re_path(r'^preferences/list/paid$', views.list_csv_preferences_paid,
             name='list_csv_preferences_paid'),
+    re_path(r'^preferences/payments/$', views.payments_report, name='payments_report'),
+    re_path(r'^preferences/payments/import/$', views.import_payments, name='payments_import'),
+    re_path(r'^preferences/payments/accept/$', views.accept_imported_payments,
+            name='payments_accept'),
+    re_path(r'^preferences/bonus/$', views.bonus_plan, name='bonus_plan'),
+    re_path(r'^preferences/bonus/apply/$', views.apply_planned_bonuses, name='bonus_plan_apply'),
+    re_path(r'^preferences/list/payments$', views.list_csv_payments,
+            name='list_csv_payments'),
     re_path(r'^lectures/list/all$', views.list_csv_lectures,
             name='list_csv_lectures'),
     re_path(r'^register/$', views.register, name='user_zosia_register'),
@@ -1,9 +1,14 @@
+from io import TextIOWrapper
+
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.tokens import default_token_generator
-from django.http import Http404, JsonResponse
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.http import Http404, HttpResponseForbidden, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
 from django.utils.html import escape
@@ -14,13 +19,20 @@ from conferences.models import Zosia
 from lectures.models import Lecture
 from users import forms
 from users.actions import ActivateUser
-from users.forms import OrganizationForm, UserPreferencesAdminForm, UserPreferencesForm
-from users.models import Organization, UserPreferences
+from users.bonus_plan import HIGHEST_PLANNED_BONUS, apply_bonus_plan, make_bonus_plan
+from users.forms import AcceptPaymentsForm, BankStatementForm, BonusPlanApplyForm, BonusPlanForm, \
+    OrganizationForm, UserPreferencesAdminForm, UserPreferencesBulkEditForm, UserPreferencesForm
+from users.mail_queue import RateLimiter, send_queued
+from users.models import MailJob, Organization, User, UserPreferences
+from users.payments import MATCH_OK, MATCH_STATUSES, PAYMENTS_CSV_HEADER, accept_payments, \
+    match_transfers, payment_rows, payment_totals, read_bank_statement
 from utils.constants import ADMIN_USER_PREFERENCES_COMMAND_CHANGE_BONUS, \
-    ADMIN_USER_PREFERENCES_COMMAND_TOGGLE_PAYMENT, BONUS_STEP, MAX_BONUS_MINUTES, \
-    MIN_BONUS_MINUTES, PAYMENT_GROUPS, UserInternals
+    ADMIN_USER_PREFERENCES_COMMAND_SET_PAYMENT, ADMIN_USER_PREFERENCES_COMMAND_TOGGLE_PAYMENT, \
+    BONUS_STEP, CSV_CHUNK_SIZE, MAIL_RECIPIENTS_SEARCH_LIMIT, MAX_BONUS_MINUTES, \
+    MIN_BONUS_MINUTES, MailInternals, PAYMENT_GROUPS, SHIRT_SIZE_CHOICES, \
+    SHIRT_TYPES_CHOICES, UserInternals
 from utils.forms import errors_format
-from utils.views import csv_response
+from utils.views import csv_response, validation_format
 
 
 @login_required
@@ -84,21 +96,63 @@ def account_edit(request):
 @require_http_methods(['GET', 'POST'])
 def mail_to_all(request):
     form = forms.MailForm(request.POST or None)
-    print(request.method)
     if request.method == 'POST':
-        print(form.errors)
         if form.is_valid():
-            form.send_mail()
-            text = form.cleaned_data.get('text')
-            subject = form.cleaned_data.get('subject')
-            receivers = form.receivers()
-            ctx = {'text': text, 'subject': subject, 'receivers': receivers}
-            return render(request, 'users/mail_sent.html', ctx)
+            job = form.send_mail(sender=request.user)
+            return redirect('mail_sent', pk=job.pk)
 
     ctx = {'form': form}
     return render(request, 'users/mail.html', ctx)
 
 
+@staff_member_required
+@require_http_methods(['GET'])
+def mail_recipients_count(request):
+    return JsonResponse({'count': forms.recipients_of_group(request.GET.get('group')).count()})
+
+
+@staff_member_required
+@require_http_methods(['GET'])
+def mail_recipients_search(request):
+    query = request.GET.get('q', '').strip()
+    users = []
+
+    if query:
+        users = User.objects \
+            .filter(Q(email__icontains=query) | Q(first_name__icontains=query) |
+                    Q(last_name__icontains=query)) \
+            .order_by('last_name', 'first_name') \
+            .values('email', 'first_name', 'last_name')[:MAIL_RECIPIENTS_SEARCH_LIMIT]
+
+    return JsonResponse({'users': [
+        {'email': user['email'], 'name': f"{user['first_name']} {user['last_name']}"}
+        for user in users]})
+
+
+@staff_member_required
+@require_http_methods(['GET'])
+def mail_sent(request, pk):
+    job = get_object_or_404(MailJob, pk=pk)
+    ctx = {
+        'job': job,
+        'progress': job.progress(),
+        'failed': job.recipients.filter(status=MailInternals.STATUS_FAILED).order_by('email'),
+    }
+    return render(request, 'users/mail_sent.html', ctx)
+
+
+@require_http_methods(['GET'])
+def mail_queue_send(request):
+    # App Engine removes this header from outside requests, so only its cron jobs can send it
+    if request.headers.get('X-Appengine-Cron') != 'true':
+        return HttpResponseForbidden()
+
+    processed = send_queued(settings.MAIL_QUEUE_BATCH_SIZE, RateLimiter(settings.MAIL_QUEUE_RATE),
+                            timeout=settings.MAIL_QUEUE_CRON_TIMEOUT,
+                            limit=settings.MAIL_QUEUE_CRON_LIMIT)
+    return JsonResponse({'processed': processed})
+
+
 @require_http_methods(['GET', 'POST'])
 def activate(request, uidb64, token):
     action = ActivateUser(
@@ -160,7 +214,7 @@ def toggle_organization(request):
 @staff_member_required()
 @require_http_methods(['GET'])
 def user_preferences_index(request):
-    zosia = get_object_or_404(Zosia, active=True)
+    zosia = Zosia.objects.find_active_or_404()
     # TODO: paging?
     user_preferences = UserPreferences.objects \
         .filter(zosia=zosia).select_related('user') \
@@ -170,6 +224,7 @@ def user_preferences_index(request):
         'objects': user_preferences,
         'change_bonus': ADMIN_USER_PREFERENCES_COMMAND_CHANGE_BONUS,
         'toggle_payment': ADMIN_USER_PREFERENCES_COMMAND_TOGGLE_PAYMENT,
+        'set_payment': ADMIN_USER_PREFERENCES_COMMAND_SET_PAYMENT,
         'min_bonus': MIN_BONUS_MINUTES,
         'max_bonus': MAX_BONUS_MINUTES,
         'bonus_step': BONUS_STEP,
@@ -235,6 +290,24 @@ def user_preferences_admin_edit(request):
     return Http404()
 
 
+@staff_member_required()
+@require_http_methods(['POST'])
+def user_preferences_admin_bulk_edit(request):
+    zosia = Zosia.objects.find_active_or_404()
+    form = UserPreferencesBulkEditForm(request.POST, request.FILES)
+
+    if not form.is_valid():
+        return JsonResponse({'msg': errors_format(form)}, status=400)
+
+    count = form.save(zosia)
+
+    return JsonResponse({
+        'msg': _("Changed preferences of %(count)s users") % {'count': count},
+        'count': count,
+        'not_found': form.missing_hashes(zosia),
+    })
+
+
 @login_required
 @require_http_methods(['GET', 'POST'])
 def register(request):
@@ -292,59 +365,175 @@ def register(request):
     return render(request, 'users/register.html', ctx)
 
 
+PREFERENCES_CSV_HEADER = ("User", "Student", "Organization", "Paid", "Baggage Transport",
+                          "AccommodationDay1", "AccommodationDay2", "AccommodationDay3",
+                          "DinnerDay1", "BreakfastDay2", "DinnerDay2", "BreakfastDay3",
+                          "DinnerDay3", "BreakfastDay4", "Vegetarian", "ShirtSize", "ShirtType")
+PREFERENCES_CSV_FIELDS = ("user__first_name", "user__last_name", "is_student",
+                          "organization__name", "payment_accepted", "transport_baggage",
+                          "accommodation_day_1", "accommodation_day_2", "accommodation_day_3",
+                          "dinner_day_1", "breakfast_day_2", "dinner_day_2", "breakfast_day_3",
+                          "dinner_day_3", "breakfast_day_4", "vegetarian", "shirt_size",
+                          "shirt_type")
+
+
+def preferences_csv_rows(prefs, with_payment=True):
+    shirt_sizes = dict(SHIRT_SIZE_CHOICES)
+    shirt_types = dict(SHIRT_TYPES_CHOICES)
+    rows = prefs.order_by("user__last_name", "user__first_name") \
+        .values_list(*PREFERENCES_CSV_FIELDS).iterator(chunk_size=CSV_CHUNK_SIZE)
+
+    for first_name, last_name, is_student, organization, paid, *flags, size, type_ in rows:
+        yield (f"{first_name} {last_name}", str(is_student), organization or "",
+               *([str(paid)] if with_payment else []), *map(str, flags),
+               str(shirt_sizes.get(size, size)), str(shirt_types.get(type_, type_)))
+
+
 @staff_member_required
 @require_http_methods(['GET'])
 def list_csv_preferences_all(request):
-    prefs = UserPreferences.objects.select_related('user').order_by("user__last_name",
-                                                                    "user__first_name")
-    header = ("User", "Student", "Organization", "Paid", "Baggage Transport", "AccommodationDay1", "AccommodationDay2",
-              "AccommodationDay3", "DinnerDay1", "BreakfastDay2", "DinnerDay2", "BreakfastDay3",
-              "DinnerDay3", "BreakfastDay4", "Vegetarian", "ShirtSize", "ShirtType")
-    data_list = [(
-        str(p.user), str(p.is_student), ("" if p.organization is None else str(p.organization.name)),
-        str(p.payment_accepted), str(p.transport_baggage),
-        str(p.accommodation_day_1), str(p.accommodation_day_2), str(p.accommodation_day_3),
-        str(p.dinner_day_1),
-        str(p.breakfast_day_2), str(p.dinner_day_2), str(p.breakfast_day_3), str(p.dinner_day_3),
-        str(p.breakfast_day_4), str(p.vegetarian), str(p.get_shirt_size_display()),
-        str(p.get_shirt_type_display())
-    ) for p in prefs
-    ]
-    return csv_response(header, data_list, filename="list_csv_preferences_all")
+    return csv_response(PREFERENCES_CSV_HEADER, preferences_csv_rows(UserPreferences.objects),
+                        filename="list_csv_preferences_all")
 
 
 @staff_member_required
 @require_http_methods(['GET'])
 def list_csv_preferences_paid(request):
-    prefs = UserPreferences.objects.select_related('user').filter(payment_accepted=True) \
-        .order_by("user__last_name", "user__first_name")
-    header = ("User", "Student", "Organization", "Baggage Transport", "AccommodationDay1", "AccommodationDay2",
-              "AccommodationDay3", "DinnerDay1", "BreakfastDay2", "DinnerDay2", "BreakfastDay3",
-              "DinnerDay3", "BreakfastDay4", "Vegetarian", "ShirtSize", "ShirtType")
-    data_list = [(
-        str(p.user), str(p.is_student), ("" if p.organization is None else str(p.organization.name)),
-        str(p.transport_baggage),
-        str(p.accommodation_day_1), str(p.accommodation_day_2), str(p.accommodation_day_3),
-        str(p.dinner_day_1), str(p.breakfast_day_2), str(p.dinner_day_2), str(p.breakfast_day_3),
-        str(p.dinner_day_3), str(p.breakfast_day_4), str(p.vegetarian),
-        str(p.get_shirt_size_display()),
-        str(p.get_shirt_type_display())
-    ) for p in prefs
-    ]
-    return csv_response(header, data_list, filename="list_csv_preferences_paid")
+    header = tuple(column for column in PREFERENCES_CSV_HEADER if column != "Paid")
+    prefs = UserPreferences.objects.filter(payment_accepted=True)
+
+    return csv_response(header, preferences_csv_rows(prefs, with_payment=False),
+                        filename="list_csv_preferences_paid")
+
+
+@staff_member_required
+@require_http_methods(['GET'])
+def payments_report(request):
+    zosia = Zosia.objects.find_active_or_404()
+    ctx = {'zosia': zosia, **payment_totals(zosia)}
+
+    return render(request, 'users/payments_report.html', ctx)
+
+
+@staff_member_required
+@require_http_methods(['GET'])
+def list_csv_payments(request):
+    zosia = Zosia.objects.find_active_or_404()
+
+    return csv_response(PAYMENTS_CSV_HEADER, payment_rows(zosia), filename="payments")
+
+
+@staff_member_required
+@require_http_methods(['GET', 'POST'])
+def import_payments(request):
+    zosia = Zosia.objects.find_active_or_404()
+    matches = None
+
+    if request.method == 'POST':
+        form = BankStatementForm(request.POST, request.FILES)
+
+        if form.is_valid():
+            try:
+                transfers = read_bank_statement(
+                    TextIOWrapper(request.FILES['file'].file, encoding='utf-8-sig'),
+                    form.cleaned_data['title_column'], form.cleaned_data['amount_column'])
+            except ValidationError as e:
+                messages.error(request, validation_format(e, _("Could not read bank statement")))
+            except UnicodeDecodeError:
+                messages.error(request, _("Bank statement must be encoded in UTF-8"))
+            else:
+                matches = match_transfers(zosia, transfers)
+
+                for match in matches:
+                    match['status_name'] = MATCH_STATUSES[match['status']]
+    else:
+        form = BankStatementForm()
+
+    ctx = {
+        'form': form,
+        'matches': matches,
+        'match_ok': MATCH_OK,
+    }
+
+    return render(request, 'users/payments_import.html', ctx)
+
+
+@staff_member_required
+@require_http_methods(['POST'])
+def accept_imported_payments(request):
+    zosia = Zosia.objects.find_active_or_404()
+    form = AcceptPaymentsForm(zosia, request.POST)
+
+    if not form.is_valid():
+        messages.error(request, errors_format(form))
+        return redirect('payments_import')
+
+    accepted = accept_payments(zosia, form.cleaned_data['preferences'])
+    messages.success(request, _("Accepted payments of %(count)s participants") %
+                     {'count': accepted})
+
+    return redirect('payments_report')
+
+
+@staff_member_required
+@require_http_methods(['GET', 'POST'])
+def bonus_plan(request):
+    zosia = Zosia.objects.find_active_or_404()
+    plan = None
+    apply_form = None
+
+    if request.method == 'POST':
+        form = BonusPlanForm(request.POST, request.FILES)
+
+        if form.is_valid():
+            plan = make_bonus_plan(zosia, form.cleaned_data['order'],
+                                   form.cleaned_data['per_minute'], form.cleaned_data['hashes'])
+            apply_form = BonusPlanApplyForm(initial={
+                'per_minute': form.cleaned_data['per_minute'],
+                'participants': plan['participants'],
+            })
+    else:
+        form = BonusPlanForm()
+
+    ctx = {
+        'form': form,
+        'plan': plan,
+        'apply_form': apply_form,
+        'max_bonus': HIGHEST_PLANNED_BONUS,
+    }
+
+    return render(request, 'users/bonus_plan.html', ctx)
+
+
+@staff_member_required
+@require_http_methods(['POST'])
+def apply_planned_bonuses(request):
+    zosia = Zosia.objects.find_active_or_404()
+    form = BonusPlanApplyForm(request.POST)
+
+    if not form.is_valid():
+        messages.error(request, errors_format(form))
+        return redirect('bonus_plan')
+
+    updated = apply_bonus_plan(zosia, form.cleaned_data['participants'],
+                               form.cleaned_data['per_minute'])
+    messages.success(request, _("Set bonus minutes of %(count)s participants") %
+                     {'count': updated})
+
+    return redirect('rooms_rooming_schedule')
 
 
 @staff_member_required
 @require_http_methods(['GET'])
 def list_csv_lectures(request):
-    lectures = Lecture.objects.all()
+    # There are few lectures, so they are fetched at once with their authors
+    lectures = Lecture.objects.select_related('author').prefetch_related('supporting_authors')
     header = ("Name", "Printed name", "Lecturers", "Duration", "Type",
               "Highlighted", "Comment")
-    data = [(
+    data = ((
         str(lecture.title), "", str(lecture.all_authors_names), str(lecture.duration),
         str(lecture.lecture_type),
         str("Yes" if lecture.author.person_type == UserInternals.PERSON_SPONSOR else "No"),
         str(lecture.requests),
-    ) for lecture in lectures
-    ]
+    ) for lecture in lectures)
     return csv_response(header, data, filename="lectures")
@@ -1,5 +1,11 @@
 # -*- coding: utf-8 -*-
+import json
+
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
 from rest_framework.permissions import BasePermission, SAFE_METHODS
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils import encoders
 
 
 class ReadAuthenticatedWriteAdmin(BasePermission):
@@ -7,3 +13,60 @@ class ReadAuthenticatedWriteAdmin(BasePermission):
         sender = request.user
 
         return sender.is_authenticated and (request.method in SAFE_METHODS or sender.is_staff)
+
+
+class EventStreamRenderer(BaseRenderer):
+    """Accepts clients of Server-Sent Events streams. Streams bypass rendering, so only error
+    responses are rendered here."""
+    media_type = "text/event-stream"
+    format = "event-stream"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data).encode()
+
+
+class EncodedJSON(dict):
+    """Serialized object kept together with its JSON, so it's encoded only once."""
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.encoded = json.dumps(data, cls=encoders.JSONEncoder, ensure_ascii=False,
+                                  separators=(",", ":")).encode()
+
+
+class EncodedJSONList(list):
+    """List of `EncodedJSON` objects, rendered by joining their JSON."""
+
+
+class CompactJSONRenderer(JSONRenderer):
+    """Renders JSON without whitespace, joining already encoded objects instead of encoding them
+    again. Indented JSON of the browsable API is rendered as usual."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+
+        if isinstance(data, EncodedJSONList) and indent is None:
+            return b"[" + b",".join(item.encoded for item in data) + b"]"
+
+        return super().render(data, accepted_media_type, renderer_context)
+
+
+def make_etag(*parts):
+    return quote_etag("-".join(map(str, parts)))
+
+
+def conditional_response(request, etag, get_response):
+    """Responds with 304 Not Modified if the client already has data tagged with `etag`,
+    without calling `get_response` at all. Otherwise tags the response from `get_response`.
+
+    Clients have to revalidate tagged responses every time, as they change with rooming.
+    """
+    response = get_conditional_response(request, etag=etag)
+
+    if response is None:
+        response = get_response()
+
+    response["ETag"] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+
+    return response
@@ -0,0 +1,201 @@
+import time
+import uuid
+
+from asgiref.local import Local
+from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
+
+_request_local = Local()
+
+# Generation of the shared cache last seen by this process, for every tiered cache
+_generations = {}
+
+GENERATION_KEY = "utils.cache.generation"
+
+
+class RequestCacheMiddleware:
+    """Keeps values cached with `get_cached` for the duration of a single request."""
+
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _request_local.values = {}
+
+        try:
+            return self.get_response(request)
+        finally:
+            _request_local.values = None
+
+
+def get_cached(key, compute, timeout):
+    """Returns value cached for the current request or in the shared cache.
+
+    The value is computed and cached for `timeout` seconds when missing. Outside of a request
+    only the shared cache is used.
+    """
+    request_values = getattr(_request_local, "values", None)
+
+    if request_values is not None and key in request_values:
+        return request_values[key]
+
+    value = cache.get_or_set(key, compute, timeout)
+
+    if request_values is not None:
+        request_values[key] = value
+
+    return value
+
+
+def _forget(key):
+    request_values = getattr(_request_local, "values", None)
+
+    if request_values is not None:
+        request_values.pop(key, None)
+
+    cache.delete(key)
+
+
+def invalidate(key):
+    """Removes value from the current request and the shared cache.
+
+    Within a transaction value is removed again after commit, as other requests might have cached
+    the old state before the change was committed.
+    """
+    _forget(key)
+
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: _forget(key))
+
+
+class TieredCache(BaseCache):
+    """Shared cache with copies of values kept by every process, which are read without asking
+    the shared cache.
+
+    Every write to the shared cache changes its generation, a random token that processes check
+    at most once per `CHECK_INTERVAL` seconds. A process that sees a changed generation drops all
+    of its copies. Copies also expire after `LOCAL_TIMEOUT` seconds. This limits how long a copy
+    can be outdated when a write races with a check.
+
+    Options are `SHARED`, with settings of the shared cache, `LOCAL_TIMEOUT`, `CHECK_INTERVAL`
+    and `MAX_ENTRIES` of copies.
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        shared = options["SHARED"]
+        self.shared = import_string(shared["BACKEND"])(shared.get("LOCATION", ""), shared)
+        self.local_timeout = options.get("LOCAL_TIMEOUT", 10)
+        self.check_interval = options.get("CHECK_INTERVAL", 1)
+        # Copies are shared by all threads of the process, like the last seen generation
+        self.local = LocMemCache(f"tiered:{location}", {
+            "TIMEOUT": self.local_timeout,
+            "OPTIONS": {"MAX_ENTRIES": options.get("MAX_ENTRIES", self._max_entries)},
+        })
+        self.seen = _generations.setdefault(location, {"token": None, "checked_at": None})
+
+    def _check_generation(self, force=False):
+        checked_at = self.seen["checked_at"]
+
+        if not force and checked_at is not None and \
+                time.monotonic() - checked_at < self.check_interval:
+            return
+
+        token = self.shared.get(GENERATION_KEY)
+
+        if token != self.seen["token"]:
+            self.local.clear()
+
+        self.seen.update(token=token, checked_at=time.monotonic())
+
+    def _change_generation(self):
+        # Writes of other processes since the last check are applied first, so the new token
+        # doesn't hide them
+        self._check_generation(force=True)
+        token = uuid.uuid4().hex
+        self.shared.set(GENERATION_KEY, token, None)
+        self.seen.update(token=token, checked_at=time.monotonic())
+
+    def _local_timeout(self, timeout):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+
+        return self.local_timeout if timeout is None else min(timeout, self.local_timeout)
+
+    def get(self, key, default=None, version=None):
+        self._check_generation()
+        value = self.local.get(key, self._missing_key, version)
+
+        if value is self._missing_key:
+            value = self.shared.get(key, self._missing_key, version)
+
+            if value is self._missing_key:
+                return default
+
+            self.local.set(key, value, version=version)
+
+        return value
+
+    def get_many(self, keys, version=None):
+        self._check_generation()
+        values = self.local.get_many(keys, version)
+        missing = [key for key in keys if key not in values]
+
+        if missing:
+            shared_values = self.shared.get_many(missing, version)
+            self.local.set_many(shared_values, version=version)
+            values.update(shared_values)
+
+        return values
+
+    def has_key(self, key, version=None):
+        return self.get(key, self._missing_key, version) is not self._missing_key
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        # Nobody has a copy of a missing value, so the generation stays
+        added = self.shared.add(key, value, timeout, version)
+
+        if added:
+            self.local.set(key, value, self._local_timeout(timeout), version)
+
+        return added
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.shared.set(key, value, timeout, version)
+        self._change_generation()
+        self.local.set(key, value, self._local_timeout(timeout), version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.shared.set_many(data, timeout, version)
+        self._change_generation()
+        self.local.set_many({key: value for key, value in data.items() if key not in failed},
+                            self._local_timeout(timeout), version)
+
+        return failed
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.shared.touch(key, timeout, version)
+
+    def delete(self, key, version=None):
+        deleted = self.shared.delete(key, version)
+        self._change_generation()
+        self.local.delete(key, version)
+
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        self.shared.delete_many(keys, version)
+        self._change_generation()
+        self.local.delete_many(keys, version)
+
+    def clear(self):
+        self.shared.clear()
+        self.local.clear()
+        self._change_generation()
+
+    def close(self, **kwargs):
+        self.shared.close(**kwargs)
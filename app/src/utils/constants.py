@@ -4,6 +4,9 @@ from django.utils.translation import ugettext_lazy as _
 
 DELIMITER = ", "
 
+# Number of rows fetched from the database at once by CSV exports
+CSV_CHUNK_SIZE = 500
+
 # Shirts
 # NOTE: We should consider not to hardcode that but rather set in options
 SHIRT_SIZE_CHOICES = [
@@ -25,6 +28,8 @@ ADMIN_USER_PREFERENCES_COMMAND_TOGGLE_PAYMENT = "toggle_payment_accepted"
 
 ADMIN_USER_PREFERENCES_COMMAND_CHANGE_BONUS = "change_bonus"
 
+ADMIN_USER_PREFERENCES_COMMAND_SET_PAYMENT = "set_payment_accepted"
+
 # Conferences
 PAYMENT_GROUPS = {
     'accommodation_day_1': {'dinner': 'dinner_day_1', 'breakfast': 'breakfast_day_2'},
@@ -41,6 +46,15 @@ class RoomingStatus:
     ROOMING_PROGRESS = 3
 
 
+class RoomEventType:
+    JOINED = "joined"
+    LEFT = "left"
+    LOCKED = "locked"
+    UNLOCKED = "unlocked"
+    HIDDEN = "hidden"
+    UNHIDDEN = "unhidden"
+
+
 MIN_BONUS_MINUTES = 0
 MAX_BONUS_MINUTES = 600
 BONUS_STEP = 3
@@ -109,6 +123,25 @@ PERSON_TYPE = [
 
 II_UWR_EMAIL_DOMAIN = "@cs.uni.wroc.pl"
 
+
+class MailInternals:
+    STATUS_PENDING = "pending"
+
+    STATUS_SENT = "sent"
+
+    # Rejected by the provider or still failing after all attempts
+    STATUS_FAILED = "failed"
+
+
+# Users suggested while picking mail recipients
+MAIL_RECIPIENTS_SEARCH_LIMIT = 10
+
+MAIL_STATUS = [
+    (MailInternals.STATUS_PENDING, _("Pending")),
+    (MailInternals.STATUS_SENT, _("Sent")),
+    (MailInternals.STATUS_FAILED, _("Failed")),
+]
+
 # Sponsors
 class SponsorInternals:
     TYPE_BRONZE = "bronze"
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.db import BaseDatabaseCache
+from django.core.management.commands import createcachetable
+
+from utils.cache import TieredCache
+
+
+class Command(createcachetable.Command):
+    """Also creates tables of database caches shared through `TieredCache`."""
+
+    def handle(self, *tablenames, **options):
+        super().handle(*tablenames, **options)
+
+        if tablenames:
+            return
+
+        for cache_alias in settings.CACHES:
+            cache = caches[cache_alias]
+
+            if isinstance(cache, TieredCache) and isinstance(cache.shared, BaseDatabaseCache):
+                self.create_table(options['database'], cache.shared._table, options['dry_run'])
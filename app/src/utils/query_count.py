@@ -0,0 +1,23 @@
+from django.db import connection
+
+
+class QueryCountMiddleware:
+    """Reports number of database queries made while handling a request in `X-Query-Count`
+    response header. Meant for benchmarks, see `rooming_loadtest` command."""
+
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        count = 0
+
+        def count_query(execute, sql, params, many, context):
+            nonlocal count
+            count += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_query):
+            response = self.get_response(request)
+
+        response["X-Query-Count"] = str(count)
+        return response
@@ -1,4 +1,8 @@
 # -*- coding: utf-8 -*-
+import json
+import os
+import subprocess
+import sys
 
 from conferences.models import Place, Transport, Zosia
 from users.models import Organization, User, UserPreferences
@@ -21,6 +25,25 @@ USER_DATA = [
 ]
 
 
+def production_settings(*names):
+    """Returns values of production settings, read in a separate process, as importing production
+    settings changes dicts shared with settings of tests."""
+    code = ("import json\nfrom zosia16.settings import prod\n"
+            f"print(json.dumps([getattr(prod, name) for name in {names!r}]))")
+    result = subprocess.run([sys.executable, "-c", code],
+                            env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+                            capture_output=True, text=True, check=True)
+
+    return json.loads(result.stdout)
+
+
+def report_benchmark(test, message):
+    """Prints result of a benchmark test, only if REPORT_BENCHMARKS environment variable is set,
+    so the output of tests stays clean."""
+    if os.environ.get("REPORT_BENCHMARKS"):
+        print(f"\n{test.id()}: {message}")
+
+
 def login_as_user(user, client, /):
     return client.login(
         email=user.email,
@@ -70,6 +93,15 @@ def create_user(index, /, person_type=UserInternals.PERSON_NORMAL, **kwargs):
                                     person_type=person_type, **kwargs)
 
 
+def create_users_in_bulk(count, /, **kwargs):
+    """Creates count users at once, skipping password hashing. These users cannot log in."""
+    return User.objects.bulk_create([
+        User(email=f"user{i}@example.com", first_name=f"User{i}", last_name="Bulk",
+             hash=f"{i:08x}" * 8, **kwargs)
+        for i in range(count)
+    ])
+
+
 def create_user_preferences(user, zosia, **kwargs):
     return UserPreferences.objects.create(user=user, zosia=zosia, terms_accepted=True, **kwargs)
 
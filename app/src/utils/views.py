@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 import csv
 from functools import wraps
+from itertools import chain
 
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.shortcuts import redirect
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
@@ -19,14 +20,20 @@ def anonymous_required(view):
     return func
 
 
+class _Echo:
+    """File-like object which returns written lines instead of storing them."""
+
+    def write(self, value):
+        return value
+
+
 def csv_response(header, data, filename='file'):
-    response = HttpResponse(content_type='text/csv')
+    """Streams CSV file with rows produced lazily by `data`, so the file is never kept in memory.
+    Querysets in `data` should be read with `.iterator(chunk_size=CSV_CHUNK_SIZE)`."""
+    writer = csv.writer(_Echo())
+    response = StreamingHttpResponse(
+        (writer.writerow(row) for row in chain([header], data)), content_type='text/csv')
     response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
-    writer = csv.writer(response)
-    writer.writerow(header)
-
-    for row in data:
-        writer.writerow(row)
 
     return response
 
@@ -101,8 +101,90 @@ REST_FRAMEWORK = {
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticated",
     ],
+    "DEFAULT_RENDERER_CLASSES": [
+        "utils.api.CompactJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
+}
+
+# API responses of at least this many bytes are compressed, with brotli if the `brotli` package
+# is installed and the client accepts it, otherwise with gzip
+COMPRESSION_PATH_PREFIX = "/api/"
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_BROTLI_QUALITY = 5
+
+# Cache shared by all workers, which doesn't need any other service. Database table (created with
+# `createcachetable`) is shared by all instances, so invalidations reach every one of them. Files
+# are shared only by workers of a single host, so they fit a single server, never autoscaling.
+# Each process keeps copies of values read from it, so warm reads don't query the database. The
+# copies are dropped within CHECK_INTERVAL seconds after any process writes to the shared cache.
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "database")
+SHARED_CACHE = {
+    "BACKEND": "utils.cache.TieredCache",
+    "LOCATION": "zosia",
+    "OPTIONS": {
+        "SHARED": {
+            "BACKEND": {
+                "file": "django.core.cache.backends.filebased.FileBasedCache",
+                "database": "django.core.cache.backends.db.DatabaseCache",
+            }[CACHE_BACKEND],
+            "LOCATION": os.environ.get(
+                "CACHE_LOCATION",
+                {"file": "/tmp/zosia_cache", "database": "zosia_cache"}[CACHE_BACKEND]),
+            # Room fragments are kept for every version of each room until they expire
+            "OPTIONS": {
+                "MAX_ENTRIES": 20000,
+            },
+        },
+        "LOCAL_TIMEOUT": 10,
+        "CHECK_INTERVAL": 1,
+        "MAX_ENTRIES": 5000,
+    },
 }
 
+# Seconds for which active conference is cached, it's also invalidated whenever it changes
+ACTIVE_ZOSIA_CACHE_TIMEOUT = 60
+# Seconds for which rooming start times of users are cached, they're also invalidated whenever
+# preferences of any user change
+ROOMING_SCHEDULE_CACHE_TIMEOUT = 60
+# Seconds for which JSON of a room is cached for each version of the room, so changes of names
+# of its members are shown at most this late
+ROOMS_FRAGMENT_CACHE_TIMEOUT = 300
+# Seconds for which snapshot of rooms shown on the rooms page is cached, it's also rebuilt
+# whenever rooms change
+ROOMS_SNAPSHOT_CACHE_TIMEOUT = 3600
+# Seconds for which numbers on the statistics dashboard are cached, they're not invalidated
+STATISTICS_CACHE_TIMEOUT = 30
+
+# Mass mail queue, sent by the App Engine cron job in cron.yaml or by the send_mails command
+MAIL_QUEUE_BATCH_SIZE = 50
+# Messages sent per second, 0 disables the limit
+MAIL_QUEUE_RATE = 5
+MAIL_QUEUE_MAX_ATTEMPTS = 5
+# Seconds before the first retry of a failed message, doubled with every next attempt
+MAIL_QUEUE_RETRY_DELAY = 60
+# Seconds between checks of the queue when it is empty
+MAIL_QUEUE_POLL_INTERVAL = 5
+# Seconds for which claimed messages are skipped by other workers. Messages of a worker which
+# stopped before saving their results are sent again afterwards, so it must exceed sending a batch.
+MAIL_QUEUE_LEASE = 300
+# A cron request holds a web worker, so it sends only a few messages: at most this many, and it
+# doesn't start another batch after the timeout in seconds. At MAIL_QUEUE_RATE that takes a few
+# seconds, large queues should be sent by the send_mails command instead.
+MAIL_QUEUE_CRON_LIMIT = 15
+MAIL_QUEUE_CRON_TIMEOUT = 3
+
+# Room events streamed to the room page (Server-Sent Events). Every open stream holds a worker
+# thread and App Engine standard buffers responses, so they're enabled only where an async worker
+# is deployed. Otherwise the page polls the changes feed.
+ROOMS_EVENTS_ENABLED = False
+# Local broadcaster reaches only clients connected to the same process
+ROOMS_EVENTS_BROADCASTER = "rooms.events.LocalBroadcaster"
+# Seconds after which the stream is closed and the client reconnects
+ROOMS_EVENTS_STREAM_TIMEOUT = 60
+ROOMS_EVENTS_HEARTBEAT = 15
+ROOMS_EVENTS_RETRY = 3
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -131,6 +213,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "utils.compression.CompressionMiddleware",
+    "utils.cache.RequestCacheMiddleware",
     "utils.www_redirect.NoWWWRedirectMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
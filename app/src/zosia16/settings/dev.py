@@ -50,6 +50,9 @@ CACHES = {
 DATABASES['default']['HOST'] = 'db'
 DATABASES['default']['PASSWORD'] = 'zosia'
 
+# Deliver room events through Postgres, the same way as in production
+ROOMS_EVENTS_BROADCASTER = 'rooms.events.PostgresBroadcaster'
+
 # This, in conjunction with DEBUG=True enables 'debug' directives in templates
 # Especially room.js makes heavy use of it
 INTERNAL_IPS = ['127.0.0.1']
@@ -0,0 +1,10 @@
+from .dev import *
+
+# Run the server under load the same way as in production, but report queries of each request
+DEBUG = False
+
+CACHES = {
+    'default': SHARED_CACHE,
+}
+
+MIDDLEWARE = ['utils.query_count.QueryCountMiddleware'] + MIDDLEWARE
@@ -43,9 +43,7 @@ LOGGING = {
 }
 
 CACHES = {
-    "default": {
-        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
-    }
+    "default": SHARED_CACHE,
 }
 
 DATABASES["default"]["CONN_MAX_AGE"] = 5
@@ -53,17 +51,13 @@ DATABASES["default"]["HOST"] = os.environ.get("DB_HOST")
 DATABASES["default"]["USER"] = os.environ.get("DB_USERNAME")
 DATABASES["default"]["PASSWORD"] = os.environ.get("DB_PASSWORD")
 
+# Deliver room events to all gunicorn workers, if they're enabled
+ROOMS_EVENTS_BROADCASTER = "rooms.events.PostgresBroadcaster"
+
 # This, in conjunction with DEBUG=True enables 'debug' directives in templates
 # Especially room.js makes heavy use of it
 INTERNAL_IPS = ["127.0.0.1"]
 
 # Django REST framework (https://www.django-rest-framework.org)
 # Disable BrowsableAPIRenderer for production
-REST_FRAMEWORK = {
-    "DEFAULT_RENDERER_CLASSES": ("rest_framework.renderers.JSONRenderer",)
-}
-
-# The maximum number of parameters that may be received via GET or POST.
-# Our current implementation of the email module can generate quite a lot
-# parameters and thus exceed the limit (default 1000).
-DATA_UPLOAD_MAX_NUMBER_FIELDS = 1500
+REST_FRAMEWORK["DEFAULT_RENDERER_CLASSES"] = ("utils.api.CompactJSONRenderer",)
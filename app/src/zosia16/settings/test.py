@@ -2,3 +2,10 @@ from .common import *
 
 DATABASES['default']['USER'] = 'zosia'
 DATABASES['default']['HOST'] = '0.0.0.0'
+
+# Tests roll back database changes without invalidating cached data, so nothing is cached
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    }
+}
@@ -3,8 +3,9 @@
 
 import argparse as argp
 from os.path import dirname, normpath
+import secrets
 import subprocess as subp
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 
 class Colour:
@@ -28,6 +29,9 @@ FILE_SYSTEM_NOTE = (
 SUBCOMMANDS_NOTE = "[contains subcommands]"
 DEBUG_MODE = False
 
+LOADTEST_PORT = 8001
+LOADTEST_PID_FILE = "/tmp/zosia_loadtest.pid"
+
 
 def command_run(command: List[str]) -> int:
     if DEBUG_MODE:
@@ -52,12 +56,15 @@ def docker_exec(command: List[str], container: str) -> None:
     command_run(["docker", "exec", "-it", container] + command)
 
 
-def docker_shell(command: List[str]) -> None:
-    docker_exec(["/bin/bash", "-c", subp.list2cmdline(command)], WEB_CONTAINER_NAME)
+def docker_shell(command: List[str], env: Optional[Dict[str, str]] = None,
+                 detach: bool = False) -> None:
+    env_opts = [opt for name, value in (env or {}).items() for opt in ["-e", f"{name}={value}"]]
+    command_run(["docker", "exec"] + (["-d"] if detach else ["-it"]) + env_opts
+                + [WEB_CONTAINER_NAME, "/bin/bash", "-c", subp.list2cmdline(command)])
 
 
-def docker_python(command: List[str]) -> None:
-    docker_shell(["python", "src/manage.py"] + command)
+def docker_python(command: List[str], env: Optional[Dict[str, str]] = None) -> None:
+    docker_shell(["python", "src/manage.py"] + command, env)
 
 
 def docker_compose_run(command: List[str], with_project: bool = True) -> None:
@@ -99,7 +106,7 @@ def run_server(display_remind: bool = False) -> None:
         remind_quit()
 
 
-def run_tests(modules: Optional[List[str]], is_verbose: bool):
+def run_tests(modules: Optional[List[str]], is_verbose: bool, is_benchmarks: bool = False):
     command = ["test"]
 
     if modules:
@@ -108,7 +115,8 @@ def run_tests(modules: Optional[List[str]], is_verbose: bool):
     if is_verbose:
         command += ["-v", "2"]
 
-    docker_python(command)
+    # Benchmark tests only assert bounds, their results are printed on request
+    docker_python(command, {"REPORT_BENCHMARKS": "1"} if is_benchmarks else None)
 
 
 def migrate(is_create_admin: bool, is_create_data: bool) -> None:
@@ -126,6 +134,34 @@ def migrate(is_create_admin: bool, is_create_data: bool) -> None:
         docker_python(["create_data"])
 
 
+def run_loadtest(is_create_data: bool, users: int, rooms: int, clients: int,
+                 iterations: int) -> None:
+    # Server and test command must share the secret key, as the test logs users in by creating
+    # their sessions directly in the database
+    env = {"SECRET_KEY": secrets.token_urlsafe(32),
+           "DJANGO_SETTINGS_MODULE": "zosia16.settings.loadtest"}
+
+    if is_create_data:
+        print(f"{Colour.PURPLE}-- Replace data with {users} users and {rooms} rooms --"
+              f"{Colour.NORMAL}")
+        docker_python(["flush", "--no-input"], env)
+        docker_python(["create_data", "--users", str(users), "--rooms", str(rooms),
+                       "--paid-ratio", "0.9", "--staggered-bonus", "--no-input"], env)
+
+    docker_python(["createcachetable"], env)
+    print(f"{Colour.PURPLE}-- Start server (localhost, port {LOADTEST_PORT}) --{Colour.NORMAL}")
+    docker_shell(["gunicorn", "--chdir", "src", "--bind", f":{LOADTEST_PORT}",
+                  "--workers", "2", "--pid", LOADTEST_PID_FILE, "zosia16.wsgi:application"],
+                 env, detach=True)
+
+    try:
+        docker_python(["rooming_loadtest", "--reset", "--url", f"http://localhost:{LOADTEST_PORT}",
+                       "--clients", str(clients), "--iterations", str(iterations)], env)
+    finally:
+        print(f"{Colour.PURPLE}-- Stop server --{Colour.NORMAL}")
+        docker_shell(["kill", f"$(cat {LOADTEST_PID_FILE})"])
+
+
 def cli():
     parser = argp.ArgumentParser()
     parser.add_argument("-d", "--debug", action="store_true",
@@ -167,6 +203,9 @@ def cli():
     test_parser.add_argument(
         "-v", "--verbose", action="store_true",
         help="add verbose option to test command")
+    test_parser.add_argument(
+        "-b", "--benchmarks", action="store_true",
+        help="print results of benchmark tests")
 
     run_test_parser = subparsers.add_parser(
         "run-test", aliases=["rt"],
@@ -177,6 +216,9 @@ def cli():
     run_test_parser.add_argument(
         "-v", "--verbose", action="store_true",
         help="add verbose option to test command")
+    run_test_parser.add_argument(
+        "-b", "--benchmarks", action="store_true",
+        help="print results of benchmark tests")
     run_test_parser.add_argument(
         "--no-cache", action="store_true",
         help="do not use cache when building container images")
@@ -231,6 +273,23 @@ def cli():
         "watch", aliases=["w"], add_help=False,
         help=f"rebuild web app on file change {FILE_SYSTEM_NOTE}")
 
+    loadtest_parser = subparsers.add_parser(
+        "loadtest", aliases=["lt", "benchmark"],
+        help="run gunicorn inside the container and replay the opening of rooming against it")
+    loadtest_parser.add_argument(
+        "-D", "--create-data", action="store_true",
+        help="replace all data with random conference, users and rooms "
+             "(users start rooming in waves)")
+    loadtest_parser.add_argument(
+        "--users", type=int, default=400, help="number of users created with `-D`")
+    loadtest_parser.add_argument(
+        "--rooms", type=int, default=80, help="number of rooms created with `-D`")
+    loadtest_parser.add_argument(
+        "-c", "--clients", type=int, default=50, help="number of concurrent clients")
+    loadtest_parser.add_argument(
+        "-i", "--iterations", type=int, default=5,
+        help="number of list, join and lock rounds done by each client")
+
     python_parser = subparsers.add_parser(
         "python", aliases=["py"],
         help=f"perform action related to Python language {SUBCOMMANDS_NOTE}")
@@ -268,7 +327,7 @@ def cli():
         print(f"{Colour.BLUE}-- Setup containers --{Colour.NORMAL}")
         setup(args.no_cache)
         print(f"{Colour.BLUE}-- Run tests --{Colour.NORMAL}")
-        run_tests(args.module, args.verbose)
+        run_tests(args.module, args.verbose, args.benchmarks)
         print(f"{Colour.BLUE}-- Quit containers --{Colour.NORMAL}")
         shutdown()
 
@@ -279,7 +338,7 @@ def cli():
         shutdown()
 
     elif args.command in ["test", "t"]:
-        run_tests(args.module, args.verbose)
+        run_tests(args.module, args.verbose, args.benchmarks)
 
     elif args.command in ["bash", "shell", "sh"]:
         docker_exec(["/bin/bash"], WEB_CONTAINER_NAME)
@@ -308,6 +367,9 @@ def cli():
         else:
             web_parser.print_help()
 
+    elif args.command in ["loadtest", "lt", "benchmark"]:
+        run_loadtest(args.create_data, args.users, args.rooms, args.clients, args.iterations)
+
     elif args.command in ["python", "py"]:
         if args.action in ["install", "i"]:
             docker_shell(["pip", "install", "-r", "requirements.txt"])